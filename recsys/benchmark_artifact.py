@@ -0,0 +1,203 @@
+"""
+
+Benchmark the TensorFlow-free retrieval artifact (retrieval_artifact.py) against the Keras model of
+the deploy step (build_keras_model in keras_model.py): we export both from the same vector space, then
+load each one in a fresh Python process, as a serving worker would, and report:
+
+    startup_s       seconds from spawning the process to the first answered query (interpreter,
+                    imports, loading, warm up)
+    rss_mb          resident memory of the worker once it is ready
+    p50_ms/p99_ms   latency of one query (a single track)
+    batch_qps       queries per second in batches of --batch_size tracks
+
+The vector space is either the final vectors of a run of one of the recsys flows, or synthetic
+(clustered) vectors with --tracks. The Keras side needs tensorflow and tensorflow_recommenders:
+without them, it is recorded as skipped.
+
+Usage:
+
+    python benchmark_artifact.py --flow RecSysTuningFlow --indexes brute_force ivf pq
+    python benchmark_artifact.py --tracks 100000 1000000 --dim 48
+
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from training import rss_mb
+
+
+def measure(recommend, tracks, batch_size, spawned_at):
+    """
+    Warm up recommend (a function from a list of track names to recommendations), then time single
+    queries and batches of the given tracks: spawned_at is the wall clock time the process was spawned.
+    """
+    recommend(tracks[:1])
+    stats = {'startup_s': time.time() - spawned_at, 'rss_mb': rss_mb('VmRSS')}
+    latencies = []
+    for track in tracks:
+        query_start = time.perf_counter()
+        recommend([track])
+        latencies.append(time.perf_counter() - query_start)
+    batch_start = time.perf_counter()
+    for i in range(0, len(tracks), batch_size):
+        recommend(tracks[i:i + batch_size])
+    p50, p99 = np.percentile(1000 * np.array(latencies), [50, 99])
+    stats.update({
+        'p50_ms': float(p50),
+        'p99_ms': float(p99),
+        'batch_qps': len(tracks) / (time.perf_counter() - batch_start)
+    })
+
+    return stats
+
+
+def artifact_worker(path, tracks, k, batch_size, spawned_at):
+    from retrieval_artifact import load_artifact
+    runtime = load_artifact(path)
+    return measure(lambda batch: runtime.recommend(batch, k), tracks, batch_size, spawned_at)
+
+
+def keras_worker(path, tracks, k, batch_size, spawned_at):
+    import tensorflow as tf
+    model = tf.saved_model.load(path)
+
+    def recommend(batch):
+        # the BruteForce layer is built with its default k (10), as in the flows
+        _, names = model(tf.constant(batch))
+        return names.numpy()
+
+    return measure(recommend, tracks, batch_size, spawned_at)
+
+
+WORKERS = {
+    'artifact': artifact_worker,
+    'keras': keras_worker
+}
+
+
+def run_worker(kind, path, queries_path, k, batch_size):
+    """
+    Run a worker in a fresh process and return its stats (or its last error line).
+    """
+    completed = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', kind, '--path', path, '--queries', queries_path,
+         '--k', str(k), '--batch_size', str(batch_size), '--spawned_at', repr(time.time())],
+        capture_output=True, text=True)
+    if completed.returncode != 0:
+        lines = completed.stderr.strip().splitlines()
+        return {'error': lines[-1] if lines else 'exit code {}'.format(completed.returncode)}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def export_keras(store, path):
+    """
+    Save the Keras model of the deploy step as a SavedModel in path, as build_retrieval_model does.
+    """
+    from keras_model import build_keras_model
+    build_keras_model(store).save(filepath=path)
+
+
+def run_benchmark(stores, work_dir, index_types, n_queries, k, batch_size):
+    """
+    For each (label, embedding store), export an artifact per index type and the Keras model,
+    and benchmark each of them in its own process.
+    """
+    from retrieval_artifact import export_artifact
+    results = []
+    for label, store in stores:
+        os.makedirs(work_dir, exist_ok=True)
+        queries_path = os.path.join(work_dir, 'queries.json')
+        rng = np.random.default_rng(0)
+        with open(queries_path, 'w') as f:
+            json.dump([store.names[_] for _ in rng.integers(0, len(store), n_queries)], f)
+        exports = []
+        for index_type in index_types:
+            export_start = time.perf_counter()
+            path = export_artifact(os.path.join(work_dir, '{}.artifact'.format(index_type)), store, index_type)
+            exports.append(('artifact', index_type, path, time.perf_counter() - export_start))
+        keras_path = os.path.join(work_dir, 'keras_model')
+        export_start = time.perf_counter()
+        try:
+            export_keras(store, keras_path)
+            exports.append(('keras', 'brute_force', keras_path, time.perf_counter() - export_start))
+        except ImportError as e:
+            results.append({'vectors': label, 'tracks': len(store), 'runtime': 'keras', 'skipped': str(e)})
+            print("{} keras skipped: {}".format(label, e))
+        for kind, index_type, path, export_s in exports:
+            stats = run_worker(kind, path, queries_path, k, batch_size)
+            size_mb = sum(
+                os.path.getsize(os.path.join(root, _)) for root, _dirs, files in os.walk(path) for _ in files
+            ) if os.path.isdir(path) else os.path.getsize(path)
+            results.append(dict({
+                'vectors': label,
+                'tracks': len(store),
+                'runtime': kind,
+                'index': index_type,
+                'export_s': export_s,
+                'size_mb': size_mb / (1 << 20)
+            }, **stats))
+            if 'error' in stats:
+                print("{} {:<8} {:<12} failed: {}".format(label, kind, index_type, stats['error']))
+                continue
+            print("{} {:<8} {:<12} size={:.1f}MB startup={:.2f}s RSS={:.0f}MB "
+                  "p50={:.3f}ms p99={:.3f}ms batch={:.0f} q/s".format(
+                      label, kind, index_type, results[-1]['size_mb'], stats['startup_s'],
+                      stats['rss_mb'], stats['p50_ms'], stats['p99_ms'], stats['batch_qps']))
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def synthetic_store(path, n_tracks, dim):
+    from benchmark_retrieval import synthetic_vectors
+    from embedding_store import load_embedding_store, save_embedding_store
+    names = ['artist_{}|||track_{}'.format(i % max(1, n_tracks // 10), i) for i in range(n_tracks)]
+    return load_embedding_store(save_embedding_store(path, np.arange(n_tracks), synthetic_vectors(n_tracks, dim), names=names))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the retrieval artifact against the Keras model")
+    parser.add_argument('--flow', default=None, help='Flow storing final_vectors (instead of synthetic vectors)')
+    parser.add_argument('--run_id', default=None, help='Defaults to the latest successful run')
+    parser.add_argument('--tracks', type=int, nargs='+', default=[100000], help='Synthetic vocabulary sizes')
+    parser.add_argument('--dim', type=int, default=48)
+    parser.add_argument('--indexes', nargs='+', default=['brute_force', 'ivf', 'int8', 'pq'])
+    parser.add_argument('--queries', default=1000, help='Number of queries (a path, for --worker)')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--work_dir', default='artifact_benchmark')
+    parser.add_argument('--output', default='artifact_benchmark.json')
+    parser.add_argument('--worker', default=None, choices=list(WORKERS), help=argparse.SUPPRESS)
+    parser.add_argument('--path', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--spawned_at', type=float, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        # in a fresh process: load, measure, and print the stats for run_worker
+        with open(args.queries) as f:
+            tracks = json.load(f)
+        print(json.dumps(WORKERS[args.worker](args.path, tracks, args.k, args.batch_size, args.spawned_at)))
+        sys.exit(0)
+    if args.flow:
+        from serve import load_vectors
+        stores = [(args.flow, load_vectors(args.flow, args.run_id))]
+    else:
+        stores = ((str(n), synthetic_store(os.path.join(args.work_dir + '_stores', str(n)), n, args.dim)) for n in args.tracks)
+    results = run_benchmark(stores, args.work_dir, args.indexes, int(args.queries), args.k, args.batch_size)
+    shutil.rmtree(args.work_dir + '_stores', ignore_errors=True)
+    import platform
+    with open(args.output, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': vars(args),
+            'results': results
+        }, f, indent=2)
+    print("Results saved at: {}".format(args.output))
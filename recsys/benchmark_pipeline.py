@@ -0,0 +1,266 @@
+"""
+
+Benchmark the stages of the recsys flows at synthetic scale, without the Kaggle CSV: we generate
+playlists with the schema of cleaned_spotify_dataset (row_id, user_id, artist, track, playlist)
+and Zipfian track popularity, write them to Lance, and run the code behind each step on them:
+
+    generate_data         synthetic rows streamed to Lance, in batches
+    prepare_dataset       load_dataset (DuckDB) + write_corpus, as in the prepare_dataset step
+    generate_embeddings   train_word2vec + save_keyed_vectors, as in a branch of the foreach
+    evaluate_model        build_fallback + hit_rate on the validation split
+    keras_model           build_keras_model (keras_model.py) on the store (needs tensorflow)
+
+For each number of rows and stage we report the seconds, the throughput (rows, words, playlists
+or tracks per second), the RSS when the stage starts and its peak RSS, in a JSON file: compare it
+with the output of a previous commit to catch regressions before they reach production. On Linux,
+the peak RSS is reset before each stage, elsewhere it is the peak of the whole process so far.
+
+Synthetic playlists are only meant for timing: track popularity follows Zipf's law like real
+listening data, but tracks are drawn independently, so the vectors (and the hit rate) are noise.
+
+Usage:
+
+    python benchmark_pipeline.py --rows 100000 1000000 10000000 --output pipeline_benchmark.json
+    python benchmark_pipeline.py --rows 100000000 --until prepare_dataset
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import time
+
+import numpy as np
+
+from training import reset_peak_rss, rss_mb
+
+STAGES = ['generate_data', 'prepare_dataset', 'generate_embeddings', 'evaluate_model', 'keras_model']
+# same as the first configuration of PlaylistRecsFlow, with fewer epochs
+HYPERS = {'min_count': 3, 'epochs': 5, 'vector_size': 48, 'window': 10, 'ns_exponent': 0.75}
+
+
+def zipf_ranks(rng, n, n_items, exponent=1.0):
+    """
+    Draw n item ranks in [0, n_items), rank r with probability roughly proportional to
+    1 / (r + 1) ** exponent: we invert the CDF of the continuous (bounded) power law, so
+    there is no table of n_items probabilities to build or search.
+    """
+    u = rng.random(n)
+    if exponent == 1.0:
+        x = np.power(n_items + 1.0, u)
+    else:
+        x = np.power(1 + u * (np.power(n_items + 1.0, 1 - exponent) - 1), 1 / (1 - exponent))
+    return np.minimum(x.astype(np.int64) - 1, n_items - 1)
+
+
+def synthetic_playlists(n_rows, n_playlists, n_users, n_tracks, n_artists, zipf_exponent=1.0,
+                        batch_size=1 << 20, seed=42):
+    """
+    Yield record batches with the schema of cleaned_spotify_dataset: rows of a playlist are
+    contiguous (and playlists of a user), as in the original CSV, and track 0 is the most popular.
+    Memory only depends on batch_size, so we can stream 10^8 rows to disk.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    def names(prefix, ids):
+        return pc.binary_join_element_wise(prefix, pa.array(ids).cast(pa.string()), '')
+
+    rng = np.random.default_rng(seed)
+    for start in range(0, n_rows, batch_size):
+        row_ids = np.arange(start, min(start + batch_size, n_rows))
+        playlists = row_ids * n_playlists // n_rows
+        tracks = zipf_ranks(rng, row_ids.shape[0], n_tracks, zipf_exponent)
+        yield pa.RecordBatch.from_arrays([
+            pa.array(row_ids),
+            names('user_', playlists * n_users // n_playlists),
+            # popular tracks are spread over the artists
+            names('artist_', tracks % n_artists),
+            names('track_', tracks),
+            names('playlist_', playlists)
+        ], names=['row_id', 'user_id', 'artist', 'track', 'playlist'])
+
+
+def write_synthetic_dataset(path, n_rows, playlist_length, playlists_per_user, tracks_per_row,
+                            artists_per_track, zipf_exponent, seed=42):
+    """
+    Stream synthetic playlists to a Lance dataset at path, sizing playlists, users, tracks and
+    artists from n_rows and the given ratios; return the row count.
+    """
+    import lance
+    import pyarrow as pa
+    n_playlists = max(1, n_rows // playlist_length)
+    n_tracks = max(1, int(n_rows * tracks_per_row))
+    schema = pa.schema([('row_id', pa.int64())] + [
+        (_, pa.string()) for _ in ['user_id', 'artist', 'track', 'playlist']])
+    batches = synthetic_playlists(
+        n_rows,
+        n_playlists,
+        max(1, n_playlists // playlists_per_user),
+        n_tracks,
+        max(1, int(n_tracks * artists_per_track)),
+        zipf_exponent,
+        seed=seed)
+    lance.write_dataset(pa.RecordBatchReader.from_batches(schema, batches), path, schema=schema, mode='overwrite')
+
+    return n_rows
+
+
+def run_stage(results, n_rows, stage, unit, fn):
+    """
+    Run fn, which returns its output and the number of items (in unit) it processed, append the
+    stats of the stage to results and return the output. A missing optional dependency (e.g.
+    tensorflow for keras_model) is recorded as a skipped stage, any other error (e.g. DuckDB running
+    out of memory) as a failed one: in both cases we return None, and the later stages for this
+    number of rows are not run.
+    """
+    reset_peak_rss()
+    # allocators keep memory from previous stages: the peak is relative to this
+    start_rss = rss_mb('VmRSS')
+    start = time.perf_counter()
+    try:
+        output, items = fn()
+    except ImportError as e:
+        results.append({'rows': n_rows, 'stage': stage, 'skipped': str(e)})
+        print("rows={} {:<20} skipped: {}".format(n_rows, stage, e))
+        return None
+    except Exception as e:
+        results.append({'rows': n_rows, 'stage': stage, 'error': repr(e), 'peak_rss_mb': rss_mb()})
+        print("rows={} {:<20} failed: {!r}".format(n_rows, stage, e))
+        return None
+    seconds = time.perf_counter() - start
+    results.append({
+        'rows': n_rows,
+        'stage': stage,
+        'seconds': seconds,
+        'items': items,
+        'unit': unit,
+        'throughput': items / seconds if seconds > 0 else 0.0,
+        'start_rss_mb': start_rss,
+        'peak_rss_mb': rss_mb()
+    })
+    print("rows={} {:<20} {:.2f}s {:.0f} {}/s peak RSS={:.0f}MB".format(
+        n_rows, stage, seconds, results[-1]['throughput'], unit, results[-1]['peak_rss_mb']))
+
+    return output
+
+
+def benchmark_rows(results, n_rows, path, stages, k, index_type, hypers, workers, data_options):
+    """
+    Run the stages on a new synthetic dataset of n_rows rows in path: everything a stage needs
+    from the previous ones lives in this scope, so nothing outlives the size it was built for.
+    """
+    from dataset import load_dataset, track_names, write_corpus
+    from embedding_store import load_embedding_store, save_keyed_vectors
+    from evaluation import hit_rate
+    from fallback import build_fallback
+    from training import train_word2vec
+    lance_path = os.path.join(path, 'cleaned_spotify_dataset.lance')
+    if run_stage(results, n_rows, 'generate_data', 'rows', lambda: (
+            lance_path, write_synthetic_dataset(lance_path, n_rows, **data_options))) is None:
+        return
+
+    def prepare_dataset():
+        splits, vocabulary, _ = load_dataset(lance_path, is_dev=False)
+        corpus_path = write_corpus(splits['train']['track_sequence'], os.path.join(path, 'train_corpus.txt'))
+        return (splits, vocabulary, corpus_path), n_rows
+
+    def generate_embeddings():
+        model, _ = train_word2vec(corpus_path, hypers, workers)
+        store_path = save_keyed_vectors(
+            os.path.join(path, 'store'), model.wv, names=track_names(vocabulary, model.wv.index_to_key))
+        return (model.wv, load_embedding_store(store_path)), model.corpus_total_words * model.epochs
+
+    def evaluate_model():
+        dataset = splits['validate']
+        fallback = build_fallback(vector_space, vocabulary)
+        return hit_rate(dataset, vector_space, k, index_type, fallback), dataset.num_rows
+
+    def keras_model():
+        from keras_model import build_keras_model
+        return build_keras_model(store), len(store)
+
+    prepared = run_stage(results, n_rows, 'prepare_dataset', 'rows', prepare_dataset) \
+        if 'prepare_dataset' in stages else None
+    if prepared is None:
+        return
+    splits, vocabulary, corpus_path = prepared
+    embeddings = run_stage(results, n_rows, 'generate_embeddings', 'words', generate_embeddings) \
+        if 'generate_embeddings' in stages else None
+    if embeddings is None:
+        return
+    vector_space, store = embeddings
+    if 'evaluate_model' in stages and run_stage(results, n_rows, 'evaluate_model', 'playlists', evaluate_model) is None:
+        return
+    if 'keras_model' in stages:
+        run_stage(results, n_rows, 'keras_model', 'tracks', keras_model)
+
+
+def run_benchmark(sizes, work_dir, until='keras_model', k=100, index_type='brute_force', hypers=HYPERS,
+                  playlist_length=80, playlists_per_user=10, tracks_per_row=0.15, artists_per_track=0.15,
+                  zipf_exponent=1.0, keep_data=False):
+    import gc
+    from training import branch_workers
+    stages = STAGES[:STAGES.index(until) + 1]
+    data_options = {
+        'playlist_length': playlist_length,
+        'playlists_per_user': playlists_per_user,
+        'tracks_per_row': tracks_per_row,
+        'artists_per_track': artists_per_track,
+        'zipf_exponent': zipf_exponent
+    }
+    workers = branch_workers()
+    results = []
+    for n_rows in sizes:
+        path = os.path.join(work_dir, 'rows_{}'.format(n_rows))
+        benchmark_rows(results, n_rows, path, stages, k, index_type, hypers, workers, data_options)
+        # free the previous size before measuring the next one
+        gc.collect()
+        if not keep_data:
+            shutil.rmtree(path, ignore_errors=True)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the recsys pipeline on synthetic playlists")
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000, 10000000])
+    parser.add_argument('--until', default='keras_model', choices=STAGES, help='Last stage to run')
+    parser.add_argument('--work_dir', default='pipeline_benchmark')
+    parser.add_argument('--output', default='pipeline_benchmark.json')
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--index', default='brute_force', help='Retrieval index for evaluate_model')
+    parser.add_argument('--epochs', type=int, default=HYPERS['epochs'])
+    # defaults are in the ballpark of the Kaggle dataset
+    parser.add_argument('--playlist_length', type=int, default=80, help='Average rows per playlist')
+    parser.add_argument('--playlists_per_user', type=int, default=10)
+    parser.add_argument('--tracks_per_row', type=float, default=0.15, help='Distinct tracks / rows')
+    parser.add_argument('--artists_per_track', type=float, default=0.15, help='Distinct artists / tracks')
+    parser.add_argument('--zipf', type=float, default=1.0, help='Exponent of the track popularity')
+    parser.add_argument('--keep_data', action='store_true', help='Keep the synthetic datasets in work_dir')
+    args = parser.parse_args()
+    results = run_benchmark(
+        args.rows,
+        args.work_dir,
+        args.until,
+        args.k,
+        args.index,
+        dict(HYPERS, epochs=args.epochs),
+        args.playlist_length,
+        args.playlists_per_user,
+        args.tracks_per_row,
+        args.artists_per_track,
+        args.zipf,
+        args.keep_data)
+    from training import cpu_allocation
+    with open(args.output, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': cpu_allocation(),
+            'config': vars(args),
+            'results': results
+        }, f, indent=2)
+    print("Results saved at: {}".format(args.output))
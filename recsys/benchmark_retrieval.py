@@ -0,0 +1,127 @@
+"""
+
+Benchmark the retrieval indexes in retrieval.py: for several vocabulary sizes, we build each
+index over synthetic (clustered) track vectors and report recall@K against brute force,
+build time, queries per second, the memory the index scans (scan_mb) and the memory it holds
+(memory_mb, see resident_nbytes), against the float32 matrix of brute force (the quantized
+indexes, int8 and pq, trade some recall for memory).
+
+As in the flows and the server, the vectors are read from an embedding store: the normalized
+matrix is memory-mapped, so the quantized indexes do not hold a float32 copy next to their codes.
+
+Real Word2Vec vectors share a large common component (the mean of the normalized vectors has a
+norm close to 1), which is what breaks quantization without centering: --offset adds one to the
+synthetic vectors, and --min_recall turns the benchmark into a check, failing if any index
+recalls less than that.
+
+Usage:
+
+    python benchmark_retrieval.py --sizes 10000 100000 1000000 --k 100
+    python benchmark_retrieval.py --indexes brute_force pq --rerank 0
+    python benchmark_retrieval.py --sizes 20000 --offset 10 --min_recall 0.95
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from embedding_store import load_embedding_store, save_embedding_store
+from retrieval import build_index, resident_nbytes
+
+
+def synthetic_vectors(n_vectors, dim, n_clusters=256, offset=0.0, seed=42):
+    """
+    Word2Vec spaces are far from uniform: we mimic that with a gaussian mixture, shifted along one
+    random direction by offset times the typical norm of its points (anisotropic for offset > 0).
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    labels = rng.integers(0, n_clusters, n_vectors)
+    direction = rng.normal(size=dim)
+    shift = offset * np.sqrt(dim) * direction / np.linalg.norm(direction)
+    return (centers[labels] + 0.5 * rng.normal(size=(n_vectors, dim)) + shift).astype(np.float32)
+
+
+def recall_at_k(predictions, ground_truth):
+    """
+    Average fraction of the exact top K neighbours returned by the approximate index.
+    """
+    return np.mean([
+        len(np.intersect1d(p[p >= 0], g)) / len(g)
+        for p, g in zip(predictions, ground_truth)
+    ])
+
+
+def run_benchmark(sizes, dim, k, n_queries, index_types, n_probe, rerank=4, offset=0.0):
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='benchmark_retrieval')
+    for n_vectors in sizes:
+        store_path = save_embedding_store(
+            os.path.join(work_dir, str(n_vectors)), np.arange(n_vectors), synthetic_vectors(n_vectors, dim, offset=offset))
+        vectors = load_embedding_store(store_path).get_normed_vectors()
+        mean_norm = float(np.linalg.norm(np.mean(vectors, axis=0)))
+        print("V={} norm of the mean vector={:.3f}".format(n_vectors, mean_norm))
+        rng = np.random.default_rng(0)
+        query_ids = rng.choice(n_vectors, min(n_queries, n_vectors), replace=False)
+        ground_truth = None
+        baseline_bytes = None
+        for index_type in index_types:
+            kwargs = {'ivf': {'n_probe': n_probe}}.get(index_type, {})
+            start = time.time()
+            index = build_index(index_type, vectors, normalized=True, rerank=rerank, **kwargs)
+            build_time = time.time() - start
+            start = time.time()
+            predictions = index.search(index.vectors[query_ids], k, exclude=query_ids)
+            qps = len(query_ids) / (time.time() - start)
+            if ground_truth is None:
+                # the first index is the exact baseline
+                ground_truth = predictions
+                baseline_bytes = resident_nbytes(index)
+            results.append({
+                'vocab_size': n_vectors,
+                'mean_norm': mean_norm,
+                'index': index_type,
+                'recall@{}'.format(k): recall_at_k(predictions, ground_truth),
+                'build_s': build_time,
+                'qps': qps,
+                'scan_mb': index.nbytes / 2 ** 20,
+                'memory_mb': resident_nbytes(index) / 2 ** 20,
+                'compression': baseline_bytes / resident_nbytes(index)
+            })
+            print("V={} {:<12} recall@{}={:.3f} build={:.2f}s qps={:.0f} scan={:.1f}MB memory={:.1f}MB ({:.1f}x)".format(
+                n_vectors, index_type, k, results[-1]['recall@{}'.format(k)], build_time, qps,
+                results[-1]['scan_mb'], results[-1]['memory_mb'], results[-1]['compression']))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark exact vs approximate track retrieval")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--dim', type=int, default=48)
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--n_queries', type=int, default=1000)
+    parser.add_argument('--n_probe', type=int, default=16)
+    parser.add_argument('--rerank', type=int, default=4,
+                        help="int8 and pq: re-score the best k * rerank candidates with the exact vectors")
+    parser.add_argument('--offset', type=float, default=0.0,
+                        help="Common component of the vectors, in norms of the mixture (e.g. 10 for a mean vector of norm ~0.99)")
+    parser.add_argument('--min_recall', type=float, default=None,
+                        help="Exit with an error if the recall of any index is below this")
+    parser.add_argument('--indexes', nargs='+', default=['brute_force', 'ivf', 'int8', 'pq'])
+    args = parser.parse_args()
+    results = run_benchmark(
+        args.sizes, args.dim, args.k, args.n_queries, args.indexes, args.n_probe, args.rerank, args.offset)
+    if args.min_recall is not None:
+        failed = [_ for _ in results if _['recall@{}'.format(args.k)] < args.min_recall]
+        for _ in failed:
+            print("FAILED: {} recall@{}={:.3f} < {} on V={}".format(
+                _['index'], args.k, _['recall@{}'.format(args.k)], args.min_recall, _['vocab_size']))
+        if failed:
+            raise SystemExit(1)
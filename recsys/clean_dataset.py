@@ -1,43 +1,100 @@
 """
 
-Unfortunately, the dataset is not properly formatted. We simply pass it through pandas
-to get a clean CSV we can import in the Flow using duckdb.
+Unfortunately, the dataset is not properly formatted. We simply stream it through pyarrow
+to get a clean dataset we can import in the Flow using duckdb.
+
+The CSV is read in record batches, so peak memory is bounded by --memory_limit_mb and does not
+grow with the size of the file: each batch gets its header cleaned and a global row_id, and is
+appended to the Parquet file and to the Lance dataset before the next one is parsed.
+
+Usage:
+
+    python clean_dataset.py --memory_limit_mb 512 --threads 4
 
 """
 
+import argparse
+import csv
+
 import lance
-import pandas as pd
 import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+
+def clean_column_name(name):
+    # same clean up we used to do with pandas: '"artistname"' -> 'artist'
+    return name.replace('"', '').replace('name', '').replace(' ', '')
+
+
+def clean_dataset(
+    csv_path='spotify_dataset.csv',
+    parquet_path='cleaned_spotify_dataset.parquet',
+    lance_path='cleaned_spotify_dataset.lance',
+    memory_limit_mb=512,
+    n_threads=None
+):
+    """
+    Stream the raw CSV into Parquet and Lance. Blocks are sized so that the batches in flight
+    (one per parsing thread) plus the writers' buffers stay within memory_limit_mb; n_threads
+    controls how many cores parse the CSV (None uses all of them, 1 disables threading).
+    """
+    if n_threads is not None and n_threads > 1:
+        pa.set_cpu_count(n_threads)
+    n_parsers = pa.cpu_count() if n_threads is None or n_threads > 1 else 1
+    # a parsed block takes a few times its size in memory, and we keep one per parser
+    block_size = max(1 << 20, (memory_limit_mb << 20) // (4 * n_parsers))
+    # read the raw header, so that we can force every column to string: types inferred on the
+    # first block may not hold for the following ones (e.g. a track called '1979')
+    with open(csv_path, newline='') as f:
+        raw_names = next(csv.reader(f))
+    reader = pa_csv.open_csv(
+        csv_path,
+        read_options=pa_csv.ReadOptions(block_size=block_size, use_threads=n_parsers > 1),
+        # skip malformed lines, as pandas on_bad_lines='skip' did
+        parse_options=pa_csv.ParseOptions(invalid_row_handler=lambda row: 'skip'),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={_: pa.string() for _ in raw_names},
+            strings_can_be_null=True)
+    )
+    names = [clean_column_name(_) for _ in reader.schema.names]
+    schema = pa.schema([('row_id', pa.int64())] + [(_, pa.string()) for _ in names])
+    print("Cleaned columns: {}, block size: {} MB, parsers: {}".format(names, block_size >> 20, n_parsers))
+    stats = {'rows': 0, 'batches': 0}
 
-import random
-
-
-def clean_dataset():
-    df_playlist = pd.read_csv(
-        'spotify_dataset.csv', 
-        on_bad_lines='skip', 
-        # if you want to get a smaller dataset, you can subsample at the source here
-        # skiprows=lambda i: i>0 and random.random() > 0.50
-        )
-    # clean up the col names
-    df_playlist.columns = df_playlist.columns.str.replace('"', '')
-    df_playlist.columns = df_playlist.columns.str.replace('name', '')
-    df_playlist.columns = df_playlist.columns.str.replace(' ', '')
-    # add a row id
-    df_playlist.insert(0, 'row_id', range(0, len(df_playlist)))
-    # show the df
-    print(df_playlist.head())
-    # print the final length for the df before writing to disk
-    print("Total rows: {}".format(len(df_playlist)))
-    # dump to parquet (better than csv for duckdb)
-
-    df_playlist.to_parquet('cleaned_spotify_dataset.parquet')
-    lance.write_dataset(pa.Table.from_pandas(df_playlist), "cleaned_spotify_dataset.lance")
+    def cleaned_batches(parquet_writer):
+        for batch in reader:
+            # if you want to get a smaller dataset, you can subsample at the source here
+            # e.g. batch = batch.filter(pyarrow.compute.random(len(batch)) < 0.5)
+            row_ids = pa.array(range(stats['rows'], stats['rows'] + batch.num_rows), type=pa.int64())
+            batch = pa.RecordBatch.from_arrays([row_ids] + batch.columns, schema=schema)
+            if stats['batches'] == 0:
+                # show the first rows
+                print(batch.slice(0, 5).to_pandas())
+            parquet_writer.write_batch(batch)
+            stats['rows'] += batch.num_rows
+            stats['batches'] += 1
+            yield batch
 
+    # dump to parquet (better than csv for duckdb) and lance, in the same pass over the csv
+    with pq.ParquetWriter(parquet_path, schema) as parquet_writer:
+        lance.write_dataset(
+            pa.RecordBatchReader.from_batches(schema, cleaned_batches(parquet_writer)),
+            lance_path,
+            schema=schema,
+            mode='overwrite')
+    # print the final length for the dataset
+    print("Total rows: {} in {} batches".format(stats['rows'], stats['batches']))
+    print("Peak Arrow memory: {:.1f} MB".format(pa.default_memory_pool().max_memory() / (1 << 20)))
     print("All done\n\nSee you, space cowboy\n")
 
     return
 
 
 if __name__ == "__main__":
-    clean_dataset()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Stream the raw Spotify CSV into Parquet and Lance")
+    parser.add_argument('--input', default='spotify_dataset.csv')
+    parser.add_argument('--memory_limit_mb', type=int, default=512)
+    parser.add_argument('--threads', type=int, default=None, help='Parsing threads, defaults to all cores')
+    args = parser.parse_args()
+    clean_dataset(args.input, memory_limit_mb=args.memory_limit_mb, n_threads=args.threads)
@@ -0,0 +1,182 @@
+"""
+
+Item-item co-occurrence recommender: a baseline engine for the recsys flows, next to Word2Vec.
+
+In every training playlist, each track co-occurs with the `window` tracks that follow it: the
+pairs are counted by DuckDB with a self-join over the unnested sequences of the training corpus
+(the same file gensim trains on, see write_corpus in dataset.py), and the counts become a sparse
+(n_tracks, n_tracks) SciPy CSR matrix, with row i holding the tracks that followed track i and how
+often. The next tracks of a playlist are then the top K of the row of its last track: a single
+pass over the data, nothing to tune but the window, and one sparse row lookup per query. With
+'mean' or 'recency' pooling, the query is the weighted sum of the rows of the last tracks of the
+playlist instead, with the same weights as the pooled Word2Vec queries (see pool_weights in
+retrieval.py), so that both engines answer the same question in join_runs.
+
+Rows with fewer than K tracks (e.g. a track never followed by anything in training) are padded
+with the most popular tracks, as the cold-start fallback does for Word2Vec. Track ids are dense
+and sorted by decreasing popularity (see dataset.py), so ties go to the more popular track too.
+
+"""
+
+import numpy as np
+
+from retrieval import Exclusions, pool_weights
+
+# position of each track in its playlist, then every (track, later track within the window) pair
+COOCCURRENCE_QUERY = """
+    WITH playlists AS (
+        SELECT
+            ROW_NUMBER() OVER () AS playlist,
+            CAST(string_split(line, ' ') AS INTEGER[]) AS track_sequence
+        FROM read_csv('{corpus_path}', delim='\t', header=False, columns={{'line': 'VARCHAR'}})
+    ),
+    items AS (
+        SELECT playlist, UNNEST(track_sequence) AS track, UNNEST(range(len(track_sequence))) AS position
+        FROM playlists
+    )
+    SELECT a.track AS src, b.track AS dst, COUNT(*)::INTEGER AS count
+    FROM items a JOIN items b
+    ON a.playlist = b.playlist AND b.position > a.position AND b.position <= a.position + {window}
+    WHERE a.track != b.track
+    GROUP BY a.track, b.track
+    HAVING COUNT(*) >= {min_count}
+    ;
+"""
+
+
+def cooccurrence_matrix(corpus_path, n_tracks, window=5, min_count=1):
+    """
+    Sparse (n_tracks, n_tracks) float32 CSR matrix of the number of times track j came at most
+    window tracks after track i in the playlists of the corpus, without the pairs seen less than
+    min_count times.
+    """
+    import duckdb
+    from scipy import sparse
+    con = duckdb.connect(database=':memory:')
+    con.execute(COOCCURRENCE_QUERY.format(corpus_path=corpus_path, window=int(window), min_count=int(min_count)))
+    pairs = con.fetch_arrow_table()
+    con.close()
+    src, dst = pairs['src'].to_numpy(), pairs['dst'].to_numpy()
+
+    return sparse.csr_matrix(
+        (pairs['count'].to_numpy().astype(np.float32), (src, dst)), shape=(n_tracks, n_tracks))
+
+
+class CooccurrenceModel():
+    """
+    Next-track recommendations from the rows of a co-occurrence matrix (see cooccurrence_matrix).
+    """
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+
+    @property
+    def nbytes(self):
+        return self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+
+    def recommend(self, query_items, k, exclude=None, pooling='last'):
+        """
+        Return a (n_queries, k) array of track ids, best first (-1 padded): the top k of the row of
+        each query item (-1 for none), then the most popular tracks. query_items can also be a
+        (n_queries, N) array with the last N tracks of each query, most recent last and padded with
+        -1 (see last_n_items in evaluation.py): with 'mean' or 'recency' pooling, the rows of those
+        tracks are summed with the weights of pool_weights. The (last) query item is excluded,
+        unless exclude (Exclusions over track ids) replaces it with a set per query.
+        """
+        sessions = np.asarray(query_items, dtype=np.int64).reshape(len(query_items), -1)
+        n_queries, n_tracks = sessions.shape[0], self.matrix.shape[0]
+        exclude = Exclusions.from_rows(sessions[:, -1]) if exclude is None else exclude
+        # one (query, item, weight) per track of a session that is a row of the matrix
+        weights = pool_weights(np.where(sessions < n_tracks, sessions, -1), pooling)
+        items_query, items_position = np.nonzero(weights > 0)
+        items = sessions[items_query, items_position]
+        # flatten the rows of the items into (query, track, weighted count) candidates
+        starts = self.matrix.indptr[items]
+        lengths = self.matrix.indptr[items + 1] - starts
+        queries = np.repeat(items_query, lengths)
+        positions = np.repeat(starts - np.r_[0, np.cumsum(lengths)[:-1]], lengths) + np.arange(lengths.sum())
+        tracks = self.matrix.indices[positions].astype(np.int64)
+        scores = self.matrix.data[positions] * np.repeat(weights[items_query, items_position], lengths).astype(np.float64)
+        if pooling != 'last':
+            # a track in the rows of several items of a session gets the sum of its weighted counts
+            keys, inverse = np.unique(queries * n_tracks + tracks, return_inverse=True)
+            queries, tracks, scores = keys // n_tracks, keys % n_tracks, np.bincount(inverse, weights=scores)
+        # popular tracks come after any co-occurring track (counts are >= 1), in popularity order:
+        # we need k of them, plus as many as each query may exclude
+        if exclude.bits is None:
+            max_excluded = (exclude.offsets[1:] - exclude.offsets[:-1]).max(initial=0)
+        else:
+            max_excluded = np.unpackbits(exclude.bits, axis=1).sum(axis=1).max(initial=0)
+        n_popular = min(n_tracks, k + int(max_excluded))
+        queries = np.r_[queries, np.repeat(np.arange(n_queries), n_popular)]
+        tracks = np.r_[tracks, np.tile(np.arange(n_popular), n_queries)]
+        scores = np.r_[scores, np.tile(-np.arange(1, n_popular + 1) / (n_popular + 1), n_queries)]
+        valid = ~exclude.contains_pairs(queries, tracks)
+        queries, tracks, scores = queries[valid], tracks[valid], scores[valid]
+        # best score first within each query, then keep the first k distinct tracks
+        order = np.lexsort((tracks, -scores, queries))
+        queries, tracks = queries[order], tracks[order]
+        # a popular track may also be in the row of the query: its first (best) entry wins
+        _, first = np.unique(queries * n_tracks + tracks, return_index=True)
+        first = np.sort(first)
+        queries, tracks = queries[first], tracks[first]
+        rank = np.arange(queries.shape[0]) - np.searchsorted(queries, queries)
+        keep = rank < k
+        results = np.full((n_queries, k), -1, dtype=np.int64)
+        results[queries[keep], rank[keep]] = tracks[keep]
+
+        return results
+
+
+def train_cooccurrence(corpus_path, n_tracks, hypers):
+    return CooccurrenceModel(
+        cooccurrence_matrix(corpus_path, n_tracks, hypers.get('window', 5), hypers.get('min_count', 1)))
+
+
+def save_cooccurrence(path, model):
+    """
+    Save the matrix as a .npz file in path (e.g. next to the vectors of the other branches) and
+    return its absolute path.
+    """
+    import os
+    from scipy import sparse
+    os.makedirs(path, exist_ok=True)
+    matrix_path = os.path.abspath(os.path.join(path, 'cooccurrence.npz'))
+    sparse.save_npz(matrix_path, model.matrix)
+
+    return matrix_path
+
+
+def load_cooccurrence(matrix_path):
+    from scipy import sparse
+    return CooccurrenceModel(sparse.load_npz(matrix_path).tocsr())
+
+
+def evaluate_cooccurrence(model, dataset, cutoffs, pooling='last', session_length=5, exclude_seen=False,
+                          batch_size=8192):
+    """
+    HR@k, MRR@k and NDCG@k for each k in cutoffs (see evaluation.py) of the model on the rows of the
+    dataset, with the same queries as the Word2Vec engine (see rank_targets): the last track of
+    track_test_x, or its last session_length tracks pooled, unless pooling is 'last'. With
+    exclude_seen, none of the tracks of track_test_x can be predicted, instead of only the last one.
+    Queries go in batches of batch_size, to bound the candidates in memory.
+    """
+    import pyarrow as pa
+    from evaluation import last_n_items, ranking_metrics, target_ranks
+    sessions = last_n_items(dataset['track_test_x'], 1 if pooling == 'last' else session_length)
+    exclude = Exclusions.from_rows(sessions[:, -1])
+    if exclude_seen:
+        # track ids are the rows of the matrix: the lists are the exclusions as they are
+        list_column = dataset['track_test_x']
+        if isinstance(list_column, pa.ChunkedArray):
+            list_column = list_column.combine_chunks()
+        offsets = list_column.offsets.to_numpy().astype(np.int64)
+        exclude = Exclusions(
+            list_column.values.to_numpy()[offsets[0]:offsets[-1]].astype(np.int64), offsets - offsets[0])
+    predictions = np.concatenate([
+        model.recommend(
+            sessions[start:start + batch_size], max(cutoffs), exclude.take(slice(start, start + batch_size)), pooling)
+        for start in range(0, sessions.shape[0], batch_size)
+    ]) if sessions.shape[0] else np.empty((0, max(cutoffs)), dtype=np.int64)
+
+    return ranking_metrics(target_ranks(predictions, dataset['track_test_y'].to_numpy()), cutoffs)
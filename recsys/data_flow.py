@@ -1,4 +1,5 @@
-from metaflow import FlowSpec, step, S3, Parameter, current
+from metaflow import FlowSpec, step, S3, Parameter, current, card
+from metaflow.cards import Markdown, Table
 
 class DataFlow(FlowSpec):
 
@@ -7,79 +8,51 @@ class DataFlow(FlowSpec):
         help='Flag for dev development, with a smaller dataset',
         default='1'
     )
+
+    DATASET_CACHE = Parameter(
+        name='dataset_cache',
+        help='Folder caching the prepared dataset across runs (empty string to disable)',
+        default='dataset_cache'
+    )
+
+    PROFILING = Parameter(
+        name='profiling',
+        help='Dataset stats: approx (one HyperLogLog scan), exact (one exact scan) or none',
+        default='approx'
+    )
     
     @step
     def start(self):
         self.next(self.prepare_dataset)
 
+    @card(type='blank', id='datasetCard')
     @step
     def prepare_dataset(self):
         """
-        Get the data in the right shape by reading the parquet dataset
+        Get the data in the right shape by reading the cleaned dataset
         and using DuckDB SQL-based wrangling to quickly prepare the datasets for
         training our Recommender System.
         """
-        import duckdb
-        import lance
-        import numpy as np
-        base_table = lance.dataset('cleaned_spotify_dataset.lance').to_table()
-        # highlight-next-line
-        con = duckdb.connect(database=':memory:')
-        # highlight-start
-        con.execute("""
-            CREATE TABLE playlists AS 
-            SELECT *, 
-            CONCAT (user_id, '-', playlist) as playlist_id,
-            CONCAT (artist, '|||', track) as track_id,
-            FROM base_table
-            ;
-        """)
-        # highlight-end
-        # highlight-next-line
-        con.execute("SELECT * FROM playlists LIMIT 1;")
-        print(con.fetchone())
-        tables = ['row_id', 'user_id', 'track_id', 'playlist_id', 'artist']
-        for t in tables:
-            # highlight-next-line
-            con.execute("SELECT COUNT(DISTINCT({})) FROM playlists;".format(t))
-            print("# of {}".format(t), con.fetchone()[0])
-        sampling_cmd = ''
-        if self.IS_DEV == '1':
-            print("Subsampling data, since this is DEV")
-            # highlight-next-line
-            sampling_cmd = ' USING SAMPLE 10 PERCENT (bernoulli)'
-        # highlight-start
-        dataset_query = """
-            SELECT * FROM
-            (   
-                SELECT 
-                    playlist_id,
-                    LIST(artist ORDER BY row_id ASC) as artist_sequence,
-                    LIST(track_id ORDER BY row_id ASC) as track_sequence,
-                    array_pop_back(LIST(track_id ORDER BY row_id ASC)) as track_test_x,
-                    LIST(track_id ORDER BY row_id ASC)[-1] as track_test_y
-                FROM 
-                    playlists
-                GROUP BY playlist_id 
-                HAVING len(track_sequence) > 2
-            ) 
-            {}
-            ;
-            """.format(sampling_cmd)
-        con.execute(dataset_query)
-        df = con.fetch_df()
-        # highlight-end
-        print("# rows: {}".format(len(df)))
-        print(df.iloc[0].tolist())
-        con.close()
-        train, validate, test = np.split(
-            df.sample(frac=1, random_state=42), 
-            [int(.7 * len(df)), int(.9 * len(df))])
-        self.df_dataset = df
-        self.df_train = train
-        self.df_validate = validate
-        self.df_test = test
-        print("# testing rows: {}".format(len(self.df_test)))
+        from dataset import load_dataset
+        # the DuckDB wrangling lives in dataset.py, so that all the flows share it: the prepared
+        # table is cached, keyed by the Lance dataset version, IS_DEV and the queries
+        splits, self.vocabulary, self.dataset_profile = load_dataset(
+            is_dev=self.IS_DEV == '1',
+            cache_dir=self.DATASET_CACHE,
+            profiling=self.PROFILING)
+        # descriptive stats (distinct users, tracks, ...) go to a card, instead of the logs
+        if self.dataset_profile:
+            current.card.append(Markdown("## Dataset profile ({} counts)".format(self.dataset_profile.mode)))
+            current.card.append(Table(self.dataset_profile.to_rows(), headers=['stat', 'value']))
+        print("# rows: {}".format(sum(_.num_rows for _ in splits.values())))
+        print(splits['train'].slice(0, 1).to_pylist())
+        # playlists are assigned to training, validation and test set inside DuckDB, from a hash
+        # of the playlist id, and each split comes back as an Arrow table (no pandas copies)
+        # with tracks as int ids: self.vocabulary maps them back to 'artist|||track'
+        self.train_dataset = splits['train']
+        self.validation_dataset = splits['validate']
+        self.test_dataset = splits['test']
+        print("# testing rows: {}".format(self.test_dataset.num_rows))
         self.next(self.end)
 
     @step
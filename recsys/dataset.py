@@ -0,0 +1,285 @@
+"""
+
+Shared dataset preparation for the recsys flows: DuckDB SQL-based wrangling to go from the
+cleaned Spotify dataset (one row per playlist entry) to one row per playlist, with the
+sequences of artists and tracks we need to train and evaluate a Prod2Vec type of model.
+
+Tracks are dictionary-encoded in DuckDB: each track_id ('artist|||track') gets a dense int32 id
+(0 being the most popular track), sequences are stored as Arrow list<int32>, and the vocabulary
+table (track_idx -> track_id, artist, occurrences) translates ids back to names at the edges.
+
+Playlists are assigned to train / validation / test (70/20/10) inside DuckDB, from a hash of
+playlist_id: the split of a playlist does not depend on sampling, on the other playlists or on
+the run, so it stays the same as the data grows. Each split is handed over from DuckDB as an
+Arrow table, without going through pandas. The training split is then written once as a text
+corpus (write_corpus), which gensim reads without going through Python either.
+
+Descriptive stats (distinct users, tracks, playlists...) are computed in a single scan, using
+HyperLogLog approximate distinct counts unless exact counts are requested, and returned as a
+DatasetProfile the flows can version and show on a card.
+
+The Lance dataset is scanned once, streaming into DuckDB only the columns we use (BASE_COLUMNS).
+Dev runs sample whole playlists during that scan, from a (salted) hash of playlist_id, so they read
+into DuckDB and aggregate ~10% of the rows instead of sampling the aggregated playlists at the end.
+
+Preparing the dataset is by far the slowest part of a dev iteration, so the prepared splits
+are cached on disk: the cache key is the version of the Lance dataset, the dev flag, the columns
+and the text of the queries, so any change to the input or to the SQL below gives a new entry.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from dataclasses import asdict, dataclass
+
+DATASET_PATH = 'cleaned_spotify_dataset.lance'
+SPLITS = ['train', 'validate', 'test']
+# the only columns of the cleaned dataset the queries below use
+BASE_COLUMNS = ['row_id', 'user_id', 'playlist', 'artist', 'track']
+PROFILE_COLUMNS = ['row_id', 'user_id', 'track_id', 'playlist_id', 'artist']
+PROFILING_MODES = ['approx', 'exact', 'none']
+
+# note we create a new id for the playlist, by concatenating user and playlist name
+# since songs can have the same name (e.g. Intro), we make them (more?) unique by
+# concatenating the artist and the track with a special symbol |||
+# NOTE: base_table is a stream of record batches from Lance, so the optional WHERE clause samples
+# at scan time: rows of the playlists we drop are never materialized
+PLAYLISTS_QUERY = """
+    CREATE TABLE playlists AS
+    SELECT *,
+    CONCAT (user_id, '-', playlist) as playlist_id,
+    CONCAT (artist, '|||', track) as track_id,
+    FROM base_table
+    {}
+    ;
+"""
+
+# whole playlists, ~10% of them: the hash is salted, as the unsalted one assigns the splits below
+DEV_SAMPLING = "WHERE hash(CONCAT (user_id, '-', playlist, '|dev')) % 100 < 10"
+
+# dense int ids for tracks, by decreasing popularity: strings are repeated across millions of
+# rows, while the sequences we carry around (Word2Vec, evaluation, artifacts) only need the ids
+VOCABULARY_QUERY = """
+    CREATE TABLE tracks AS
+    SELECT
+        (ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC, track_id) - 1)::INTEGER as track_idx,
+        track_id,
+        MIN(artist) as artist,
+        COUNT(*) as occurrences
+    FROM playlists
+    GROUP BY track_id
+    ;
+"""
+
+# each row is keyed by playlist id, and with two arrays for the sequence of artists
+# in the playlist and the sequence of songs (as track_idx) - we use the original row_id
+# as index for the playlist ordering
+# 9cc0cfd4d7d7885102480dd99e7a90d6-HardRock | [ artist_1, ... artist_n ] | [ 4, ... 1022 ]
+# track_test_x is the list of songs in a playlist except the LAST one
+# track_test_y is the LAST song - we will use these columns for validation and testing
+# of our recommender, when asking the model to "continue" a playlist it has never seen before.
+# the split is a function of the playlist_id hash only: 0-69 train, 70-89 validate, 90-99 test
+# (NOTE: DuckDB's hash may change across DuckDB versions, which env.yml pins)
+DATASET_QUERY = """
+    CREATE TABLE dataset AS
+    SELECT
+        playlist_id,
+        LIST(playlists.artist ORDER BY row_id ASC) as artist_sequence,
+        LIST(track_idx ORDER BY row_id ASC) as track_sequence,
+        array_pop_back(LIST(track_idx ORDER BY row_id ASC)) as track_test_x,
+        LIST(track_idx ORDER BY row_id ASC)[-1] as track_test_y,
+        CASE
+            WHEN hash(playlist_id) % 100 < 70 THEN 'train'
+            WHEN hash(playlist_id) % 100 < 90 THEN 'validate'
+            ELSE 'test'
+        END as split
+    FROM
+        playlists JOIN tracks USING (track_id)
+    GROUP BY playlist_id
+    HAVING len(track_sequence) > 2
+    ;
+"""
+
+# rows come back in a deterministic (but shuffled) order, so that training is reproducible
+SPLIT_QUERY = """
+    SELECT * EXCLUDE (split) FROM dataset WHERE split = '{}' ORDER BY hash(playlist_id), playlist_id;
+"""
+
+
+@dataclass
+class DatasetProfile:
+    """
+    Descriptive stats of the playlists table: mode is 'approx' (HyperLogLog) or 'exact'.
+    """
+    mode: str
+    rows: int
+    distinct: dict
+
+    def to_rows(self):
+        return [['rows', self.rows]] + [['# of {}'.format(k), v] for k, v in self.distinct.items()]
+
+
+def profile_query(mode):
+    """
+    One query, i.e. one scan over playlists, for all the distinct counts.
+    """
+    if mode not in PROFILING_MODES:
+        raise ValueError("Unknown profiling mode '{}', choose one of: {}".format(mode, PROFILING_MODES))
+    if mode == 'none':
+        return None
+    distinct = 'approx_count_distinct({0})' if mode == 'approx' else 'COUNT(DISTINCT {0})'
+    return "SELECT COUNT(*), {} FROM playlists;".format(
+        ', '.join(distinct.format(_) for _ in PROFILE_COLUMNS))
+
+
+def dataset_queries(is_dev, profiling='approx'):
+    """
+    Return the SQL we run to build the dataset - playlists will be sampled down if this is a dev run.
+    """
+    return {
+        'playlists': PLAYLISTS_QUERY.format(DEV_SAMPLING if is_dev else ''),
+        'vocabulary': VOCABULARY_QUERY,
+        'profile': profile_query(profiling),
+        'dataset': DATASET_QUERY,
+        'splits': {_: SPLIT_QUERY.format(_) for _ in SPLITS}
+    }
+
+
+def cache_key(dataset_path, is_dev, queries):
+    """
+    Hash of everything that determines the prepared table.
+    """
+    import lance
+    key = {
+        'dataset': os.path.abspath(dataset_path),
+        'version': lance.dataset(dataset_path).version,
+        'is_dev': is_dev,
+        'columns': BASE_COLUMNS,
+        'queries': queries
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def build_dataset(dataset_path, queries):
+    """
+    Run the queries in DuckDB and return the splits as a dictionary of Arrow tables, the
+    vocabulary as an Arrow table and the DatasetProfile (None if profiling is disabled).
+    """
+    import duckdb
+    import lance
+    import pyarrow as pa
+    lance_dataset = lance.dataset(dataset_path)
+    # only the columns we use, streamed batch by batch: DuckDB filters (in dev) while it scans,
+    # instead of the whole table being materialized in Arrow first
+    schema = pa.schema([lance_dataset.schema.field(_) for _ in BASE_COLUMNS])
+    base_table = pa.RecordBatchReader.from_batches(schema, lance_dataset.to_batches(columns=BASE_COLUMNS))
+    # we start a fast in-memory database
+    con = duckdb.connect(database=':memory:')
+    con.register('base_table', base_table)
+    con.execute(queries['playlists'])
+    # quick inspection of the first line
+    con.execute("SELECT * FROM playlists LIMIT 1;")
+    print(con.fetchone())
+    # let's leverage duckdb super fast SQL interface to get some descriptive stats
+    # about our dataset, all of them in one pass
+    profile = None
+    if queries['profile']:
+        con.execute(queries['profile'])
+        counts = con.fetchone()
+        profile = DatasetProfile(
+            mode='approx' if 'approx_count_distinct' in queries['profile'] else 'exact',
+            rows=counts[0],
+            distinct=dict(zip(PROFILE_COLUMNS, counts[1:])))
+    con.execute(queries['vocabulary'])
+    con.execute(queries['dataset'])
+    # the playlists table is not needed anymore, free the memory before exporting the splits
+    con.execute("DROP TABLE playlists;")
+    splits = {}
+    for split, split_query in queries['splits'].items():
+        con.execute(split_query)
+        splits[split] = con.fetch_arrow_table()
+    con.execute("SELECT * FROM tracks ORDER BY track_idx;")
+    vocabulary = con.fetch_arrow_table()
+    # close out the db connection
+    con.close()
+
+    return splits, vocabulary, profile
+
+
+def load_dataset(dataset_path=DATASET_PATH, is_dev=True, cache_dir=None, profiling='approx'):
+    """
+    Return the prepared dataset, one row per playlist, as a dictionary from split name
+    ('train', 'validate', 'test') to Arrow table, the track vocabulary and the DatasetProfile.
+
+    If cache_dir is set, we first look for splits prepared with the same Lance dataset version,
+    dev flag and queries, and skip DuckDB entirely on a hit; on a miss, the new splits are saved there.
+    """
+    import pyarrow.parquet as pq
+    queries = dataset_queries(is_dev, profiling)
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, cache_key(dataset_path, is_dev, queries))
+        if os.path.exists(cache_path):
+            print("Loading the prepared dataset from cache: {}".format(cache_path))
+            with open(os.path.join(cache_path, 'profile.json')) as f:
+                profile = json.load(f)
+            splits = {_: pq.read_table(os.path.join(cache_path, '{}.parquet'.format(_))) for _ in SPLITS}
+            vocabulary = pq.read_table(os.path.join(cache_path, 'vocabulary.parquet'))
+            return splits, vocabulary, DatasetProfile(**profile) if profile else None
+    if is_dev:
+        print("Subsampling data, since this is DEV")
+    splits, vocabulary, profile = build_dataset(dataset_path, queries)
+    if cache_path:
+        # write to a temporary folder of our own first, so that a crash never leaves a broken cache
+        # entry and concurrent runs with the same key never write to the same files
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=os.path.basename(cache_path) + '.', suffix='.tmp', dir=cache_dir)
+        for split, table in splits.items():
+            pq.write_table(table, os.path.join(tmp_path, '{}.parquet'.format(split)))
+        pq.write_table(vocabulary, os.path.join(tmp_path, 'vocabulary.parquet'))
+        with open(os.path.join(tmp_path, 'profile.json'), 'w') as f:
+            json.dump(asdict(profile) if profile else None, f)
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            if not os.path.exists(cache_path):
+                raise
+            # another run with the same key got there first: its entry holds the same splits
+            shutil.rmtree(tmp_path)
+        print("Prepared dataset cached at: {}".format(cache_path))
+
+    return splits, vocabulary, profile
+
+
+def track_names(vocabulary, track_ids):
+    """
+    Translate track ids (ints, or the string tokens we feed to gensim) back to 'artist|||track'.
+    """
+    import numpy as np
+    import pyarrow as pa
+    return vocabulary.column('track_id').take(pa.array(np.asarray(track_ids, dtype=np.int64))).to_pylist()
+
+
+def write_corpus(list_column, path):
+    """
+    Write a list<int32> column of track ids as a Word2Vec corpus file, one sequence per line with
+    space-separated ids, and return the absolute path: gensim reads it in corpus_file mode, without
+    going through Python (see training.py). Ids are written as they are, so gensim keys are the track
+    ids as strings. We convert one record batch at a time, with Arrow compute kernels.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    schema = pa.schema([('tokens', pa.string())])
+    # ids and spaces only, so a header-less, unquoted CSV with one column is exactly the corpus format
+    options = pa_csv.WriteOptions(include_header=False, quoting_style='none')
+    with pa_csv.CSVWriter(path, schema, write_options=options) as writer:
+        for chunk in list_column.chunks:
+            lines = pc.binary_join(chunk.cast(pa.list_(pa.string())), ' ')
+            writer.write_batch(pa.RecordBatch.from_arrays([lines], schema=schema))
+
+    return os.path.abspath(path)
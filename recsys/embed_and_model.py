@@ -1,4 +1,5 @@
-from metaflow import FlowSpec, step, S3, Parameter, current
+from metaflow import FlowSpec, step, S3, Parameter, current, card, Flow, Run
+from metaflow.cards import Markdown, Table
 import os
 import json
 import time
@@ -13,6 +14,18 @@ class RecModelTrainingFlow(FlowSpec):
         default='1'
     )
 
+    DATASET_CACHE = Parameter(
+        name='dataset_cache',
+        help='Folder caching the prepared dataset across runs (empty string to disable)',
+        default='dataset_cache'
+    )
+
+    PROFILING = Parameter(
+        name='profiling',
+        help='Dataset stats: approx (one HyperLogLog scan), exact (one exact scan) or none',
+        default='approx'
+    )
+
     #highlight-start
     KNN_K = Parameter(
         name='knn_k',
@@ -21,81 +34,137 @@ class RecModelTrainingFlow(FlowSpec):
     ) 
     #highlight-end
 
+    RETRIEVAL_INDEX = Parameter(
+        name='retrieval_index',
+        help='Index for KNN retrieval: brute_force (exact), ivf (approximate, faster on large catalogues), int8 or pq (quantized, less memory)',
+        default='brute_force'
+    )
+
+    RETRIEVAL_RERANK = Parameter(
+        name='retrieval_rerank',
+        help='With int8 or pq, re-score the best K * retrieval_rerank candidates with the exact vectors (0 to rank on the codes only)',
+        default='4'
+    )
+
+    QUERY_POOLING = Parameter(
+        name='query_pooling',
+        help='KNN query for a playlist: last (last track), mean or recency (pooled vectors of the last tracks)',
+        default='last'
+    )
+
+    SESSION_LENGTH = Parameter(
+        name='session_length',
+        help='Number of tracks pooled in the query, with mean or recency pooling',
+        default='5'
+    )
+
+    EXCLUDE_SEEN = Parameter(
+        name='exclude_seen',
+        help='1 to never recommend tracks that are already in the playlist, 0 to only exclude the query track',
+        default='0'
+    )
+
+    EVAL_CUTOFFS = Parameter(
+        name='eval_cutoffs',
+        help='Comma separated cutoffs K for Hit Rate@K, MRR@K and NDCG@K, on top of knn_k',
+        default='1,10'
+    )
+
+    EVAL_WORKERS = Parameter(
+        name='eval_workers',
+        help='Processes sharing the test set evaluation in model_testing, 0 for one per allocated CPU',
+        default='1'
+    )
+
+    EMBEDDING_STORE = Parameter(
+        name='embedding_store',
+        help='Local (or shared) folder where track vectors are stored as memory-mapped embedding stores',
+        default='embedding_stores'
+    )
+
+    INCREMENTAL = Parameter(
+        name='incremental',
+        help='Flag to warm-start from the latest successful run, training on new playlists only',
+        default='0'
+    )
+
+    GUARD_TOLERANCE = Parameter(
+        name='guard_tolerance',
+        help='Max relative drop in validation Hit Rate vs the last full retrain before an incremental run retrains from scratch',
+        default='0.05'
+    )
+
     @step
     def start(self):
+        from evaluation import parse_cutoffs
         print("flow name: %s" % current.flow_name)
         print("run id: %s" % current.run_id)
         print("username: %s" % current.username)
         if self.IS_DEV == '1':
             print("ATTENTION: RUNNING AS DEV VERSION - DATA WILL BE SUB-SAMPLED!!!")
+        # bad eval_cutoffs fail here, not after training
+        parse_cutoffs(self.KNN_K, self.EVAL_CUTOFFS)
         self.next(self.prepare_dataset)
 
+    @card(type='blank', id='datasetCard')
     @step
     def prepare_dataset(self):
         """
-        Get the data in the right shape by reading the parquet dataset
+        Get the data in the right shape by reading the cleaned dataset
         and using duckdb SQL-based wrangling to quickly prepare the datasets for
         training our Recommender System.
         """
-        import duckdb
-        import lance
-        import numpy as np
-        base_table = lance.dataset('cleaned_spotify_dataset.lance').to_table()
-        con = duckdb.connect(database=':memory:')
-        con.execute("""
-            CREATE TABLE playlists AS 
-            SELECT *, 
-            CONCAT (user_id, '-', playlist) as playlist_id,
-            CONCAT (artist, '|||', track) as track_id,
-            FROM base_table
-            ;
-        """)
-        con.execute("SELECT * FROM playlists LIMIT 1;")
-        print(con.fetchone())
-        
-        tables = ['row_id', 'user_id', 'track_id', 'playlist_id', 'artist']
-        for t in tables:
-            con.execute("SELECT COUNT(DISTINCT({})) FROM playlists;".format(t))
-            print("# of {}".format(t), con.fetchone()[0])
-            
-        sampling_cmd = ''
-        if self.IS_DEV == '1':
-            print("Subsampling data, since this is DEV")
-            sampling_cmd = ' USING SAMPLE 10 PERCENT (bernoulli)'
-            
-        dataset_query = """
-            SELECT * FROM
-            (   
-                SELECT 
-                    playlist_id,
-                    LIST(artist ORDER BY row_id ASC) as artist_sequence,
-                    LIST(track_id ORDER BY row_id ASC) as track_sequence,
-                    array_pop_back(LIST(track_id ORDER BY row_id ASC)) as track_test_x,
-                    LIST(track_id ORDER BY row_id ASC)[-1] as track_test_y
-                FROM 
-                    playlists
-                GROUP BY playlist_id 
-                HAVING len(track_sequence) > 2
-            ) 
-            {}
-            ;
-            """.format(sampling_cmd)
-        
-        con.execute(dataset_query)
-        df = con.fetch_df()
-        print("# rows: {}".format(len(df)))
-        print(df.iloc[0].tolist())
-        con.close()
-
-        train, validate, test = np.split(
-            df.sample(frac=1, random_state=42), 
-            [int(.7 * len(df)), int(.9 * len(df))])
-        
-        self.df_dataset = df
-        self.df_train = train
-        self.df_validate = validate
-        self.df_test = test
-        print("# testing rows: {}".format(len(self.df_test)))
+        from dataset import load_dataset, write_corpus
+        # the DuckDB wrangling lives in dataset.py, so that all the flows share it: the prepared
+        # table is cached, keyed by the Lance dataset version, IS_DEV and the queries
+        splits, self.vocabulary, self.dataset_profile = load_dataset(
+            is_dev=self.IS_DEV == '1',
+            cache_dir=self.DATASET_CACHE,
+            profiling=self.PROFILING)
+        # descriptive stats (distinct users, tracks, ...) go to a card, instead of the logs
+        if self.dataset_profile:
+            current.card.append(Markdown("## Dataset profile ({} counts)".format(self.dataset_profile.mode)))
+            current.card.append(Table(self.dataset_profile.to_rows(), headers=['stat', 'value']))
+        print("# rows: {}".format(sum(_.num_rows for _ in splits.values())))
+        print(splits['train'].slice(0, 1).to_pylist())
+        # playlists are assigned to training, validation and test set inside DuckDB, from a hash
+        # of the playlist id, and each split comes back as an Arrow table (no pandas copies)
+        # with tracks as int ids: self.vocabulary maps them back to 'artist|||track'
+        self.train_dataset = splits['train']
+        self.validation_dataset = splits['validate']
+        self.test_dataset = splits['test']
+        print("# testing rows: {}".format(self.test_dataset.num_rows))
+        # write the training playlists once, as a plain text corpus: gensim trains on the file
+        # in corpus_file mode (see training.py), so generate_embeddings never loads train_dataset
+        self.corpus_path = write_corpus(
+            self.train_dataset['track_sequence'],
+            os.path.join(self.EMBEDDING_STORE, current.flow_name, current.run_id, 'train_corpus.txt'))
+        # the next incremental run only trains on the playlists that are not in this list
+        self.train_playlists = self.train_dataset['playlist_id']
+        self.previous_run = None
+        if self.INCREMENTAL == '1':
+            import pyarrow.compute as pc
+            # the latest successful run of the same kind with a model to start from: a dev run is
+            # trained and validated on a sample, so neither its model nor its reference model are
+            # comparable with those of a full run (and vice versa)
+            previous = next((
+                run for run in Flow(current.flow_name)
+                if run.successful and run.data.IS_DEV == self.IS_DEV and 'reference_run' in run.data
+            ), None)
+            if previous is not None:
+                self.previous_run = previous.pathspec
+                is_new = pc.invert(pc.is_in(  # pylint: disable=no-member
+                    self.train_dataset['playlist_id'],
+                    value_set=previous.data.train_playlists.combine_chunks()))
+                new_playlists = self.train_dataset.filter(is_new)
+                print("Warm start from {}: {} new playlists out of {}".format(
+                    self.previous_run, new_playlists.num_rows, self.train_dataset.num_rows))
+                self.new_corpus_path = write_corpus(
+                    new_playlists['track_sequence'],
+                    os.path.join(self.EMBEDDING_STORE, current.flow_name, current.run_id, 'new_corpus.txt'))
+            else:
+                print("No previous {} run with a checkpoint to warm-start from: training from scratch".format(
+                    'dev' if self.IS_DEV == '1' else 'full'))
         
         self.hyper_string = json.dumps({ 
             'min_count': 3, 
@@ -107,34 +176,57 @@ class RecModelTrainingFlow(FlowSpec):
         self.next(self.generate_embeddings)
 
     #highlight-next-line
-    def predict_next_track(self, vector_space, input_sequence, k):
-        """        
-        Given an embedding space, predict best next song with KNN.
-        Initially, we just take the LAST item in the input playlist as the query item for KNN
-        and retrieve the top K nearest vectors (you could think of taking the smoothed average embedding
-        of the input list, for example, as a refinement).
-
-        If the query item is not in the vector space, we make a random bet. We could refine this by taking
-        for example the vector of the artist (average of all songs), or with some other strategy (sampling
-        by popularity). 
-
-        For more options on how to generate vectors for "cold items" see for example the paper:
-        https://dl.acm.org/doi/10.1145/3383313.3411477
+    def evaluate_model(self, dataset, vector_space, k, fallback=None, n_workers=1):
         """
-        query_item = input_sequence[-1]
-        if query_item not in vector_space:
-            query_item = choice(list(vector_space.index_to_key))
-        
-        return [_[0] for _ in vector_space.most_similar(query_item, topn=k)]
+        Hit Rate, MRR and NDCG on the dataset, at K and at each of the eval_cutoffs, computed in batch:
+        all the query vectors are scored against the vocabulary with matrix multiplications instead of
+        one most_similar call per row, once at the largest cutoff, and every metric is derived from the
+        rank of the target track. Query tracks without a vector are answered by the cold-start fallback
+        (see fallback.py), if given. With n_workers > 1, the queries are sharded across processes
+        (see evaluation.py).
+        """
+        from evaluation import evaluate, parse_cutoffs
+        return evaluate(
+            dataset, vector_space, parse_cutoffs(k, self.EVAL_CUTOFFS), self.RETRIEVAL_INDEX, fallback,
+            self.QUERY_POOLING, int(self.SESSION_LENGTH), n_workers, self.EXCLUDE_SEEN == '1',
+            int(self.RETRIEVAL_RERANK))
 
-    #highlight-next-line
-    def evaluate_model(self, _df, vector_space, k):
-        lambda_predict = lambda row: self.predict_next_track(vector_space, row['track_test_x'], k)
-        _df['predictions'] = _df.apply(lambda_predict, axis=1)
-        lambda_hit = lambda row: 1 if row['track_test_y'] in row['predictions'] else 0
-        _df['hit'] = _df.apply(lambda_hit, axis=1)
-        hit_rate = _df['hit'].sum() / len(_df)
-        return hit_rate
+    def warm_start(self, workers):
+        """
+        Load the model of the previous run, translate its vocabulary to the track ids of this run
+        and train it on the new playlists only.
+        """
+        from gensim.models.word2vec import Word2Vec
+        from training import remap_vocabulary, update_word2vec
+        previous = Run(self.previous_run)
+        track2vec_model = remap_vocabulary(
+            Word2Vec.load(previous.data.checkpoint_path), previous.data.vocabulary, self.vocabulary)
+        if os.path.getsize(self.new_corpus_path) == 0:
+            print("No new playlists since {}, keeping its model".format(self.previous_run))
+            return track2vec_model, []
+
+        return update_word2vec(track2vec_model, self.new_corpus_path, workers)
+
+    def score_reference(self):
+        """
+        Hit Rate@K of the model of the last full retrain on the validation set of this run: splits
+        and vocabulary change from one run to the next, so the metric it had on its own validation
+        set is not comparable with the one of today's incremental model.
+        """
+        from gensim.models.word2vec import Word2Vec
+        from fallback import build_fallback
+        from training import drop_stale_tracks, remap_vocabulary
+        reference = Run(self.reference_run)
+        reference_model = remap_vocabulary(
+            Word2Vec.load(reference.data.checkpoint_path), reference.data.vocabulary, self.vocabulary)
+        vector_space = drop_stale_tracks(reference_model.wv)
+        metrics = self.evaluate_model(
+            self.validation_dataset,
+            vector_space,
+            k=int(self.KNN_K),
+            fallback=build_fallback(vector_space, self.vocabulary))
+
+        return metrics['hit_rate@{}'.format(self.KNN_K)]
 
     #highlight-start
     @step
@@ -143,26 +235,84 @@ class RecModelTrainingFlow(FlowSpec):
         """
         Generate vector representations for songs, based on the Prod2Vec idea.
 
+        In incremental mode, we warm-start from the previous model instead, and only fall back to
+        training from scratch if the warm model does not pass the guard on the validation set.
+
         For an overview of the algorithm and the evaluation, see for example:
         https://arxiv.org/abs/2007.14906
         """
-        from gensim.models.word2vec import Word2Vec
+        from embedding_store import save_keyed_vectors
+        from fallback import build_fallback, save_fallback
+        from dataset import track_names
+        from training import branch_workers, drop_stale_tracks, train_word2vec
         self.hypers = json.loads(self.hyper_string)
-        track2vec_model = Word2Vec(self.df_train['track_sequence'], **self.hypers)
-        print("Training with hypers {} is completed!".format(self.hyper_string))
-        print("Vector space size: {}".format(len(track2vec_model.wv.index_to_key)))
-        test_track = choice(list(track2vec_model.wv.index_to_key))
-        print("Example track: '{}'".format(test_track))
-        test_vector = track2vec_model.wv[test_track]
-        print("Test vector for '{}': {}".format(test_track, test_vector[:5]))
-        test_sims = track2vec_model.wv.most_similar(test_track, topn=3)
-        print("Similar songs to '{}': {}".format(test_track, test_sims))
-        self.validation_metric = self.evaluate_model(
-            self.df_validate,
-            track2vec_model.wv,
-            k=int(self.KNN_K))
+        workers = branch_workers()
+        self.training_mode = 'full'
+        if self.previous_run:
+            track2vec_model, self.epoch_stats = self.warm_start(workers)
+            vector_space = drop_stale_tracks(track2vec_model.wv)
+            self.validation_metrics = self.evaluate_model(
+                self.validation_dataset,
+                vector_space,
+                k=int(self.KNN_K),
+                fallback=build_fallback(vector_space, self.vocabulary))
+            self.validation_metric = self.validation_metrics['hit_rate@{}'.format(self.KNN_K)]
+            # guard: the warm model should not be (much) worse than the last full retrain, scored
+            # on the same rows, otherwise we pay for a full retrain today, instead of drifting day
+            # after day
+            self.reference_run = Run(self.previous_run).data.reference_run
+            self.reference_metric = self.score_reference()
+            print("Hit Rate@{}: {} (incremental) vs {} (last full retrain, {})".format(
+                self.KNN_K, self.validation_metric, self.reference_metric, self.reference_run))
+            if self.validation_metric >= self.reference_metric * (1 - float(self.GUARD_TOLERANCE)):
+                self.training_mode = 'incremental'
+            else:
+                print("The incremental model did not pass the guard: training from scratch")
+        if self.training_mode == 'full':
+            track2vec_model, self.epoch_stats = train_word2vec(self.corpus_path, self.hypers, workers)
+        print("Training ({}) with hypers {} on {} workers is completed!".format(
+            self.training_mode, self.hyper_string, workers))
+        if self.epoch_stats:
+            print("Mean throughput: {:.0f} words/s".format(
+                sum(_['words_per_second'] for _ in self.epoch_stats) / len(self.epoch_stats)))
+        # tracks of previous runs that are not in the current vocabulary are left out
+        vector_space = drop_stale_tracks(track2vec_model.wv)
+        print("Vector space size: {}".format(len(vector_space.index_to_key)))
+        test_track = choice(list(vector_space.index_to_key))
+        test_name = track_names(self.vocabulary, [test_track])[0]
+        print("Example track: '{}'".format(test_name))
+        test_vector = vector_space[test_track]
+        print("Test vector for '{}': {}".format(test_name, test_vector[:5]))
+        test_sims = vector_space.most_similar(test_track, topn=3)
+        test_sims = list(zip(track_names(self.vocabulary, [_[0] for _ in test_sims]), [_[1] for _ in test_sims]))
+        print("Similar songs to '{}': {}".format(test_name, test_sims))
+        # cold-start tables (artist centroids, popular tracks) for the query tracks without a vector
+        fallback = build_fallback(vector_space, self.vocabulary)
+        if self.training_mode == 'full':
+            self.validation_metrics = self.evaluate_model(
+                self.validation_dataset,
+                vector_space,
+                k=int(self.KNN_K),
+                fallback=fallback)
+            self.validation_metric = self.validation_metrics['hit_rate@{}'.format(self.KNN_K)]
+            # this model is the baseline the next incremental runs are guarded against
+            self.reference_run = '{}/{}'.format(current.flow_name, current.run_id)
+            self.reference_metric = self.validation_metric
         print("Hit Rate@{} is: {}".format(self.KNN_K, self.validation_metric))
-        self.track_vectors = track2vec_model.wv
+        # finally, version the embeddings: instead of pickling the KeyedVectors, we write them
+        # to a memory-mapped store (see embedding_store.py) and only version its path
+        self.track_vectors_path = save_keyed_vectors(
+            os.path.join(self.EMBEDDING_STORE, current.flow_name, current.run_id, current.task_id),
+            vector_space,
+            names=track_names(self.vocabulary, vector_space.index_to_key),
+            hypers=self.hypers)
+        save_fallback(self.track_vectors_path, fallback)
+        # and the full model, which the next incremental run starts from
+        checkpoint_dir = os.path.join(
+            self.EMBEDDING_STORE, current.flow_name, current.run_id, 'checkpoints', current.task_id)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.checkpoint_path = os.path.abspath(os.path.join(checkpoint_dir, 'word2vec.model'))
+        track2vec_model.save(self.checkpoint_path)
         self.next(self.model_testing)
 
     #highlight-start
@@ -177,11 +327,20 @@ class RecModelTrainingFlow(FlowSpec):
         evaluating recommender systems is a very complex task, and better metrics, through good abstractions, 
         are available, i.e. https://reclist.io/.
         """
-        self.test_metric = self.evaluate_model(
-            self.df_test,
-            self.track_vectors,
-            k=int(self.KNN_K))
+        from embedding_store import load_embedding_store
+        from fallback import load_fallback
+        from training import cpu_allocation
+        # with 0, one worker per CPU of the step (e.g. @resources), not per core of the host
+        n_workers = int(self.EVAL_WORKERS) or cpu_allocation()
+        self.test_metrics = self.evaluate_model(
+            self.test_dataset,
+            load_embedding_store(self.track_vectors_path),
+            k=int(self.KNN_K),
+            fallback=load_fallback(self.track_vectors_path),
+            n_workers=n_workers)
+        self.test_metric = self.test_metrics['hit_rate@{}'.format(self.KNN_K)]
         print("Hit Rate@{} on the test set is: {}".format(self.KNN_K, self.test_metric))
+        print("All metrics on the test set: {}".format(self.test_metrics))
         self.next(self.end)
 
     @step
@@ -0,0 +1,151 @@
+"""
+
+An on-disk embedding store for track vectors, to avoid pickling (and then un-pickling and
+copying) gensim KeyedVectors every time a step or a client needs the vector space.
+
+A store is a directory with:
+
+    vectors.npy         contiguous float32 (n_tracks, dim) matrix
+    normed_vectors.npy  the same matrix with L2 normalized rows, ready for cosine KNN
+    ids.arrow           Arrow IPC file with an int 'id' column (the track ids from dataset.py),
+                        row i <-> vectors[i], and optionally a 'name' column ('artist|||track')
+    manifest.json       shape, dtype, file names and any metadata from the flow
+
+Matrices are opened with np.load(mmap_mode='r'), so opening a store is near-instant and
+read-only processes (e.g. several server workers) share the same pages in memory.
+
+EmbeddingStore exposes the bits of the KeyedVectors API we use in the flows (index_to_key,
+key_to_index, vectors, get_normed_vectors, most_similar, store[track], track in store), so it
+can be passed wherever a vector space is expected: keys are int track ids, and names are only
+needed at the edges (e.g. serving).
+
+"""
+
+import json
+import os
+
+import numpy as np
+
+MANIFEST_FILE = 'manifest.json'
+VECTORS_FILE = 'vectors.npy'
+NORMED_VECTORS_FILE = 'normed_vectors.npy'
+IDS_FILE = 'ids.arrow'
+STORE_FORMAT_VERSION = 1
+
+
+def save_embedding_store(path, ids, vectors, names=None, **metadata):
+    """
+    Write ids (and names, if given) and vectors to a new store in path, and return the
+    absolute path of the store.
+    """
+    import pyarrow as pa
+    from retrieval import normalize
+    os.makedirs(path, exist_ok=True)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    assert vectors.ndim == 2 and vectors.shape[0] == len(ids)
+    np.save(os.path.join(path, VECTORS_FILE), vectors)
+    np.save(os.path.join(path, NORMED_VECTORS_FILE), normalize(vectors))
+    columns = {'id': pa.array(np.asarray(ids, dtype=np.int32))}
+    if names is not None:
+        columns['name'] = pa.array(list(names), type=pa.string())
+    table = pa.table(columns)
+    with pa.OSFile(os.path.join(path, IDS_FILE), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    manifest = {
+        'format_version': STORE_FORMAT_VERSION,
+        'count': vectors.shape[0],
+        'dim': vectors.shape[1],
+        'dtype': 'float32',
+        'vectors': VECTORS_FILE,
+        'normed_vectors': NORMED_VECTORS_FILE,
+        'ids': IDS_FILE,
+        'metadata': metadata
+    }
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return os.path.abspath(path)
+
+
+def save_keyed_vectors(path, vector_space, names=None, **metadata):
+    """
+    Convenience wrapper to store a gensim KeyedVectors object, whose keys are track ids as strings.
+    """
+    return save_embedding_store(path, vector_space.index_to_key, vector_space.vectors, names, **metadata)
+
+
+class EmbeddingStore():
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['format_version'] > STORE_FORMAT_VERSION:
+            raise ValueError("Store {} has format version {}, we can read up to {}".format(
+                path, self.manifest['format_version'], STORE_FORMAT_VERSION))
+        self.vectors = np.load(os.path.join(path, self.manifest['vectors']), mmap_mode='r')
+        self._normed_vectors = np.load(os.path.join(path, self.manifest['normed_vectors']), mmap_mode='r')
+        import pyarrow as pa
+        # the id table is memory-mapped too: names are decoded into Python strings lazily,
+        # only if somebody needs them
+        self._ids_table = pa.ipc.open_file(pa.memory_map(os.path.join(path, self.manifest['ids']))).read_all()
+        self.ids = self._ids_table.column('id').to_numpy()
+        self._index_to_key = None
+        self._key_to_index = None
+        self._names = None
+
+    @property
+    def metadata(self):
+        return self.manifest['metadata']
+
+    @property
+    def index_to_key(self):
+        if self._index_to_key is None:
+            self._index_to_key = self.ids.tolist()
+        return self._index_to_key
+
+    @property
+    def names(self):
+        """
+        'artist|||track' for each row, None if the store was saved without names.
+        """
+        if self._names is None and 'name' in self._ids_table.column_names:
+            self._names = self._ids_table.column('name').to_pylist()
+        return self._names
+
+    @property
+    def key_to_index(self):
+        if self._key_to_index is None:
+            self._key_to_index = {key: i for i, key in enumerate(self.index_to_key)}
+        return self._key_to_index
+
+    def name(self, key):
+        return self.names[self.key_to_index[key]]
+
+    def get_normed_vectors(self):
+        return self._normed_vectors
+
+    def most_similar(self, key, topn=10):
+        """
+        Same output as gensim most_similar for a single track: [(track, cosine similarity), ...]
+        """
+        from retrieval import top_k
+        query = self.key_to_index[key]
+        normed_vectors = self.get_normed_vectors()
+        neighbours = top_k(normed_vectors[[query]], normed_vectors, topn, exclude=np.array([query]))[0]
+        scores = normed_vectors[neighbours] @ normed_vectors[query]
+        return [(self.index_to_key[i], float(score)) for i, score in zip(neighbours, scores)]
+
+    def __len__(self):
+        return self.manifest['count']
+
+    def __contains__(self, key):
+        return key in self.key_to_index
+
+    def __getitem__(self, key):
+        return self.vectors[self.key_to_index[key]]
+
+
+def load_embedding_store(path):
+    return EmbeddingStore(path)
@@ -0,0 +1,351 @@
+"""
+
+Batched evaluation of a track vector space on the held-out playlists.
+
+For every playlist we use the LAST track of track_test_x as the query, retrieve the top K
+neighbours for all the playlists at once (see retrieval.py), and record the rank of track_test_y
+among them (-1 when it is not there). Hit Rate@K, the metric we used to compute row by row with
+DataFrame.apply and gensim most_similar, is then the share of ranks below K, and MRR@K and
+NDCG@K for any list of cutoffs come from the same int array (see ranking_metrics): we retrieve
+once, at the largest K.
+
+Queries can also pool the vectors of the last N tracks of track_test_x (mean or recency-weighted):
+the sessions are padded into one int array, so pooling is a NumPy reduction over all playlists.
+With exclude_seen, the tracks already in track_test_x are masked before top K selection, straight
+from the offsets of the Arrow list column (see seen_exclusions).
+
+For large test sets, rank_targets can also shard the queries across a pool of processes, which all
+search the same normalized matrix in shared memory (see sharded_ranks).
+
+"""
+
+import numpy as np
+
+from retrieval import Exclusions, build_index, pool
+
+
+def vocabulary_ids(vector_space):
+    """
+    Track ids (see dataset.py) of the rows of the vector space, as an int array: an embedding store
+    has them already, gensim keys are the same ids as string tokens.
+    """
+    ids = getattr(vector_space, 'ids', None)
+    if ids is None:
+        ids = np.asarray(vector_space.index_to_key, dtype=np.int64)
+    return ids
+
+
+def lookup(vector_space, track_ids):
+    """
+    Map track ids (any shape) to their row in the vector space, -1 for unknown tracks or padding
+    (negative ids): since ids are dense ints, this is a single fancy indexing over a lookup array,
+    no Python dictionary involved.
+    """
+    ids = vocabulary_ids(vector_space)
+    track_ids = np.asarray(track_ids, dtype=np.int64)
+    size = max(ids.max(initial=-1), track_ids.max(initial=-1)) + 1
+    rows = np.full(size, -1, dtype=np.int64)
+    rows[ids] = np.arange(ids.shape[0])
+    return np.where(track_ids >= 0, rows[np.maximum(track_ids, 0)], -1)
+
+
+def last_n_items(list_column, n):
+    """
+    Last n elements of each list in an Arrow list column, as a (n_rows, n) int array padded on the
+    left with -1 for shorter lists, without converting the lists to Python: the offsets of the list
+    array point right after the last element of each list.
+    """
+    import pyarrow as pa
+    if isinstance(list_column, pa.ChunkedArray):
+        list_column = list_column.combine_chunks()
+    offsets = list_column.offsets.to_numpy()
+    positions = offsets[1:, None] - n + np.arange(n)
+    valid = positions >= offsets[:-1, None]
+    values = list_column.values.to_numpy()
+    return np.where(valid, values[np.where(valid, positions, 0)], -1)
+
+
+def predict_from_last(index, vector_space, query_items, k, fallback=None):
+    """
+    Top k rows for each query item, from its own vector: query items missing from the vector
+    space are answered by the cold-start fallback (see fallback.py) if given, with a random bet otherwise.
+    """
+    artists = fallback.track_artists(query_items) if fallback is not None else None
+    return search_last(index, lookup(vector_space, query_items), k, fallback, artists)
+
+
+def search_last(index, rows, k, fallback=None, artists=None, seed=None, exclude=None):
+    """
+    predict_from_last on rows of the index (-1 for tracks without a vector) instead of track ids:
+    artists are the artist centroid rows of the tracks (see ColdStartFallback.track_artists), only
+    needed with a fallback. exclude (Exclusions) replaces the default of excluding the query track.
+    """
+    if fallback is not None:
+        return fallback.search(index, rows, artists, k, exclude)
+    # without a fallback, a query item that is not in the vector space gets a random bet
+    missing = rows < 0
+    rows = rows.copy()
+    rows[missing] = np.random.default_rng(seed).integers(0, index.vectors.shape[0], missing.sum())
+
+    return index.search(index.vectors[rows], k, exclude=rows if exclude is None else exclude)
+
+
+def predict_rows(index, rows, k, fallback=None, artists=None, pooling='last', exclude=None):
+    """
+    Return a (n_queries, k) array of rows of the index, best match first (-1 padded): rows is a
+    (n_queries, N) array with the rows of the last N tracks of each query, most recent last and -1
+    for padding or tracks without a vector, and artists the artist centroid rows of the last tracks
+    (only needed with a fallback). Sessions without any vector are answered from their last track.
+
+    By default only the last track of each query is excluded from its predictions: exclude
+    (Exclusions, e.g. from seen_exclusions) replaces it with a set of rows per query.
+    """
+    results = np.full((rows.shape[0], k), -1, dtype=np.int64)
+    pooled = np.zeros(rows.shape[0], dtype=bool) if pooling == 'last' else (rows >= 0).any(axis=1)
+    if pooled.any():
+        # the last track of the session is excluded, as the query track is with 'last'
+        _rows = rows[pooled]
+        _exclude = _rows[:, -1] if exclude is None else exclude.take(np.flatnonzero(pooled))
+        predictions = index.search(pool(index.vectors, _rows, pooling), k, exclude=_exclude)
+        results[pooled, :predictions.shape[1]] = predictions
+    if not pooled.all():
+        predictions = search_last(
+            index, rows[~pooled, -1], k, fallback, None if artists is None else artists[~pooled],
+            exclude=None if exclude is None else exclude.take(np.flatnonzero(~pooled)))
+        results[~pooled, :predictions.shape[1]] = predictions
+
+    return results
+
+
+def predict_next_tracks(vector_space, sessions, k, index_type='brute_force', fallback=None, pooling='last',
+                        rerank=None):
+    """
+    Predict the next tracks of each query with KNN: return a (n_queries, k) array of
+    indices in the vector space, best match first (-1 if an approximate index
+    could not find k candidates).
+
+    sessions are the query items (one track id per query) or a (n_queries, N) array with the last
+    N tracks of each query, most recent last and padded with -1 (see last_n_items): with 'mean' or
+    'recency' pooling, the query vector pools the vectors of those tracks (see retrieval.py).
+    Sessions without any track in the vector space are answered from their last track. rerank is
+    the re-ranking factor of the quantized indexes (see retrieval.build_index).
+    """
+    index = build_index(index_type, vector_space.get_normed_vectors(), normalized=True, rerank=rerank)
+    sessions = np.asarray(sessions, dtype=np.int64).reshape(len(sessions), -1)
+    artists = fallback.track_artists(sessions[:, -1]) if fallback is not None else None
+
+    return predict_rows(index, lookup(vector_space, sessions), k, fallback, artists, pooling)
+
+
+def seen_exclusions(vector_space, list_column):
+    """
+    Exclusions with the rows of all the tracks in each list of an Arrow list column (e.g. the
+    track_test_x of each playlist), straight from the offsets and values of the list array.
+    """
+    import pyarrow as pa
+    if isinstance(list_column, pa.ChunkedArray):
+        list_column = list_column.combine_chunks()
+    offsets = list_column.offsets.to_numpy().astype(np.int64)
+    values = list_column.values.to_numpy()[offsets[0]:offsets[-1]]
+
+    return Exclusions(lookup(vector_space, values), offsets - offsets[0])
+
+
+def target_ranks(predictions, targets):
+    """
+    Position (0 for the best match) of the target row of each query among its predictions, -1 when
+    the target is not there.
+    """
+    # a target outside the vocabulary can never be a hit
+    found = (predictions == targets[:, None]) & (targets[:, None] >= 0)
+    return np.where(found.any(axis=1), found.argmax(axis=1), -1)
+
+
+def parse_cutoffs(k, eval_cutoffs):
+    """
+    Cutoffs for evaluate: k (e.g. knn_k), then the comma separated cutoffs in eval_cutoffs (e.g.
+    '1,10'). Raise a ValueError unless they are all integers >= 1.
+    """
+    values = [str(k)] + [_.strip() for _ in str(eval_cutoffs).split(',') if _.strip()]
+    try:
+        cutoffs = [int(_) for _ in values]
+    except ValueError:
+        raise ValueError("Cutoffs must be integers, got: {}".format(', '.join(values)))
+    _check_cutoffs(cutoffs)
+
+    return cutoffs
+
+
+def _check_cutoffs(cutoffs):
+    invalid = [_ for _ in cutoffs if _ < 1]
+    if not cutoffs or invalid:
+        raise ValueError("Cutoffs must be integers >= 1, got: {}".format(cutoffs))
+
+
+def ranking_metrics(ranks, cutoffs):
+    """
+    HR@k, MRR@k and NDCG@k for each cutoff k, from the ranks of the targets (see target_ranks) of
+    a retrieval at K >= max(cutoffs). With a single relevant track per query the ideal DCG is 1,
+    so the metrics are the mean over queries of [rank < k], 1 / (rank + 1) and 1 / log2(rank + 2)
+    (0 for misses): we count the queries per rank once, and read every cutoff off cumulative sums.
+    """
+    _check_cutoffs(cutoffs)
+    ranks = np.asarray(ranks)
+    n_queries = max(1, ranks.shape[0])
+    max_k = max(cutoffs)
+    counts = np.bincount(ranks[(ranks >= 0) & (ranks < max_k)], minlength=max_k) / n_queries
+    positions = np.arange(max_k)
+    curves = {
+        'hit_rate': np.cumsum(counts),
+        'mrr': np.cumsum(counts / (positions + 1)),
+        'ndcg': np.cumsum(counts / np.log2(positions + 2))
+    }
+
+    return {'{}@{}'.format(name, k): float(curve[k - 1]) for k in sorted(set(cutoffs)) for name, curve in curves.items()}
+
+
+# state of a worker process of sharded_ranks, set once by _init_worker
+_WORKER = {}
+
+
+def _share(array):
+    """
+    Copy array into a new shared memory block, and return the block and what a worker needs to
+    attach to it.
+    """
+    from multiprocessing import shared_memory
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _attach(spec):
+    from multiprocessing import shared_memory
+    name, shape, dtype = spec
+    # spawned workers share the resource tracker of the parent, which unlinks the block when done
+    block = shared_memory.SharedMemory(name=name)
+    _WORKER.setdefault('blocks', []).append(block)
+
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _init_worker(index_type, vectors_spec, index_specs, index_params, fallback_spec):
+    from retrieval_artifact import restore_index
+    try:
+        from threadpoolctl import threadpool_limits
+        # one BLAS thread per worker: the processes are the parallelism
+        _WORKER['limits'] = threadpool_limits(1)
+    except ImportError:
+        pass
+    # the index the parent built, on top of the shared arrays: no training, no copy
+    _WORKER['index'] = restore_index(
+        index_type, _attach(vectors_spec), {name: _attach(spec) for name, spec in index_specs.items()}, index_params)
+    _WORKER['fallback'] = None
+    if fallback_spec is not None:
+        from fallback import ColdStartFallback
+        centroids_spec, popular = fallback_spec
+        # search only needs the centroids and the popular tracks, artists are looked up by the parent
+        _WORKER['fallback'] = ColdStartFallback([], np.empty(0, dtype=np.int64), _attach(centroids_spec), popular)
+
+
+def _shard_ranks(shard):
+    rows, artists, targets, k, pooling, exclude = shard
+    predictions = predict_rows(_WORKER['index'], rows, k, _WORKER['fallback'], artists, pooling, exclude)
+
+    return target_ranks(predictions, targets)
+
+
+def sharded_ranks(index_type, normed_vectors, rows, targets, k, fallback=None, artists=None, pooling='last',
+                 exclude=None, n_workers=2, shards_per_worker=4, rerank=None):
+    """
+    target_ranks over a pool of n_workers processes: the index is built once, here, and the normalized
+    matrix, the arrays of the index (e.g. IVF lists, quantized codes) and the artist centroids of the
+    fallback are copied once into shared memory. Each worker restores the index on top of them
+    (see restore_index in retrieval_artifact.py), without training or copying anything, so only
+    the small per-shard int arrays are pickled. Queries are split in
+    n_workers * shards_per_worker shards, to even out the load, and the ranks are concatenated back
+    in query order.
+    """
+    import multiprocessing
+    from retrieval_artifact import index_state
+    blocks = []
+    try:
+        block, vectors_spec = _share(np.asarray(normed_vectors, dtype=np.float32))
+        blocks.append(block)
+        index_arrays, index_params = index_state(
+            build_index(index_type, normed_vectors, normalized=True, rerank=rerank))
+        index_specs = {}
+        for name, array in index_arrays.items():
+            block, index_specs[name] = _share(array)
+            blocks.append(block)
+        fallback_spec = None
+        if fallback is not None:
+            block, centroids_spec = _share(np.asarray(fallback.artist_centroids, dtype=np.float32))
+            blocks.append(block)
+            fallback_spec = (centroids_spec, np.asarray(fallback.popular))
+        shards = [_ for _ in np.array_split(np.arange(rows.shape[0]), n_workers * shards_per_worker) if len(_)]
+        # spawn, not fork: the parent may be running BLAS or DuckDB threads
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(
+                n_workers, _init_worker, (index_type, vectors_spec, index_specs, index_params, fallback_spec)) as workers:
+            ranks = workers.map(_shard_ranks, [
+                (rows[_], None if artists is None else artists[_], targets[_], k, pooling,
+                 None if exclude is None else exclude.take(_))
+                for _ in shards])
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return np.concatenate(ranks) if ranks else np.empty(0, dtype=np.int64)
+
+
+def rank_targets(dataset, vector_space, k, index_type='brute_force', fallback=None, pooling='last', session_length=5,
+                 n_workers=1, exclude_seen=False, rerank=None):
+    """
+    Rank of track_test_y among the top k predictions of the vector space (-1 when it is not there),
+    for each row of the dataset, an Arrow table with track_test_x / track_test_y columns: queries pool
+    the last session_length tracks of track_test_x, unless pooling is 'last'. With n_workers > 1,
+    queries are sharded across processes (see sharded_ranks).
+
+    With exclude_seen, none of the tracks of track_test_x can be predicted, instead of only the
+    query track: the K slots all go to tracks the playlist does not have yet. rerank is the
+    re-ranking factor of the quantized indexes (see retrieval.build_index).
+    """
+    sessions = last_n_items(dataset['track_test_x'], 1 if pooling == 'last' else session_length)
+    rows = lookup(vector_space, sessions)
+    artists = fallback.track_artists(sessions[:, -1]) if fallback is not None else None
+    targets = lookup(vector_space, dataset['track_test_y'].to_numpy())
+    exclude = seen_exclusions(vector_space, dataset['track_test_x']) if exclude_seen else None
+    if n_workers > 1:
+        return sharded_ranks(
+            index_type, vector_space.get_normed_vectors(), rows, targets, k, fallback, artists, pooling, exclude,
+            n_workers, rerank=rerank)
+    index = build_index(index_type, vector_space.get_normed_vectors(), normalized=True, rerank=rerank)
+
+    return target_ranks(predict_rows(index, rows, k, fallback, artists, pooling, exclude), targets)
+
+
+def evaluate(dataset, vector_space, cutoffs, index_type='brute_force', fallback=None, pooling='last', session_length=5,
+             n_workers=1, exclude_seen=False, rerank=None):
+    """
+    HR@k, MRR@k and NDCG@k of the vector space over the rows of the dataset for each k in cutoffs,
+    from a single retrieval at the largest one (see rank_targets for the other arguments).
+    """
+    ranks = rank_targets(
+        dataset, vector_space, max(cutoffs), index_type, fallback, pooling, session_length, n_workers, exclude_seen,
+        rerank)
+
+    return ranking_metrics(ranks, cutoffs)
+
+
+def hit_rate(dataset, vector_space, k, index_type='brute_force', fallback=None, pooling='last', session_length=5,
+             n_workers=1, exclude_seen=False, rerank=None):
+    """
+    Hit Rate@K of the vector space over the rows of the dataset (see rank_targets).
+    """
+    ranks = rank_targets(
+        dataset, vector_space, k, index_type, fallback, pooling, session_length, n_workers, exclude_seen, rerank)
+
+    return float((ranks >= 0).mean()) if ranks.shape[0] else 0.0
@@ -0,0 +1,170 @@
+"""
+
+Cold-start fallback for query tracks that are not in the vector space (e.g. tracks below
+min_count): instead of a random bet, we answer with
+
+    - the neighbours of the artist centroid (the mean of the normalized vectors of the artist's
+      tracks in the vector space), if we know the artist and have vectors for some of their tracks;
+    - the most popular tracks otherwise.
+
+Everything is computed once per model and saved in its embedding store, so a miss costs a
+couple of array lookups (or a dictionary lookup on the artist name, at serving time), never a
+pass over the vocabulary.
+
+For more options on how to generate vectors for "cold items" see for example the paper:
+https://dl.acm.org/doi/10.1145/3383313.3411477
+
+"""
+
+import os
+
+import numpy as np
+
+FALLBACK_DIR = 'fallback'
+CENTROIDS_FILE = 'artist_centroids.npy'
+TRACK_ARTIST_FILE = 'track_artist.npy'
+POPULAR_FILE = 'popular.npy'
+ARTISTS_FILE = 'artists.arrow'
+# the separator dataset.py uses in track names: 'artist|||track'
+ARTIST_SEPARATOR = '|||'
+
+
+class ColdStartFallback():
+    """
+    artists: artist names, row i <-> artist_centroids[i]
+    track_artist: for each track id in the vocabulary, the row of its artist (-1 if no centroid)
+    artist_centroids: (n_artists, dim) float32 matrix with unit-length rows
+    popular: rows of the vector space, most popular track first
+    """
+
+    def __init__(self, artists, track_artist, artist_centroids, popular):
+        self.artists = artists
+        self.track_artist = track_artist
+        self.artist_centroids = artist_centroids
+        self.popular = popular
+        self.artist_to_index = {artist: i for i, artist in enumerate(artists)}
+
+    def track_artists(self, track_ids):
+        """
+        Artist centroid row of each track id, -1 for unknown tracks or artists without a centroid.
+        """
+        track_ids = np.asarray(track_ids, dtype=np.int64)
+        known = (track_ids >= 0) & (track_ids < self.track_artist.shape[0])
+        return np.where(known, self.track_artist[np.where(known, track_ids, 0)], -1)
+
+    def name_artist(self, name):
+        """
+        Artist centroid row for a track name ('artist|||track'), -1 if we have no centroid.
+        """
+        return self.artist_to_index.get(name.split(ARTIST_SEPARATOR)[0], -1)
+
+    def popular_tracks(self, k):
+        """
+        The k most popular rows, padded with -1 if the vector space is smaller than k.
+        """
+        result = np.full(k, -1, dtype=np.int64)
+        result[:min(k, self.popular.shape[0])] = self.popular[:k]
+        return result
+
+    def search(self, index, rows, artists, k, exclude=None):
+        """
+        Return a (n_queries, k) array of rows of the vector space, given for each query its row
+        (-1 if the track is missing) and its artist centroid row (-1 if none): known tracks are
+        searched as usual, tracks with a centroid from the centroid, the rest get the most popular.
+
+        exclude are retrieval.Exclusions for the queries (e.g. the tracks already in the playlist),
+        which replace the default of excluding the query track itself: popular tracks are masked the
+        same way, over the whole popular list, so we still return k of them unless it runs out.
+        """
+        from retrieval import as_exclusions
+        exclude = as_exclusions(exclude)
+        if exclude is None:
+            results = np.tile(self.popular_tracks(k), (rows.shape[0], 1))
+        else:
+            # popular tracks are ranked: score them by rank, mask the excluded ones and keep the best k
+            scores = np.tile(-np.arange(self.popular.shape[0], dtype=np.float32), (rows.shape[0], 1))
+            scores[exclude.mask(self.popular)] = -np.inf
+            _k = min(k, self.popular.shape[0])
+            top = np.argsort(-scores, axis=1, kind='stable')[:, :_k]
+            results = np.full((rows.shape[0], k), -1, dtype=np.int64)
+            results[:, :_k] = np.where(np.take_along_axis(scores, top, axis=1) > -np.inf, self.popular[top], -1)
+        searched = np.flatnonzero((rows >= 0) | (artists >= 0))
+        if searched.shape[0] > 0:
+            _rows = rows[searched]
+            queries = np.where(
+                (_rows >= 0)[:, None],
+                index.vectors[np.maximum(_rows, 0)],
+                self.artist_centroids[np.maximum(artists[searched], 0)])
+            # the query track itself is excluded, centroid queries have nothing to exclude
+            neighbours = index.search(queries, k, exclude=_rows if exclude is None else exclude.take(searched))
+            results[searched] = -1
+            results[searched, :neighbours.shape[1]] = neighbours
+
+        return results
+
+
+def build_fallback(vector_space, vocabulary, n_popular=1000):
+    """
+    Compute the fallback tables for a vector space (gensim KeyedVectors or embedding store) from
+    the track vocabulary of dataset.py (track_idx, track_id, artist, occurrences).
+    """
+    import pyarrow.compute as pc
+    from evaluation import vocabulary_ids
+    from retrieval import normalize
+    ids = vocabulary_ids(vector_space)
+    artist_column = pc.dictionary_encode(vocabulary.column('artist').combine_chunks())
+    artists = artist_column.dictionary.to_pylist()
+    # the vocabulary is sorted by track_idx, so positions are ids
+    track_artist = artist_column.indices.fill_null(-1).to_numpy().astype(np.int64)
+    row_artist = track_artist[ids]
+    rows = np.flatnonzero(row_artist >= 0)
+    normed_vectors = vector_space.get_normed_vectors()
+    sums = np.zeros((len(artists), normed_vectors.shape[1]), dtype=np.float32)
+    np.add.at(sums, row_artist[rows], normed_vectors[rows])
+    # only keep the artists with at least one track in the vector space
+    has_centroid = np.bincount(row_artist[rows], minlength=len(artists)) > 0
+    artist_rows = np.where(has_centroid, np.cumsum(has_centroid) - 1, -1)
+    track_artist = np.where(track_artist >= 0, artist_rows[np.maximum(track_artist, 0)], -1)
+    # ids are ranked by popularity (0 is the most popular track), so the smallest ids come first
+    popular = np.argsort(ids, kind='stable')[:n_popular]
+
+    return ColdStartFallback(
+        [artist for artist, keep in zip(artists, has_centroid) if keep],
+        track_artist,
+        normalize(sums[has_centroid]),
+        popular)
+
+
+def save_fallback(path, fallback):
+    """
+    Save the fallback tables in the embedding store at path.
+    """
+    import pyarrow as pa
+    fallback_path = os.path.join(path, FALLBACK_DIR)
+    os.makedirs(fallback_path, exist_ok=True)
+    np.save(os.path.join(fallback_path, CENTROIDS_FILE), fallback.artist_centroids)
+    np.save(os.path.join(fallback_path, TRACK_ARTIST_FILE), fallback.track_artist)
+    np.save(os.path.join(fallback_path, POPULAR_FILE), fallback.popular)
+    table = pa.table({'artist': pa.array(fallback.artists, type=pa.string())})
+    with pa.OSFile(os.path.join(fallback_path, ARTISTS_FILE), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    return path
+
+
+def load_fallback(path):
+    """
+    Load the fallback tables of the embedding store at path, None if the store has none.
+    """
+    import pyarrow as pa
+    fallback_path = os.path.join(path, FALLBACK_DIR)
+    if not os.path.exists(fallback_path):
+        return None
+    artists = pa.ipc.open_file(pa.memory_map(os.path.join(fallback_path, ARTISTS_FILE))).read_all()
+
+    return ColdStartFallback(
+        artists.column('artist').to_pylist(),
+        np.load(os.path.join(fallback_path, TRACK_ARTIST_FILE), mmap_mode='r'),
+        np.load(os.path.join(fallback_path, CENTROIDS_FILE), mmap_mode='r'),
+        np.load(os.path.join(fallback_path, POPULAR_FILE)))
@@ -0,0 +1,71 @@
+"""
+
+The Keras retrieval model of the deploy step, shipped "as is" to a SageMaker endpoint.
+
+build_keras_model only needs the vector space (an EmbeddingStore from embedding_store.py, with the
+'artist|||track' names), not the flow, so the deploy step and the benchmarks (benchmark_pipeline.py,
+benchmark_artifact.py) build exactly the same model. TensorFlow is only imported when the model is
+built.
+
+"""
+
+from random import choice
+
+import numpy as np
+
+
+def build_keras_model(vector_space):
+    """
+    Build a retrieval model using TF recommender abstraction - by packaging the vector space
+    in a Keras object, we get for free the possibility of shipping the artifact "as is" to 
+    a Sagemaker endpoint, and benefit from the PaaS abstraction and hardware acceleration.
+
+    Of course, other deployment options are possible, including for example using a custom script
+    and a custom image with Sagemaker.
+    """
+    print("Building Keras model")
+    import tensorflow as tf
+    import tensorflow_recommenders as tfrs
+    # the endpoint speaks 'artist|||track' names, int track ids only live inside the flow
+    all_ids = vector_space.names
+    # the store is already a (memory-mapped) numpy array
+    song_vectors = np.asarray(vector_space.vectors)
+    # pick one random item to use as test
+    # as we want to make sure our "conversion" to Keras 
+    # still gets us the same values!
+    test_index = choice(range(len(all_ids)))
+    test_id = all_ids[test_index]
+    embedding_dimension = song_vectors[0].shape[0]
+    print("Vector space dims: {}".format(embedding_dimension))
+    # add to the existing matrix of weight a 0.0.0.0... vector for unknown items
+    # float32 like the vectors, so that np.r_ does not upcast the whole matrix to float64
+    unknown_vector = np.zeros((1, embedding_dimension), dtype=np.float32)
+    print(song_vectors.shape, unknown_vector.shape)
+    embedding_matrix = np.r_[unknown_vector, song_vectors]
+    # first item is the unknown token!
+    print(embedding_matrix.shape)
+    assert embedding_matrix[0][0] == 0.0
+    # init embedding layer with our vectors
+    embedding_layer = tf.keras.layers.Embedding(len(all_ids) + 1, embedding_dimension)
+    embedding_layer.build((None, ))
+    embedding_layer.set_weights([embedding_matrix])
+    embedding_layer.trainable = False
+    vector_model = tf.keras.Sequential([
+        tf.keras.layers.StringLookup(vocabulary=all_ids, mask_token=None),
+        embedding_layer
+        ])
+    # testing and debug
+    print("Example track: '{}'".format(test_id))
+    _v = vector_model(np.array([test_id]))
+    print(song_vectors[test_index][:5], _v[0][:5])
+    # test unknonw ID
+    print("Test unknown id:")
+    print(vector_model(np.array(['blahdagkagda']))[0][:5])    
+    # Finally, create a retrieval model
+    song_index = tfrs.layers.factorized_top_k.BruteForce(vector_model)  
+    song_index.index(song_vectors, np.array(all_ids))
+    # Try it
+    _, names = song_index(tf.constant([test_id]))
+    print(f"Recommendations after track '{test_id}': {names[0, :3]}")
+
+    return song_index
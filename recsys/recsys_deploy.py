@@ -1,7 +1,7 @@
 
 # global imports
 from metaflow import FlowSpec, step, S3, Parameter, current, card
-from metaflow.cards import Markdown, Table
+from metaflow.cards import Image, Markdown, Table
 import os
 import json
 import time
@@ -15,12 +15,78 @@ class RecSysSagemakerDeployment(FlowSpec):
         default='1'
     )
 
+    DATASET_CACHE = Parameter(
+        name='dataset_cache',
+        help='Folder caching the prepared dataset across runs (empty string to disable)',
+        default='dataset_cache'
+    )
+
+    PROFILING = Parameter(
+        name='profiling',
+        help='Dataset stats: approx (one HyperLogLog scan), exact (one exact scan) or none',
+        default='approx'
+    )
+
     KNN_K = Parameter(
         name='knn_k',
         help='Number of neighbors we retrieve from the vector space',
         default='100'
     ) 
 
+    RETRIEVAL_INDEX = Parameter(
+        name='retrieval_index',
+        help='Index for KNN retrieval: brute_force (exact), ivf (approximate, faster on large catalogues), int8 or pq (quantized, less memory)',
+        default='brute_force'
+    )
+
+    RETRIEVAL_RERANK = Parameter(
+        name='retrieval_rerank',
+        help='With int8 or pq, re-score the best K * retrieval_rerank candidates with the exact vectors (0 to rank on the codes only)',
+        default='4'
+    )
+
+    QUERY_POOLING = Parameter(
+        name='query_pooling',
+        help='KNN query for a playlist: last (last track), mean or recency (pooled vectors of the last tracks)',
+        default='last'
+    )
+
+    SESSION_LENGTH = Parameter(
+        name='session_length',
+        help='Number of tracks pooled in the query, with mean or recency pooling',
+        default='5'
+    )
+
+    EXCLUDE_SEEN = Parameter(
+        name='exclude_seen',
+        help='1 to never recommend tracks that are already in the playlist, 0 to only exclude the query track',
+        default='0'
+    )
+
+    EVAL_CUTOFFS = Parameter(
+        name='eval_cutoffs',
+        help='Comma separated cutoffs K for Hit Rate@K, MRR@K and NDCG@K, on top of knn_k',
+        default='1,10'
+    )
+
+    EVAL_WORKERS = Parameter(
+        name='eval_workers',
+        help='Processes sharing the test set evaluation in model_testing, 0 for one per allocated CPU',
+        default='1'
+    )
+
+    COOCCURRENCE_WINDOW = Parameter(
+        name='cooccurrence_window',
+        help='Window of the item-item co-occurrence baseline trained next to Word2Vec, 0 to skip it',
+        default='5'
+    )
+
+    EMBEDDING_STORE = Parameter(
+        name='embedding_store',
+        help='Local (or shared) folder where track vectors are stored as memory-mapped embedding stores',
+        default='embedding_stores'
+    )
+
     # highlight-start
     # NOTE: Sagemaker-specific parameters below here
     # If you don't wish to deploy the model, you can leave 'sagemaker_deploy' as 0,
@@ -64,6 +130,7 @@ class RecSysSagemakerDeployment(FlowSpec):
         """
         Start-up: check everything works or fail fast!
         """
+        from evaluation import parse_cutoffs
         from metaflow.metaflow_config import DATASTORE_SYSROOT_S3 
         # debug printing
         print("flow name: %s" % current.flow_name)
@@ -81,103 +148,44 @@ class RecSysSagemakerDeployment(FlowSpec):
             # is configured properly
             assert DATASTORE_SYSROOT_S3 is not None
         # highlight-end
+        # bad eval_cutoffs fail here, not after training
+        parse_cutoffs(self.KNN_K, self.EVAL_CUTOFFS)
         # next up, get the data
         self.next(self.prepare_dataset)
 
+    @card(type='blank', id='datasetCard')
     @step
     def prepare_dataset(self):
         """
-        Get the data in the right shape by reading the parquet dataset
+        Get the data in the right shape by reading the cleaned dataset
         and using duckdb SQL-based wrangling to quickly prepare the datasets for
         training our Recommender System.
         """
-        import duckdb
-        import numpy as np
-        # we start a fast in-memory database
-        con = duckdb.connect(database=':memory:')
-        # read the data from the local dataset file
-        # if you prefer to rely on Metaflow versioning for this input file
-        # uncomment the IncludeFile at the top of the class and modify the
-        # reading line
-        # note we create a new id for the playlist, by concatenating user and playlist name
-        # since songs can have the same name (e.g. Intro), we make them (more?) unique by
-        # concatenating the artist and the track with a special symbol |||
-        con.execute("""
-            CREATE TABLE playlists AS 
-            SELECT *, 
-            CONCAT (user_id, '-', playlist) as playlist_id,
-            CONCAT (artist, '|||', track) as track_id,
-            FROM 'cleaned_spotify_dataset.parquet'
-            ;
-        """)
-        # quick inspection of the first line
-        con.execute("SELECT * FROM playlists LIMIT 1;")
-        print(con.fetchone())
-        # let's leverage duckdb super fast SQL interface to get some descriptive stats
-        # about our dataset. Some people may prefer to do as part of EDA in a notebook,
-        # but we include it here since i) it's super fast, ii) it shows a viable alternative
-        # to clunky Pandas code for simple aggregations
-        tables = ['row_id', 'user_id', 'track_id', 'playlist_id', 'artist']
-        for t in tables:
-            con.execute("SELECT COUNT(DISTINCT({})) FROM playlists;".format(t))
-            print("# of {}".format(t), con.fetchone()[0])
-        # when we are happy, we are getting data in the shape we need for Prod2Vec type 
-        # of representation - each row is keyed by playlist id, and with two arrays
-        # for the sequence of artists in the playlist and the sequence of songs
-        # 9cc0cfd4d7d7885102480dd99e7a90d6-HardRock | [ artist_1, ... artist_n ] | [ song_1, ... song_n ] 
-        # We use the original row_id as index for the playlist ordering
-        # NOTE: we create an intermediate table so that we can optionally subsample
-        # at the end and get a smaller dataset
-        sampling_cmd = ''
-        if self.IS_DEV == '1':
-            # data will be sampled down if this is a dev run
-            # this allows for very quick iteration and small data
-            # snapshots as we still work our way towards an end to end flow
-            print("Subsampling data, since this is DEV")
-            sampling_cmd = ' USING SAMPLE 10 PERCENT (bernoulli)'
-        # build the dataset query
-        # NOTE: we also sequenci-fy the artist as a list in case 
-        # we want to build artist embeddings ;-)
-        # track_test_x is the list of songs in a playlist except the LAST one
-        # track_test_y is the LAST song - we will use these columns for 
-        # validation and testing of our recommender, when asking the model to
-        # "continue" a playlist it has never seen before.
-        dataset_query = """
-            SELECT * FROM
-            (   
-                SELECT 
-                    playlist_id,
-                    LIST(artist ORDER BY row_id ASC) as artist_sequence,
-                    LIST(track_id ORDER BY row_id ASC) as track_sequence,
-                    array_pop_back(LIST(track_id ORDER BY row_id ASC)) as track_test_x,
-                    LIST(track_id ORDER BY row_id ASC)[-1] as track_test_y
-                FROM 
-                    playlists
-                GROUP BY playlist_id 
-                HAVING len(track_sequence) > 2
-            ) 
-            {}
-            ;
-            """.format(sampling_cmd)
-        # dump the table to a df and print out stats
-        con.execute(dataset_query)
-        df = con.fetch_df()
-        print("# rows: {}".format(len(df)))
-        # debug: print the first row
-        print(df.iloc[0].tolist())
-        # close out the db connection
-        con.close()
-        # assign session to training, validation and test set
-        train, validate, test = np.split(
-            df.sample(frac=1, random_state=42), 
-            [int(.7 * len(df)), int(.9 * len(df))])
-        # finally, version the data in Metaflow automatically
-        # since pandas can be pickled by default
-        self.df_dataset = df
-        self.df_train = train
-        self.df_validate = validate
-        self.df_test = test
-        print("# testing rows: {}".format(len(self.df_test)))
+        from dataset import load_dataset, write_corpus
+        # the DuckDB wrangling lives in dataset.py, so that all the flows share it: the prepared
+        # table is cached, keyed by the Lance dataset version, IS_DEV and the queries
+        splits, self.vocabulary, self.dataset_profile = load_dataset(
+            is_dev=self.IS_DEV == '1',
+            cache_dir=self.DATASET_CACHE,
+            profiling=self.PROFILING)
+        # descriptive stats (distinct users, tracks, ...) go to a card, instead of the logs
+        if self.dataset_profile:
+            current.card.append(Markdown("## Dataset profile ({} counts)".format(self.dataset_profile.mode)))
+            current.card.append(Table(self.dataset_profile.to_rows(), headers=['stat', 'value']))
+        print("# rows: {}".format(sum(_.num_rows for _ in splits.values())))
+        print(splits['train'].slice(0, 1).to_pylist())
+        # playlists are assigned to training, validation and test set inside DuckDB, from a hash
+        # of the playlist id, and each split comes back as an Arrow table (no pandas copies)
+        # with tracks as int ids: self.vocabulary maps them back to 'artist|||track'
+        self.train_dataset = splits['train']
+        self.validation_dataset = splits['validate']
+        self.test_dataset = splits['test']
+        print("# testing rows: {}".format(self.test_dataset.num_rows))
+        # write the training playlists once, as a plain text corpus: gensim trains on the file
+        # in corpus_file mode (see training.py), so each branch of the foreach never loads train_dataset
+        self.corpus_path = write_corpus(
+            self.train_dataset['track_sequence'],
+            os.path.join(self.EMBEDDING_STORE, current.flow_name, current.run_id, 'train_corpus.txt'))
         # next up, generate vectors for songs from existing playlists
         # sets of hypers - we serialize them to a string and pass them to the foreach below
         # params inspired by https://arxiv.org/pdf/2007.14906.pdf
@@ -186,75 +194,122 @@ class RecSysSagemakerDeployment(FlowSpec):
             { 'min_count': 5, 'epochs': 30, 'vector_size': 48, 'window': 10, 'ns_exponent': 0.75 },
             { 'min_count': 10, 'epochs': 30, 'vector_size': 48, 'window': 10, 'ns_exponent': 0.75 }
         ]]
+        # plus a baseline engine in its own branch, compared with Word2Vec in join_runs: next tracks
+        # from item-item co-occurrence counts (see cooccurrence.py), no training but a single pass
+        if int(self.COOCCURRENCE_WINDOW) > 0:
+            self.hypers_sets.append(json.dumps({ 'engine': 'cooccurrence', 'window': int(self.COOCCURRENCE_WINDOW) }))
         # we train K models in parallel, depending how many configurations of hypers 
         # we set - we generate K set of vectors, and evaluate them on the validation
         # set to pick the best combination of parameters!
         self.next(self.generate_embeddings, foreach='hypers_sets')
 
-    def predict_next_track(self, vector_space, input_sequence, k):
-        """        
-        Given an embedding space, predict best next song with KNN.
-        Initially, we just take the LAST item in the input playlist as the query item for KNN
-        and retrieve the top K nearest vectors (you could think of taking the smoothed average embedding
-        of the input list, for example, as a refinement).
-
-        If the query item is not in the vector space, we make a random bet. We could refine this by taking
-        for example the vector of the artist (average of all songs), or with some other strategy (sampling
-        by popularity). 
-
-        For more options on how to generate vectors for "cold items" see for example the paper:
-        https://dl.acm.org/doi/10.1145/3383313.3411477
+    def evaluate_model(self, dataset, vector_space, k, fallback=None, n_workers=1):
         """
-        query_item = input_sequence[-1]
-        if query_item not in vector_space:
-            # pick a random item instead
-            query_item = choice(list(vector_space.index_to_key))
-        
-        return [_[0] for _ in vector_space.most_similar(query_item, topn=k)]
-
-    def evaluate_model(self, _df, vector_space, k):
-        lambda_predict = lambda row: self.predict_next_track(vector_space, row['track_test_x'], k)
-        _df['predictions'] = _df.apply(lambda_predict, axis=1)
-        lambda_hit = lambda row: 1 if row['track_test_y'] in row['predictions'] else 0
-        _df['hit'] = _df.apply(lambda_hit, axis=1)
-        # debug: print the first row where we got a hit
-        # this is a pretty long print, so uncomment only when debugging
-        # print(_df[_df['hit'] == 1].iloc[0].tolist())
-        # hit rate is # of hits / total predictions
-        hit_rate = _df['hit'].sum() / len(_df)
-        return hit_rate
+        Hit Rate, MRR and NDCG on the dataset, at K and at each of the eval_cutoffs, computed in batch:
+        all the query vectors are scored against the vocabulary with matrix multiplications instead of
+        one most_similar call per row, once at the largest cutoff, and every metric is derived from the
+        rank of the target track. Query tracks without a vector are answered by the cold-start fallback
+        (see fallback.py), if given. With n_workers > 1, the queries are sharded across processes
+        (see evaluation.py).
+        """
+        from evaluation import evaluate, parse_cutoffs
+        return evaluate(
+            dataset, vector_space, parse_cutoffs(k, self.EVAL_CUTOFFS), self.RETRIEVAL_INDEX, fallback,
+            self.QUERY_POOLING, int(self.SESSION_LENGTH), n_workers, self.EXCLUDE_SEEN == '1',
+            int(self.RETRIEVAL_RERANK))
 
-    @step
-    def generate_embeddings(self):
+    def train_word2vec_engine(self):
         """
         Generate vector representations for songs, based on the Prod2Vec idea.
 
         For an overview of the algorithm and the evaluation, see for example:
         https://arxiv.org/abs/2007.14906
         """
-        from gensim.models.word2vec import Word2Vec
-        # this is the CURRENT hyper param JSON in the fan-out
-        # each copy of this step in the parallelization will have its own value
-        self.hyper_string = self.input
-        self.hypers = json.loads(self.hyper_string)
-        track2vec_model = Word2Vec(self.df_train['track_sequence'], **self.hypers)
-        print("Training with hypers {} is completed!".format(self.hyper_string))
+        from embedding_store import save_keyed_vectors
+        from fallback import build_fallback, save_fallback
+        from dataset import track_names
+        from training import branch_workers, train_word2vec
+        # without a container quota, the branches of the foreach share the local cores
+        workers = branch_workers(len(self.hypers_sets))
+        training_start = time.perf_counter()
+        track2vec_model, self.epoch_stats = train_word2vec(self.corpus_path, self.hypers, workers)
+        self.training_seconds = time.perf_counter() - training_start
+        self.model_mb = track2vec_model.wv.vectors.nbytes / (1 << 20)
+        print("Training with hypers {} on {} workers is completed!".format(self.hyper_string, workers))
+        print("Mean throughput: {:.0f} words/s".format(
+            sum(_['words_per_second'] for _ in self.epoch_stats) / len(self.epoch_stats)))
         print("Vector space size: {}".format(len(track2vec_model.wv.index_to_key)))
         # debug with a random example
         test_track = choice(list(track2vec_model.wv.index_to_key))
-        print("Example track: '{}'".format(test_track))
+        test_name = track_names(self.vocabulary, [test_track])[0]
+        print("Example track: '{}'".format(test_name))
         test_vector = track2vec_model.wv[test_track]
-        print("Test vector for '{}': {}".format(test_track, test_vector[:5]))
+        print("Test vector for '{}': {}".format(test_name, test_vector[:5]))
         test_sims = track2vec_model.wv.most_similar(test_track, topn=3)
-        print("Similar songs to '{}': {}".format(test_track, test_sims))
+        test_sims = list(zip(track_names(self.vocabulary, [_[0] for _ in test_sims]), [_[1] for _ in test_sims]))
+        print("Similar songs to '{}': {}".format(test_name, test_sims))
+        # cold-start tables (artist centroids, popular tracks) for the query tracks without a vector
+        fallback = build_fallback(track2vec_model.wv, self.vocabulary)
         # calculate the validation score as hit rate
-        self.validation_metric = self.evaluate_model(
-            self.df_validate,
+        self.validation_metrics = self.evaluate_model(
+            self.validation_dataset,
             track2vec_model.wv,
-            k=int(self.KNN_K))
+            k=int(self.KNN_K),
+            fallback=fallback)
+        self.validation_metric = self.validation_metrics['hit_rate@{}'.format(self.KNN_K)]
         print("Hit Rate@{} is: {}".format(self.KNN_K, self.validation_metric))
-        # finally, version the embeddings
-        self.track_vectors = track2vec_model.wv
+        # finally, version the embeddings: instead of pickling the KeyedVectors, we write them
+        # to a memory-mapped store (see embedding_store.py) and only version its path
+        self.track_vectors_path = save_keyed_vectors(
+            os.path.join(self.EMBEDDING_STORE, current.flow_name, current.run_id, current.task_id),
+            track2vec_model.wv,
+            names=track_names(self.vocabulary, track2vec_model.wv.index_to_key),
+            hypers=self.hypers)
+        save_fallback(self.track_vectors_path, fallback)
+
+    def train_cooccurrence_engine(self):
+        """
+        Count item-item co-occurrences over the training corpus, and evaluate next-track
+        recommendations from the rows of the matrix (see cooccurrence.py).
+        """
+        from cooccurrence import evaluate_cooccurrence, save_cooccurrence, train_cooccurrence
+        from evaluation import parse_cutoffs
+        training_start = time.perf_counter()
+        model = train_cooccurrence(self.corpus_path, self.vocabulary.num_rows, self.hypers)
+        self.training_seconds = time.perf_counter() - training_start
+        self.model_mb = model.nbytes / (1 << 20)
+        print("Co-occurrence matrix with {} pairs in {:.1f}s".format(model.matrix.nnz, self.training_seconds))
+        # the same queries and cutoffs as evaluate_model, so the engines are compared like for like
+        self.validation_metrics = evaluate_cooccurrence(
+            model,
+            self.validation_dataset,
+            parse_cutoffs(self.KNN_K, self.EVAL_CUTOFFS),
+            self.QUERY_POOLING,
+            int(self.SESSION_LENGTH),
+            self.EXCLUDE_SEEN == '1')
+        self.validation_metric = self.validation_metrics['hit_rate@{}'.format(self.KNN_K)]
+        print("Hit Rate@{} is: {}".format(self.KNN_K, self.validation_metric))
+        self.cooccurrence_path = save_cooccurrence(
+            os.path.join(self.EMBEDDING_STORE, current.flow_name, current.run_id, current.task_id), model)
+
+    @step
+    def generate_embeddings(self):
+        """
+        Train the engine of the current branch of the foreach: Word2Vec for each set of hypers, and
+        the co-occurrence baseline (if any), with its training time and peak memory for join_runs.
+        """
+        from training import rss_mb
+        # this is the CURRENT hyper param JSON in the fan-out
+        # each copy of this step in the parallelization will have its own value
+        self.hyper_string = self.input
+        self.hypers = json.loads(self.hyper_string)
+        self.engine = self.hypers.get('engine', 'word2vec')
+        if self.engine == 'cooccurrence':
+            self.train_cooccurrence_engine()
+        else:
+            self.train_word2vec_engine()
+        # the task is a process of its own: its peak is the memory of this branch
+        self.peak_rss_mb = rss_mb('VmHWM')
         # join with the other runs
         self.next(self.join_runs)
 
@@ -264,24 +319,75 @@ class RecSysSagemakerDeployment(FlowSpec):
         """
         Join the parallel runs and merge results into a dictionary.
         """
+        from training import plot_epoch_stats, throughput_summary
         # merge results from runs with different parameters (key is hyper settings as a string)
         # and collect the predictions made by the different versions
-        self.all_vectors = { inp.hyper_string: inp.track_vectors for inp in inputs}
-        self.all_results = { inp.hyper_string: inp.validation_metric for inp in inputs}
+        # only the (small) metric and store path of each branch are loaded here: the vectors stay in
+        # their embedding stores, so we keep a reference to every configuration, not a copy
+        # the co-occurrence baseline has no vectors: only Word2Vec runs compete for the final ones
+        word2vec_inputs = [inp for inp in inputs if inp.engine == 'word2vec']
+        self.all_results = { inp.hyper_string: inp.validation_metric for inp in word2vec_inputs}
+        self.all_metrics = { inp.hyper_string: inp.validation_metrics for inp in inputs}
+        self.all_vectors = { inp.hyper_string: inp.track_vectors_path for inp in word2vec_inputs}
+        self.all_epoch_stats = { inp.hyper_string: inp.epoch_stats for inp in word2vec_inputs}
+        # cost of each engine, next to its hit rate
+        self.engine_results = [{
+            'engine': inp.engine,
+            'hypers': inp.hyper_string,
+            'hit_rate': inp.validation_metric,
+            'training_seconds': inp.training_seconds,
+            'peak_rss_mb': inp.peak_rss_mb,
+            'model_mb': inp.model_mb
+        } for inp in inputs]
         print("Current result map: {}".format(self.all_results))
          # pick one according to best hit rate
         self.best_model, self_best_result = sorted(self.all_results.items(), key=lambda x: x[1], reverse=True)[0]
         print("The best validation score is for model: {}, {}".format(self.best_model, self_best_result))
         # assign as "final" the best vectors according to validation
-        self.final_vectors = self.all_vectors[self.best_model]
-        self.final_dataset = inputs[0].df_test
+        self.final_vectors_path = self.all_vectors[self.best_model]
+        # the test set is passed down from the branches as it is, without loading it in this task
+        self.merge_artifacts(inputs, include=['test_dataset'])
         # TODO: improve card
         current.card.append(Markdown("## Results from parallel training"))
+        # every metric of the validation split, one column per metric and cutoff
+        metric_names = list(next(iter(self.all_metrics.values())))
         current.card.append(
             Table([
-                [inp.hyper_string, inp.validation_metric] for inp in inputs
-            ])
+                [hypers] + [metrics[_] for _ in metric_names] for hypers, metrics in self.all_metrics.items()
+            ], headers=['hypers'] + metric_names)
+        )
+        # both engines answer the same queries (see evaluate_cooccurrence)
+        query = 'last track' if self.QUERY_POOLING == 'last' else '{} of the last {} tracks'.format(
+            self.QUERY_POOLING, self.SESSION_LENGTH)
+        current.card.append(Markdown("## Engines: hit rate, training time and memory (query: {})".format(query)))
+        current.card.append(
+            Table([[
+                _['engine'],
+                _['hypers'],
+                round(_['hit_rate'], 4),
+                round(_['training_seconds'], 1),
+                round(_['peak_rss_mb']),
+                round(_['model_mb'], 1)
+            ] for _ in self.engine_results], headers=[
+                'engine', 'hypers', 'Hit Rate@{}'.format(self.KNN_K), 'training (s)', 'peak RSS (MB)', 'model (MB)'])
+        )
+        # per-epoch training stats of each set of hypers (see training.py): what each one costs,
+        # and how busy it kept its workers
+        summaries = { hypers: throughput_summary(epoch_stats) for hypers, epoch_stats in self.all_epoch_stats.items()}
+        current.card.append(Markdown("## Training throughput"))
+        current.card.append(
+            Table([[
+                hypers,
+                summary['epochs'],
+                summary['workers'],
+                round(summary['seconds'], 1),
+                round(summary['words_per_second']),
+                round(summary['utilization'], 2),
+                summary['last_loss']
+            ] for hypers, summary in summaries.items()
+            ], headers=['hypers', 'epochs', 'workers', 'seconds', 'words/s', 'utilization', 'last epoch loss'])
         )
+        current.card.append(Image.from_matplotlib(plot_epoch_stats(self.all_epoch_stats)))
         # next, test the best model on unseen data, and report the final Hit Rate as 
         # our best point-wise estimate of "in the wild" performance
         self.next(self.model_testing)
@@ -296,11 +402,20 @@ class RecSysSagemakerDeployment(FlowSpec):
         evaluating recommender systems is a very complex task, and better metrics, through good abstractions, 
         are available, i.e. https://reclist.io/.
         """
-        self.test_metric = self.evaluate_model(
-            self.final_dataset,
-            self.final_vectors,
-            k=int(self.KNN_K))
+        from embedding_store import load_embedding_store
+        from fallback import load_fallback
+        from training import cpu_allocation
+        # with 0, one worker per CPU of the step (e.g. @resources), not per core of the host
+        n_workers = int(self.EVAL_WORKERS) or cpu_allocation()
+        self.test_metrics = self.evaluate_model(
+            self.test_dataset,
+            load_embedding_store(self.final_vectors_path),
+            k=int(self.KNN_K),
+            fallback=load_fallback(self.final_vectors_path),
+            n_workers=n_workers)
+        self.test_metric = self.test_metrics['hit_rate@{}'.format(self.KNN_K)]
         print("Hit Rate@{} on the test set is: {}".format(self.KNN_K, self.test_metric))
+        print("All metrics on the test set: {}".format(self.test_metrics))
         self.next(self.deploy)
 
     # highlight-start
@@ -326,7 +441,8 @@ class RecSysSagemakerDeployment(FlowSpec):
         embedding_dimension = song_vectors[0].shape[0]
         print("Vector space dims: {}".format(embedding_dimension))
         # add to the existing matrix of weight a 0.0.0.0... vector for unknown items
-        unknown_vector = np.zeros((1, embedding_dimension))
+        # float32 like the vectors, so that np.r_ does not upcast the whole matrix to float64
+        unknown_vector = np.zeros((1, embedding_dimension), dtype=np.float32)
         print(song_vectors.shape, unknown_vector.shape)
         embedding_matrix = np.r_[unknown_vector, song_vectors]
         # first item is the unknown token!
@@ -358,7 +474,7 @@ class RecSysSagemakerDeployment(FlowSpec):
         return song_index
 
     # highlight-next-line
-    def build_retrieval_model(self):
+    def build_retrieval_model(self, vector_space):
         """
         Take the embedding space, build a Keras KNN model and store it in S3
         so that it can be deployed by a Sagemaker endpoint!
@@ -374,11 +490,12 @@ class RecSysSagemakerDeployment(FlowSpec):
         local_tar_name = 'model-{}.tar.gz'.format(self.model_timestamp)
         # pick one item, as index, to use as a test
         self.test_index = 3
+        # the endpoint speaks 'artist|||track' names, int track ids only live inside the flow
         retrieval_model = self.keras_model(
-            self.all_ids,
-            self.startup_embeddings,
-            self.all_ids[self.test_index],
-            self.startup_embeddings[self.test_index]
+            vector_space.names,
+            vector_space.vectors,
+            vector_space.names[self.test_index],
+            vector_space.vectors[self.test_index]
         )
         retrieval_model.save(filepath=model_name)
         # zip keras folder to a single tar local file
@@ -411,14 +528,31 @@ class RecSysSagemakerDeployment(FlowSpec):
         
         """
         import numpy as np
-        self.all_ids = list(self.final_vectors.index_to_key)
-        self.startup_embeddings = np.array([self.final_vectors[_] for _ in self.all_ids])
+        from embedding_store import load_embedding_store
+        # open the best vectors memory-mapped, instead of un-pickling a copy of the matrix
+        final_vectors = load_embedding_store(self.final_vectors_path)
+        from retrieval_artifact import export_artifact
+        # always export the TensorFlow-free alternative to the Keras model: one file, served with NumPy
+        # only by retrieval_artifact.py (see benchmark_artifact.py for startup time and latency)
+        self.retrieval_artifact_path = export_artifact(
+            os.path.join(self.EMBEDDING_STORE, current.flow_name, current.run_id, 'retrieval.artifact'),
+            final_vectors,
+            self.RETRIEVAL_INDEX,
+            rerank=int(self.RETRIEVAL_RERANK))
+        print("Retrieval artifact saved at: {}".format(self.retrieval_artifact_path))
+        from vector_dataset import write_vector_dataset
+        # and as a new version of the Lance dataset of track vectors of the flow, with an IVF-PQ index:
+        # clients can pin this run with the version, or always read the latest one
+        track_vectors = write_vector_dataset(
+            os.path.join(self.EMBEDDING_STORE, current.flow_name, 'track_vectors.lance'), final_vectors)
+        self.vector_dataset_path, self.vector_dataset_version = os.path.abspath(track_vectors.path), track_vectors.version
+        print("Track vectors saved at: {} (version {})".format(self.vector_dataset_path, self.vector_dataset_version))
         # skip the deployment if not needed
         if self.SAGEMAKER_DEPLOY == '0':
             print("Skipping deployment to Sagemaker")
         else:
             # first build the retrieval model and version it on S3
-            self.model_s3_path = self.build_retrieval_model()
+            self.model_s3_path = self.build_retrieval_model(final_vectors)
             from sagemaker.tensorflow import TensorFlowModel
             self.ENDPOINT_NAME = 'playlist-recs-{}-endpoint'.format(self.model_timestamp)
             # print out the name, so that we can use it later
@@ -434,7 +568,7 @@ class RecSysSagemakerDeployment(FlowSpec):
                 endpoint_name=self.ENDPOINT_NAME
             )
             # run a small test against the endpoint to check everything is working fine
-            input = {'instances': np.array([self.all_ids[self.test_index]])}
+            input = {'instances': np.array([final_vectors.names[self.test_index]])}
             # output is on the form {'predictions': {'output_2': ['0012E00001z5EzAQAU', ..]}
             result = predictor.predict(input)
             print(input, result)
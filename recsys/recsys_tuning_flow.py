@@ -1,5 +1,5 @@
 from metaflow import FlowSpec, step, S3, Parameter, current, card
-from metaflow.cards import Markdown, Table
+from metaflow.cards import Image, Markdown, Table
 import os
 import json
 import time
@@ -14,153 +14,270 @@ class RecSysTuningFlow(FlowSpec):
         default='1'
     )
 
+    DATASET_CACHE = Parameter(
+        name='dataset_cache',
+        help='Folder caching the prepared dataset across runs (empty string to disable)',
+        default='dataset_cache'
+    )
+
+    PROFILING = Parameter(
+        name='profiling',
+        help='Dataset stats: approx (one HyperLogLog scan), exact (one exact scan) or none',
+        default='approx'
+    )
+
     KNN_K = Parameter(
         name='knn_k',
         help='Number of neighbors we retrieve from the vector space',
         default='100'
     ) 
 
+    N_CONFIGS = Parameter(
+        name='n_configs',
+        help='Number of hyperparameter configurations sampled from the search space',
+        default='12'
+    )
+
+    ETA = Parameter(
+        name='eta',
+        help='Successive halving rate: configs train 1/eta of their epochs, the best 1/eta of them finish',
+        default='3'
+    )
+
+    VALIDATION_SAMPLE = Parameter(
+        name='validation_sample',
+        help='Number of validation playlists used to score configurations before promotion',
+        default='5000'
+    )
+
+    RETRIEVAL_INDEX = Parameter(
+        name='retrieval_index',
+        help='Index for KNN retrieval: brute_force (exact), ivf (approximate, faster on large catalogues), int8 or pq (quantized, less memory)',
+        default='brute_force'
+    )
+
+    RETRIEVAL_RERANK = Parameter(
+        name='retrieval_rerank',
+        help='With int8 or pq, re-score the best K * retrieval_rerank candidates with the exact vectors (0 to rank on the codes only)',
+        default='4'
+    )
+
+    QUERY_POOLING = Parameter(
+        name='query_pooling',
+        help='KNN query for a playlist: last (last track), mean or recency (pooled vectors of the last tracks)',
+        default='last'
+    )
+
+    SESSION_LENGTH = Parameter(
+        name='session_length',
+        help='Number of tracks pooled in the query, with mean or recency pooling',
+        default='5'
+    )
+
+    EXCLUDE_SEEN = Parameter(
+        name='exclude_seen',
+        help='1 to never recommend tracks that are already in the playlist, 0 to only exclude the query track',
+        default='0'
+    )
+
+    EVAL_CUTOFFS = Parameter(
+        name='eval_cutoffs',
+        help='Comma separated cutoffs K for Hit Rate@K, MRR@K and NDCG@K, on top of knn_k',
+        default='1,10'
+    )
+
+    EVAL_WORKERS = Parameter(
+        name='eval_workers',
+        help='Processes sharing the test set evaluation in model_testing, 0 for one per allocated CPU',
+        default='1'
+    )
+
+    EMBEDDING_STORE = Parameter(
+        name='embedding_store',
+        help='Local (or shared) folder where track vectors are stored as memory-mapped embedding stores',
+        default='embedding_stores'
+    )
+
     @step
     def start(self):
+        from evaluation import parse_cutoffs
         print("flow name: %s" % current.flow_name)
         print("run id: %s" % current.run_id)
         print("username: %s" % current.username)
         if self.IS_DEV == '1':
             print("ATTENTION: RUNNING AS DEV VERSION - DATA WILL BE SUB-SAMPLED!!!") 
+        # bad eval_cutoffs fail here, not after training
+        parse_cutoffs(self.KNN_K, self.EVAL_CUTOFFS)
         # next up, get the data
         self.next(self.prepare_dataset)
 
+    @card(type='blank', id='datasetCard')
     @step
     def prepare_dataset(self):
         """
-        Get the data in the right shape by reading the parquet dataset
+        Get the data in the right shape by reading the cleaned dataset
         and using duckdb SQL-based wrangling to quickly prepare the datasets for
         training our Recommender System.
         """
-        import duckdb
-        import numpy as np
-        con = duckdb.connect(database=':memory:')
-        
-        con.execute("""
-            CREATE TABLE playlists AS 
-            SELECT *, 
-            CONCAT (user_id, '-', playlist) as playlist_id,
-            CONCAT (artist, '|||', track) as track_id,
-            FROM 'cleaned_spotify_dataset.parquet'
-            ;
-        """)
-        con.execute("SELECT * FROM playlists LIMIT 1;")
-        print(con.fetchone())
-        
-        tables = ['row_id', 'user_id', 'track_id', 'playlist_id', 'artist']
-        for t in tables:
-            con.execute("SELECT COUNT(DISTINCT({})) FROM playlists;".format(t))
-            print("# of {}".format(t), con.fetchone()[0])
-            
-        sampling_cmd = ''
-        if self.IS_DEV == '1':
-            print("Subsampling data, since this is DEV")
-            sampling_cmd = ' USING SAMPLE 10 PERCENT (bernoulli)'
-            
-        dataset_query = """
-            SELECT * FROM
-            (   
-                SELECT 
-                    playlist_id,
-                    LIST(artist ORDER BY row_id ASC) as artist_sequence,
-                    LIST(track_id ORDER BY row_id ASC) as track_sequence,
-                    array_pop_back(LIST(track_id ORDER BY row_id ASC)) as track_test_x,
-                    LIST(track_id ORDER BY row_id ASC)[-1] as track_test_y
-                FROM 
-                    playlists
-                GROUP BY playlist_id 
-                HAVING len(track_sequence) > 2
-            ) 
-            {}
-            ;
-            """.format(sampling_cmd)
+        from dataset import load_dataset, write_corpus
+        # the DuckDB wrangling lives in dataset.py, so that all the flows share it: the prepared
+        # table is cached, keyed by the Lance dataset version, IS_DEV and the queries
+        splits, self.vocabulary, self.dataset_profile = load_dataset(
+            is_dev=self.IS_DEV == '1',
+            cache_dir=self.DATASET_CACHE,
+            profiling=self.PROFILING)
+        # descriptive stats (distinct users, tracks, ...) go to a card, instead of the logs
+        if self.dataset_profile:
+            current.card.append(Markdown("## Dataset profile ({} counts)".format(self.dataset_profile.mode)))
+            current.card.append(Table(self.dataset_profile.to_rows(), headers=['stat', 'value']))
+        print("# rows: {}".format(sum(_.num_rows for _ in splits.values())))
+        print(splits['train'].slice(0, 1).to_pylist())
+        # playlists are assigned to training, validation and test set inside DuckDB, from a hash
+        # of the playlist id, and each split comes back as an Arrow table (no pandas copies)
+        # with tracks as int ids: self.vocabulary maps them back to 'artist|||track'
+        self.train_dataset = splits['train']
+        self.validation_dataset = splits['validate']
+        self.test_dataset = splits['test']
+        print("# testing rows: {}".format(self.test_dataset.num_rows))
+        # write the training playlists once, as a plain text corpus: gensim trains on the file
+        # in corpus_file mode (see training.py), so each branch of the foreach never loads train_dataset
+        self.corpus_path = write_corpus(
+            self.train_dataset['track_sequence'],
+            os.path.join(self.EMBEDDING_STORE, current.flow_name, current.run_id, 'train_corpus.txt'))
         
-        con.execute(dataset_query)
-        df = con.fetch_df()
-        print("# rows: {}".format(len(df)))
-        print(df.iloc[0].tolist())
-        con.close()
-        
-        train, validate, test = np.split(
-            df.sample(frac=1, random_state=42), 
-            [int(.7 * len(df)), int(.9 * len(df))])
-        
-        self.df_dataset = df
-        self.df_train = train
-        self.df_validate = validate
-        self.df_test = test
-        print("# testing rows: {}".format(len(self.df_test)))
-        
-        self.hypers_sets = [json.dumps(_) for _ in [
-            { 'min_count': 3, 'epochs': 30, 'vector_size': 48, 'window': 10, 'ns_exponent': 0.75 },
-            { 'min_count': 5, 'epochs': 30, 'vector_size': 48, 'window': 10, 'ns_exponent': 0.75 },
-            { 'min_count': 10, 'epochs': 30, 'vector_size': 48, 'window': 10, 'ns_exponent': 0.75 }
-        ]]
-        # we train K models in parallel, depending how many configurations of hypers 
-        # we set - we generate K set of vectors, and evaluate them on the validation
-        # set to pick the best combination of parameters!
+        from search import sample_configs
+        # instead of a few hand-picked sets of hypers, we declare the space we want to explore
+        # and sample N_CONFIGS configurations from it, serialized to strings for the foreach
+        search_space = {
+            'min_count': [3, 5, 10],
+            'vector_size': [32, 48, 64],
+            'window': [5, 10, 20],
+            'ns_exponent': [0.5, 0.75, 1.0],
+            'epochs': [20, 30]
+        }
+        self.hypers_sets = [json.dumps(_) for _ in sample_configs(search_space, int(self.N_CONFIGS))]
+        # we train K models in parallel, for a fraction of their epochs: the best ones
+        # on (a sample of) the validation set will then finish their training
         self.next(self.generate_embeddings, foreach='hypers_sets')
         # highlight-end
 
-    def predict_next_track(self, vector_space, input_sequence, k):
-        """        
-        Given an embedding space, predict best next song with KNN.
-        Initially, we just take the LAST item in the input playlist as the query item for KNN
-        and retrieve the top K nearest vectors (you could think of taking the smoothed average embedding
-        of the input list, for example, as a refinement).
-
-        If the query item is not in the vector space, we make a random bet. We could refine this by taking
-        for example the vector of the artist (average of all songs), or with some other strategy (sampling
-        by popularity). 
-
-        For more options on how to generate vectors for "cold items" see for example the paper:
-        https://dl.acm.org/doi/10.1145/3383313.3411477
+    def evaluate_model(self, dataset, vector_space, k, fallback=None, n_workers=1):
         """
-        query_item = input_sequence[-1]
-        if query_item not in vector_space:
-            query_item = choice(list(vector_space.index_to_key))
-        
-        return [_[0] for _ in vector_space.most_similar(query_item, topn=k)]
-
-    def evaluate_model(self, _df, vector_space, k):
-        lambda_predict = lambda row: self.predict_next_track(vector_space, row['track_test_x'], k)
-        _df['predictions'] = _df.apply(lambda_predict, axis=1)
-        lambda_hit = lambda row: 1 if row['track_test_y'] in row['predictions'] else 0
-        _df['hit'] = _df.apply(lambda_hit, axis=1)
-        hit_rate = _df['hit'].sum() / len(_df)
-        return hit_rate
+        Hit Rate, MRR and NDCG on the dataset, at K and at each of the eval_cutoffs, computed in batch:
+        all the query vectors are scored against the vocabulary with matrix multiplications instead of
+        one most_similar call per row, once at the largest cutoff, and every metric is derived from the
+        rank of the target track. Query tracks without a vector are answered by the cold-start fallback
+        (see fallback.py), if given. With n_workers > 1, the queries are sharded across processes
+        (see evaluation.py).
+        """
+        from evaluation import evaluate, parse_cutoffs
+        return evaluate(
+            dataset, vector_space, parse_cutoffs(k, self.EVAL_CUTOFFS), self.RETRIEVAL_INDEX, fallback,
+            self.QUERY_POOLING, int(self.SESSION_LENGTH), n_workers, self.EXCLUDE_SEEN == '1',
+            int(self.RETRIEVAL_RERANK))
 
     @step
     def generate_embeddings(self):
         """
         Generate vector representations for songs, based on the Prod2Vec idea.
 
+        This is the first rung of successive halving: we only train for 1/ETA of the epochs, and
+        score the partial model on a sample of the validation set.
+
         For an overview of the algorithm and the evaluation, see for example:
         https://arxiv.org/abs/2007.14906
         """
+        from fallback import build_fallback
+        from search import rung_epochs
+        from training import branch_workers, train_word2vec
+        self.hyper_string = self.input
+        self.hypers = json.loads(self.hyper_string)
+        # without a container quota, the branches of the foreach share the local cores
+        workers = branch_workers(len(self.hypers_sets))
+        track2vec_model, self.epoch_stats = train_word2vec(
+            self.corpus_path, self.hypers, workers, epochs=rung_epochs(self.hypers, int(self.ETA)))
+        print("Trained {} for {} epochs on {} workers".format(self.hyper_string, track2vec_model.epochs, workers))
+        # validation rows come in a (deterministic) shuffled order, so the first rows are a fair sample
+        self.rung_metrics = self.evaluate_model(
+            self.validation_dataset.slice(0, int(self.VALIDATION_SAMPLE)),
+            track2vec_model.wv,
+            k=int(self.KNN_K),
+            fallback=build_fallback(track2vec_model.wv, self.vocabulary))
+        self.rung_metric = self.rung_metrics['hit_rate@{}'.format(self.KNN_K)]
+        print("Hit Rate@{} on the validation sample is: {}".format(self.KNN_K, self.rung_metric))
+        # save the full model (not just the vectors), so that training can resume if promoted
+        checkpoint_dir = os.path.join(
+            self.EMBEDDING_STORE, current.flow_name, current.run_id, 'checkpoints', current.task_id)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.checkpoint_path = os.path.abspath(os.path.join(checkpoint_dir, 'word2vec.model'))
+        track2vec_model.save(self.checkpoint_path)
+        self.next(self.rank_configs)
+
+    @step
+    def rank_configs(self, inputs):
+        """
+        Rank the configurations on the validation sample, and keep the best 1/ETA of them.
+        """
+        from search import promote
+        self.merge_artifacts(inputs, include=[
+            'corpus_path', 'vocabulary', 'validation_dataset', 'test_dataset'])
+        self.rung_results = { inp.hyper_string: inp.rung_metric for inp in inputs }
+        self.checkpoints = { inp.hyper_string: inp.checkpoint_path for inp in inputs }
+        self.rung_epoch_stats = { inp.hyper_string: inp.epoch_stats for inp in inputs }
+        self.promoted = promote(self.rung_results, int(self.ETA))
+        self.next(self.promote_configs)
+
+    @step
+    def promote_configs(self):
+        """
+        Send the promoted configurations to finish their training, in parallel.
+        """
+        print("Promoting {} configs out of {}: {}".format(len(self.promoted), len(self.rung_results), self.promoted))
+        self.next(self.continue_training, foreach='promoted')
+
+    @step
+    def continue_training(self):
+        """
+        Resume training of a promoted configuration for the rest of its epochs, and evaluate it
+        on the full validation set.
+        """
         from gensim.models.word2vec import Word2Vec
+        from embedding_store import save_keyed_vectors
+        from fallback import build_fallback, save_fallback
+        from dataset import track_names
+        from training import branch_workers, resume_word2vec
         self.hyper_string = self.input
         self.hypers = json.loads(self.hyper_string)
-        track2vec_model = Word2Vec(self.df_train['track_sequence'], **self.hypers)
-        print("Training with hypers {} is completed!".format(self.hyper_string))
+        workers = branch_workers(len(self.promoted))
+        track2vec_model, self.epoch_stats = resume_word2vec(
+            Word2Vec.load(self.checkpoints[self.hyper_string]), self.corpus_path, self.hypers, workers)
+        print("Training with hypers {} on {} workers is completed!".format(self.hyper_string, workers))
         print("Vector space size: {}".format(len(track2vec_model.wv.index_to_key)))
         test_track = choice(list(track2vec_model.wv.index_to_key))
-        print("Example track: '{}'".format(test_track))
+        test_name = track_names(self.vocabulary, [test_track])[0]
+        print("Example track: '{}'".format(test_name))
         test_vector = track2vec_model.wv[test_track]
-        print("Test vector for '{}': {}".format(test_track, test_vector[:5]))
+        print("Test vector for '{}': {}".format(test_name, test_vector[:5]))
         test_sims = track2vec_model.wv.most_similar(test_track, topn=3)
-        print("Similar songs to '{}': {}".format(test_track, test_sims))
-        self.validation_metric = self.evaluate_model(
-            self.df_validate,
+        test_sims = list(zip(track_names(self.vocabulary, [_[0] for _ in test_sims]), [_[1] for _ in test_sims]))
+        print("Similar songs to '{}': {}".format(test_name, test_sims))
+        # cold-start tables (artist centroids, popular tracks) for the query tracks without a vector
+        fallback = build_fallback(track2vec_model.wv, self.vocabulary)
+        self.validation_metrics = self.evaluate_model(
+            self.validation_dataset,
             track2vec_model.wv,
-            k=int(self.KNN_K))
+            k=int(self.KNN_K),
+            fallback=fallback)
+        self.validation_metric = self.validation_metrics['hit_rate@{}'.format(self.KNN_K)]
         print("Hit Rate@{} is: {}".format(self.KNN_K, self.validation_metric))
-        self.track_vectors = track2vec_model.wv
+        # finally, version the embeddings: instead of pickling the KeyedVectors, we write them
+        # to a memory-mapped store (see embedding_store.py) and only version its path
+        self.track_vectors_path = save_keyed_vectors(
+            os.path.join(self.EMBEDDING_STORE, current.flow_name, current.run_id, current.task_id),
+            track2vec_model.wv,
+            names=track_names(self.vocabulary, track2vec_model.wv.index_to_key),
+            hypers=self.hypers)
+        save_fallback(self.track_vectors_path, fallback)
         self.next(self.join_runs)
 
     # highlight-next-line
@@ -170,20 +287,56 @@ class RecSysTuningFlow(FlowSpec):
         """
         Join the parallel runs and merge results into a dictionary.
         """
-        self.all_vectors = { inp.hyper_string: inp.track_vectors for inp in inputs}
+        from training import plot_epoch_stats, throughput_summary
+        # only the (small) metric and store path of each branch are loaded here: the vectors stay in
+        # their embedding stores, so we keep a reference to every configuration, not a copy
         self.all_results = { inp.hyper_string: inp.validation_metric for inp in inputs}
+        self.all_metrics = { inp.hyper_string: inp.validation_metrics for inp in inputs}
+        self.all_vectors = { inp.hyper_string: inp.track_vectors_path for inp in inputs}
         print("Current result map: {}".format(self.all_results))
         self.best_model, self_best_result = sorted(self.all_results.items(), key=lambda x: x[1], reverse=True)[0]
         print("The best validation score is for model: {}, {}".format(self.best_model, self_best_result))
-        self.final_vectors = self.all_vectors[self.best_model]
-        self.final_dataset = inputs[0].df_test
+        self.final_vectors_path = self.all_vectors[self.best_model]
+        # the test set is passed down from the branches as it is, without loading it in this task
+        self.merge_artifacts(inputs, include=['test_dataset', 'rung_results', 'rung_epoch_stats'])
+        # epochs of the first rung for every config, then the ones resumed after promotion
+        resumed_epoch_stats = { inp.hyper_string: inp.epoch_stats for inp in inputs}
+        self.all_epoch_stats = {
+            hypers: epoch_stats + resumed_epoch_stats.get(hypers, [])
+            for hypers, epoch_stats in self.rung_epoch_stats.items()
+        }
         # highlight-start
         current.card.append(Markdown("## Results from parallel training"))
+        # every metric of the validation split, one column per metric and cutoff
+        metric_names = list(next(iter(self.all_metrics.values())))
         current.card.append(
             Table([
-                [inp.hyper_string, inp.validation_metric] for inp in inputs
-            ])
+                [hypers] + [metrics[_] for _ in metric_names] for hypers, metrics in self.all_metrics.items()
+            ], headers=['hypers'] + metric_names)
+        )
+        current.card.append(Markdown("## Successive halving: first rung (validation sample)"))
+        current.card.append(
+            Table([
+                [hypers, metric, hypers in self.all_results] for hypers, metric in self.rung_results.items()
+            ], headers=['hypers', 'Hit Rate@{}'.format(self.KNN_K), 'promoted'])
+        )
+        # per-epoch training stats of each set of hypers (see training.py): what each one costs,
+        # and how busy it kept its workers
+        summaries = { hypers: throughput_summary(epoch_stats) for hypers, epoch_stats in self.all_epoch_stats.items()}
+        current.card.append(Markdown("## Training throughput"))
+        current.card.append(
+            Table([[
+                hypers,
+                summary['epochs'],
+                summary['workers'],
+                round(summary['seconds'], 1),
+                round(summary['words_per_second']),
+                round(summary['utilization'], 2),
+                summary['last_loss']
+            ] for hypers, summary in summaries.items()
+            ], headers=['hypers', 'epochs', 'workers', 'seconds', 'words/s', 'utilization', 'last epoch loss'])
         )
+        current.card.append(Image.from_matplotlib(plot_epoch_stats(self.all_epoch_stats)))
         # highlight-end
         # next, test the best model on unseen data, and report the final Hit Rate as 
         # our best point-wise estimate of "in the wild" performance
@@ -199,11 +352,20 @@ class RecSysTuningFlow(FlowSpec):
         evaluating recommender systems is a very complex task, and better metrics, through good abstractions, 
         are available, i.e. https://reclist.io/.
         """
-        self.test_metric = self.evaluate_model(
-            self.final_dataset,
-            self.final_vectors,
-            k=int(self.KNN_K))
+        from embedding_store import load_embedding_store
+        from fallback import load_fallback
+        from training import cpu_allocation
+        # with 0, one worker per CPU of the step (e.g. @resources), not per core of the host
+        n_workers = int(self.EVAL_WORKERS) or cpu_allocation()
+        self.test_metrics = self.evaluate_model(
+            self.test_dataset,
+            load_embedding_store(self.final_vectors_path),
+            k=int(self.KNN_K),
+            fallback=load_fallback(self.final_vectors_path),
+            n_workers=n_workers)
+        self.test_metric = self.test_metrics['hit_rate@{}'.format(self.KNN_K)]
         print("Hit Rate@{} on the test set is: {}".format(self.KNN_K, self.test_metric))
+        print("All metrics on the test set: {}".format(self.test_metrics))
         self.next(self.end)
 
     @step
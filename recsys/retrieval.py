@@ -0,0 +1,660 @@
+"""
+
+Vectorized KNN retrieval over a track embedding matrix.
+
+Instead of asking gensim for the neighbours of one track at a time, we score a whole
+matrix of queries against the (L2 normalized) vocabulary with a single matrix multiply,
+in fixed-size chunks to keep memory bounded, and select the top K with argpartition.
+
+Exact search is linear in the size of the catalogue, so we also provide an approximate
+index (IVF, i.e. an inverted file over k-means clusters) behind the same interface:
+
+    index = build_index('ivf', vectors)
+    neighbours = index.search(queries, k)
+
+Both scan float32 vectors (4 bytes per dimension). For catalogues of millions of tracks, the
+quantized indexes keep compressed codes in memory and score float32 queries against them
+directly (asymmetric distance computation): 'int8' (scalar quantization, about 4x smaller) and
+'pq' (product quantization, 12x smaller for 48 dims with the default n_subspaces = dim / 4, one
+byte per subspace plus a float32 bias per track). The nbytes of each index is the memory its
+search scans. The quantized indexes encode the vectors minus their mean, and can re-score their
+best k * rerank candidates with the exact vectors (on by default for PQ). They also keep the
+float32 vectors, to look up query vectors (and for re-ranking): build them from memory-mapped
+normalized vectors (e.g. an embedding store, with normalized=True), or they hold a full float32
+copy in RAM next to their codes. resident_nbytes counts both.
+
+Queries can also pool the last tracks of each session (mean or recency-weighted), for all
+the sessions at once: see pool. Every index takes per-query sets of rows to exclude (e.g. the
+tracks already in the playlist), as sparse index arrays or packed bitsets: see Exclusions.
+
+Use benchmark_retrieval.py to trade recall for speed on your own vocabulary sizes.
+
+"""
+
+import numpy as np
+
+# how the tracks of a session are combined into one query vector (see pool)
+POOLINGS = ['last', 'mean', 'recency']
+
+
+def normalize(vectors):
+    """
+    Return a float32 copy of the matrix with unit-length rows, so that dot products
+    are cosine similarities (zero rows are left as zeros).
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def pool_weights(rows, pooling='mean', decay=0.8):
+    """
+    (n_sessions, N) weights of the tracks of each session in its query (see pool), summing to 1
+    over the tracks of the session (0 for padding): the co-occurrence engine pools its sessions with
+    the same weights (see cooccurrence.py).
+    """
+    if pooling not in POOLINGS:
+        raise ValueError("Unknown pooling '{}', choose one of: {}".format(pooling, POOLINGS))
+    valid = rows >= 0
+    if pooling == 'last':
+        weights = np.zeros(rows.shape, dtype=np.float32)
+        weights[:, -1] = 1.0
+    elif pooling == 'recency':
+        weights = np.tile(decay ** np.arange(rows.shape[1] - 1, -1, -1, dtype=np.float32), (rows.shape[0], 1))
+    else:
+        weights = np.ones(rows.shape, dtype=np.float32)
+    weights *= valid
+    totals = weights.sum(axis=1, keepdims=True)
+    weights /= np.where(totals > 0, totals, 1.0)
+
+    return weights
+
+
+def pool(normed_vectors, rows, pooling='mean', decay=0.8, chunk_size=65536):
+    """
+    Session query vectors: rows is a (n_sessions, N) int array of rows of normed_vectors, most
+    recent track last, with -1 for padding (or tracks without a vector). 'mean' averages the
+    vectors in the session, 'recency' weights them by decay ** age (0 for the last track) and
+    'last' only takes the last track. Sessions without any vector get a zero query.
+
+    All the sessions are pooled at once with a weighted sum over the padded array, in chunks
+    to bound the (chunk_size, N, dim) gather.
+    """
+    weights = pool_weights(rows, pooling, decay)
+    queries = np.empty((rows.shape[0], normed_vectors.shape[1]), dtype=np.float32)
+    for start in range(0, rows.shape[0], chunk_size):
+        end = min(start + chunk_size, rows.shape[0])
+        _vectors = normed_vectors[np.maximum(rows[start:end], 0)]
+        queries[start:end] = np.einsum('nj,njd->nd', weights[start:end], _vectors)
+
+    return queries
+
+
+class Exclusions():
+    """
+    Per-query sets of rows the search must not return (e.g. the tracks already in each playlist),
+    over the integer rows of the index, in one of two representations:
+
+        - sparse, CSR-like: the rows of query i are rows[offsets[i]:offsets[i + 1]] (-1 entries are
+          ignored), see from_rows, from_padded and from_lists;
+        - packed bitsets: a (n_queries, ceil(n_vectors / 8)) uint8 array from np.packbits, with one
+          bit per row of the index, which pays off for very large sets (e.g. a whole user history).
+
+    Either way the sets are applied as a mask on the scores, before top K selection.
+    """
+
+    def __init__(self, rows=None, offsets=None, bits=None):
+        self.rows = rows
+        self.offsets = offsets
+        self.bits = bits
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        One row per query, -1 for none: the exclude argument of search used to be only this.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        return cls(rows[rows >= 0], np.r_[0, np.cumsum(rows >= 0)])
+
+    @classmethod
+    def from_padded(cls, rows):
+        """
+        A (n_queries, M) int array, padded with -1.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        return cls(rows[rows >= 0], np.r_[0, np.cumsum((rows >= 0).sum(axis=1))])
+
+    @classmethod
+    def from_lists(cls, lists):
+        lists = [np.asarray(_, dtype=np.int64).ravel() for _ in lists]
+        rows = np.concatenate(lists) if lists else np.empty(0, dtype=np.int64)
+        return cls(rows, np.r_[0, np.cumsum([len(_) for _ in lists])].astype(np.int64))
+
+    def __len__(self):
+        return self.bits.shape[0] if self.bits is not None else self.offsets.shape[0] - 1
+
+    def take(self, queries):
+        """
+        Exclusions of a subset of the queries: a slice or an int array.
+        """
+        if self.bits is not None:
+            return Exclusions(bits=self.bits[queries])
+        if isinstance(queries, slice):
+            start, stop, _ = queries.indices(len(self))
+            return Exclusions(
+                self.rows[self.offsets[start]:self.offsets[stop]], self.offsets[start:stop + 1] - self.offsets[start])
+        queries = np.asarray(queries, dtype=np.int64)
+        lengths = (self.offsets[1:] - self.offsets[:-1])[queries]
+        offsets = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+        positions = np.repeat(self.offsets[queries] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return Exclusions(self.rows[positions], offsets)
+
+    def to_bits(self, n_vectors):
+        """
+        Packed bitsets over n_vectors rows, for the same sets.
+        """
+        if self.bits is not None:
+            return self
+        queries, rows = self._pairs()
+        bits = np.zeros((len(self), (n_vectors + 7) // 8), dtype=np.uint8)
+        np.bitwise_or.at(bits, (queries, rows >> 3), (128 >> (rows & 7)).astype(np.uint8))
+        return Exclusions(bits=bits)
+
+    def _pairs(self):
+        # (query, row) pairs of the sparse representation, without the -1 entries
+        queries = np.repeat(np.arange(len(self)), self.offsets[1:] - self.offsets[:-1])
+        valid = self.rows >= 0
+        return queries[valid], self.rows[valid]
+
+    def apply(self, scores, start=0):
+        """
+        Set to -inf, in place, the excluded entries of scores, a (n_queries, n_columns) matrix for
+        rows start to start + n_columns of the index.
+        """
+        end = start + scores.shape[1]
+        if self.bits is not None:
+            first_byte = start // 8
+            mask = np.unpackbits(self.bits[:, first_byte:(end + 7) // 8], axis=1)
+            scores[mask[:, start - 8 * first_byte:end - 8 * first_byte].astype(bool)] = -np.inf
+            return scores
+        queries, rows = self._pairs()
+        in_block = (rows >= start) & (rows < end)
+        scores[queries[in_block], rows[in_block] - start] = -np.inf
+        return scores
+
+    def mask(self, candidates):
+        """
+        (n_queries, len(candidates)) bool array: is each candidate row excluded for each query.
+        """
+        candidates = np.asarray(candidates, dtype=np.int64)
+        if self.bits is not None:
+            return ((self.bits[:, candidates >> 3] >> (7 - (candidates & 7))) & 1).astype(bool)
+        result = np.zeros((len(self), candidates.shape[0]), dtype=bool)
+        if candidates.shape[0] == 0:
+            return result
+        queries, rows = self._pairs()
+        order = np.argsort(candidates, kind='stable')
+        positions = np.minimum(np.searchsorted(candidates[order], rows), candidates.shape[0] - 1)
+        found = candidates[order][positions] == rows
+        result[queries[found], order[positions[found]]] = True
+        return result
+
+    def contains(self, i, candidates):
+        """
+        Bool array: is each of the candidate rows excluded for query i.
+        """
+        if self.bits is not None:
+            return ((self.bits[i, candidates >> 3] >> (7 - (candidates & 7))) & 1).astype(bool)
+        excluded = self.rows[self.offsets[i]:self.offsets[i + 1]]
+        if excluded.shape[0] == 1:
+            # the usual case, e.g. the query track
+            return candidates == excluded[0]
+        return np.isin(candidates, excluded)
+
+    def contains_pairs(self, queries, candidates):
+        """
+        Bool array: is candidates[j] excluded for query queries[j], for ragged candidate lists
+        flattened into (query, row) pairs.
+        """
+        queries = np.asarray(queries, dtype=np.int64)
+        candidates = np.asarray(candidates, dtype=np.int64)
+        if self.bits is not None:
+            return ((self.bits[queries, candidates >> 3] >> (7 - (candidates & 7))) & 1).astype(bool)
+        excluded_queries, excluded_rows = self._pairs()
+        # one int per (query, row) pair, so that a single isin does the matching
+        n_rows = max(candidates.max(initial=-1), excluded_rows.max(initial=-1)) + 1
+        return np.isin(queries * n_rows + candidates, excluded_queries * n_rows + excluded_rows)
+
+
+def as_exclusions(exclude):
+    """
+    The exclude argument of search as Exclusions: None, Exclusions, one row per query (-1 for none)
+    or a (n_queries, M) array of rows padded with -1.
+    """
+    if exclude is None or isinstance(exclude, Exclusions):
+        return exclude
+    exclude = np.asarray(exclude)
+    return Exclusions.from_rows(exclude) if exclude.ndim == 1 else Exclusions.from_padded(exclude)
+
+
+def top_k(queries, normed_vectors, k, exclude=None, chunk_size=1024):
+    """
+    Return a (n_queries, k) int array with the indices of the k rows of normed_vectors
+    most similar to each query, sorted by decreasing similarity.
+
+    exclude holds the rows that must not be returned for each query (see as_exclusions), e.g.
+    the query track itself, as gensim most_similar does, or the tracks already in the playlist:
+    they are masked before selection, and rows are padded with -1 if fewer than k are left.
+    """
+    n_queries = queries.shape[0]
+    exclude = as_exclusions(exclude)
+    k = min(k, normed_vectors.shape[0])
+    results = np.empty((n_queries, k), dtype=np.int64)
+    for start in range(0, n_queries, chunk_size):
+        end = min(start + chunk_size, n_queries)
+        # (chunk_size, V) similarity matrix - this is the only big allocation
+        scores = queries[start:end] @ normed_vectors.T
+        if exclude is None:
+            results[start:end] = _select(scores, np.arange(normed_vectors.shape[0]), k)
+            continue
+        exclude.take(slice(start, end)).apply(scores)
+        selected = _select(scores, np.arange(normed_vectors.shape[0]), k)
+        selected[np.take_along_axis(scores, selected, axis=1) == -np.inf] = -1
+        results[start:end] = selected
+
+    return results
+
+
+def _select(scores, candidates, k):
+    """
+    Pick the k best candidates for each row of scores, best first: argpartition is
+    linear in the number of candidates, we then only sort the k winners.
+    """
+    top = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    top_scores = np.take_along_axis(scores, top, axis=-1)
+    order = np.argsort(-top_scores, axis=-1, kind='stable')
+    return candidates[np.take_along_axis(top, order, axis=-1)]
+
+
+class BruteForceIndex():
+    """
+    Exact search: every query is scored against the whole vocabulary.
+
+    Pass normalized=True if the rows of vectors already have unit length (e.g. a memory
+    mapped matrix from embedding_store.py), to use them as they are without a copy.
+    """
+
+    def __init__(self, vectors, chunk_size=1024, normalized=False):
+        self.vectors = vectors if normalized else normalize(vectors)
+        self.chunk_size = chunk_size
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes
+
+    def search(self, queries, k, exclude=None):
+        return top_k(normalize(queries), self.vectors, k, exclude, self.chunk_size)
+
+
+class IVFIndex():
+    """
+    Approximate search with an inverted file: the vocabulary is partitioned in n_lists
+    clusters with (spherical) k-means, and each query is only scored against the vectors
+    in the n_probe clusters closest to it. Cost per query goes from O(V) to roughly
+    O(n_lists + n_probe * V / n_lists).
+    """
+
+    def __init__(self, vectors, n_lists=None, n_probe=16, n_iter=10, max_train_size=100000, seed=42,
+                 normalized=False):
+        self.vectors = vectors if normalized else normalize(vectors)
+        n_vectors = self.vectors.shape[0]
+        # usual rule of thumb for IVF: a few times sqrt(V) lists
+        self.n_lists = min(n_lists or int(4 * np.sqrt(n_vectors)), n_vectors)
+        self.n_probe = min(n_probe, self.n_lists)
+        self.centroids = self._train(n_iter, max_train_size, np.random.default_rng(seed))
+        assignments = self._assign(self.vectors)
+        # store the members of each list contiguously: list l is ids[offsets[l]:offsets[l + 1]]
+        self.ids = np.argsort(assignments, kind='stable')
+        self.offsets = np.r_[0, np.cumsum(np.bincount(assignments, minlength=self.n_lists))]
+
+    def _assign(self, vectors, chunk_size=8192):
+        return np.concatenate([
+            np.argmax(vectors[start:start + chunk_size] @ self.centroids.T, axis=1)
+            for start in range(0, vectors.shape[0], chunk_size)
+        ])
+
+    def _train(self, n_iter, max_train_size, rng):
+        n_vectors = self.vectors.shape[0]
+        sample = self.vectors[rng.choice(n_vectors, min(n_vectors, max_train_size), replace=False)]
+        self.centroids = sample[rng.choice(sample.shape[0], self.n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignments = self._assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, sample)
+            # empty clusters keep their previous centroid
+            empty = np.bincount(assignments, minlength=self.n_lists) == 0
+            sums[empty] = self.centroids[empty]
+            self.centroids = normalize(sums)
+
+        return self.centroids
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + self.centroids.nbytes + self.ids.nbytes + self.offsets.nbytes
+
+    def _members(self, lists):
+        return np.concatenate([self.ids[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+
+    def search(self, queries, k, exclude=None, chunk_size=1024):
+        """
+        Same contract as BruteForceIndex.search. When the n_probe lists of a query hold fewer than
+        k candidates (e.g. after excluding the tracks of a long playlist), we over-fetch: the next
+        closest lists are probed too, doubling their number until there are k candidates.
+
+        Queries are processed chunk_size at a time: the centroids of a chunk are scored and sorted
+        once, over-fetching only reads further along that order, and the queries which probe the
+        same lists are scored together, with one matrix product per probe set.
+        """
+        queries = normalize(queries)
+        exclude = as_exclusions(exclude)
+        results = np.full((queries.shape[0], k), -1, dtype=np.int64)
+        for start in range(0, queries.shape[0], chunk_size):
+            end = min(start + chunk_size, queries.shape[0])
+            order = np.argsort(-(queries[start:end] @ self.centroids.T), axis=1, kind='stable')
+            pending = np.arange(end - start)
+            n_probe = self.n_probe
+            while pending.shape[0] > 0:
+                # the probe set of a query is the same whatever the order of its lists
+                probes = np.sort(order[pending, :n_probe], axis=1)
+                probe_sets, groups = np.unique(probes, axis=0, return_inverse=True)
+                short = []
+                for group, lists in enumerate(probe_sets):
+                    rows = pending[groups.ravel() == group]
+                    candidates = self._members(lists)
+                    scores = queries[start + rows] @ self.vectors[candidates].T
+                    if exclude is not None:
+                        scores[exclude.take(start + rows).mask(candidates)] = -np.inf
+                    n_found = np.isfinite(scores).sum(axis=1)
+                    done = (n_found >= k) | (n_probe >= self.n_lists)
+                    short.append(rows[~done])
+                    _k = min(k, candidates.shape[0])
+                    if not done.any() or _k == 0:
+                        continue
+                    selected = _select(scores[done], candidates, _k)
+                    # fewer than k candidates left once every list is probed: pad with -1
+                    selected[np.arange(_k) >= n_found[done, None]] = -1
+                    results[start + rows[done], :_k] = selected
+                pending = np.concatenate(short)
+                n_probe = min(2 * n_probe, self.n_lists)
+
+        return results
+
+
+def _blocked_search(queries, n_vectors, score_block, k, exclude=None, block_size=16384):
+    """
+    Top k rows for each query, scoring the catalogue one block of rows at a time with
+    score_block(queries, start, end), masking the Exclusions in exclude (if any) and keeping a
+    running top k: memory is bounded by
+    (n_queries, block_size + k), whatever the size of the catalogue. Rows are padded with -1
+    when there are fewer than k candidates.
+    """
+    n_queries = queries.shape[0]
+    best_scores = np.full((n_queries, k), -np.inf, dtype=np.float32)
+    best_ids = np.full((n_queries, k), -1, dtype=np.int64)
+    for start in range(0, n_vectors, block_size):
+        end = min(start + block_size, n_vectors)
+        scores = score_block(queries, start, end)
+        if exclude is not None:
+            exclude.apply(scores, start)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, np.broadcast_to(np.arange(start, end), (n_queries, end - start))], axis=1)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    best_ids = np.take_along_axis(best_ids, order, axis=1)
+    best_ids[np.take_along_axis(best_scores, order, axis=1) == -np.inf] = -1
+
+    return best_ids
+
+
+def _centering(vectors, block_size=65536):
+    """
+    Mean of the rows of vectors (e.g. memory-mapped) and the bias of each row, (x - mean).mean, one
+    block at a time: the quantized indexes score q.x - q.mean = (q - mean).(x - mean) + bias, and
+    only quantize x - mean.
+    """
+    total = np.zeros(vectors.shape[1], dtype=np.float64)
+    for start in range(0, vectors.shape[0], block_size):
+        total += vectors[start:start + block_size].sum(axis=0, dtype=np.float64)
+    mean = (total / max(vectors.shape[0], 1)).astype(np.float32)
+    bias = np.empty(vectors.shape[0], dtype=np.float32)
+    for start in range(0, vectors.shape[0], block_size):
+        bias[start:start + block_size] = (vectors[start:start + block_size] - mean) @ mean
+
+    return mean, bias
+
+
+def _rerank(vectors, queries, candidates, k):
+    """
+    Keep the k best of the candidates of each query, re-scored with the exact vectors: only those
+    rows are read, so vectors can stay memory-mapped. -1 (padding) stays at the bottom.
+    """
+    exact = np.einsum('ncd,nd->nc', vectors[np.maximum(candidates, 0)], queries)
+    exact[candidates < 0] = -np.inf
+    order = np.argsort(-exact, axis=1, kind='stable')[:, :k]
+    candidates = np.take_along_axis(candidates, order, axis=1)
+    candidates[np.take_along_axis(exact, order, axis=1) == -np.inf] = -1
+
+    return candidates
+
+
+class Int8Index():
+    """
+    Scalar quantization: each dimension of the (normalized) vectors is stored as an int8 with its
+    own scale, i.e. 1 byte per dimension instead of 4. Queries are not quantized (asymmetric
+    distance computation): we fold the scales into the float32 query and score it against the
+    codes directly, one block of the catalogue at a time.
+
+    Word2Vec vectors are far from centered (the norm of their mean is close to 1), so we quantize
+    x - mean instead of x: the codes spend their 255 levels on what tells tracks apart, not on the
+    offset they share. A track is scored (q - mean).(x - mean) + bias, with the exact bias
+    (x - mean).mean kept as one float32 per track: this is q.x minus q.mean, the same for every
+    track, so the ranking of a query is unchanged, and the quantization error is no longer
+    multiplied by the mean, which would swamp the small differences between tracks.
+
+    With rerank > 0, the best k * rerank candidates are re-scored with the exact vectors. Otherwise
+    vectors is only read to look up query vectors (e.g. by the server): either way it can stay
+    memory-mapped.
+    """
+
+    def __init__(self, vectors, rerank=0, chunk_size=1024, block_size=16384, normalized=False):
+        self.vectors = vectors if normalized else normalize(vectors)
+        self.rerank = rerank
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.mean, self.bias = _centering(self.vectors)
+        # symmetric quantization: x - mean ~ codes * scales, with codes in [-127, 127]
+        self.scales = np.zeros(self.vectors.shape[1], dtype=np.float32)
+        for start in range(0, self.vectors.shape[0], 65536):
+            self.scales = np.maximum(
+                self.scales, np.max(np.abs(self.vectors[start:start + 65536] - self.mean), axis=0, initial=0))
+        self.scales /= 127
+        self.scales[self.scales == 0] = 1.0
+        self.codes = np.empty(self.vectors.shape, dtype=np.int8)
+        for start in range(0, self.vectors.shape[0], 65536):
+            self.codes[start:start + 65536] = np.clip(
+                np.rint((self.vectors[start:start + 65536] - self.mean) / self.scales), -127, 127)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes + self.mean.nbytes + self.bias.nbytes
+
+    def _score_block(self, queries, start, end):
+        return queries @ self.codes[start:end].T.astype(np.float32) + self.bias[start:end]
+
+    def search(self, queries, k, exclude=None):
+        """
+        Same contract as IVFIndex.search: rows are padded with -1 if needed.
+        """
+        queries = normalize(queries)
+        exclude = as_exclusions(exclude)
+        n_candidates = k * self.rerank if self.rerank > 0 else k
+        results = np.empty((queries.shape[0], k), dtype=np.int64)
+        for start in range(0, queries.shape[0], self.chunk_size):
+            end = min(start + self.chunk_size, queries.shape[0])
+            candidates = _blocked_search(
+                (queries[start:end] - self.mean) * self.scales, self.codes.shape[0], self._score_block, n_candidates,
+                None if exclude is None else exclude.take(slice(start, end)), self.block_size)
+            if self.rerank > 0:
+                candidates = _rerank(self.vectors, queries[start:end], candidates, k)
+            results[start:end] = candidates
+
+        return results
+
+
+def _kmeans(sample, n_clusters, n_iter, rng):
+    """
+    Plain (euclidean) k-means, for the sub-vectors of product quantization.
+    """
+    sample = np.ascontiguousarray(sample, dtype=np.float32)
+    centroids = sample[rng.choice(sample.shape[0], n_clusters, replace=False)]
+    for _ in range(n_iter):
+        # argmin |x - c|^2 = argmax x.c - |c|^2 / 2
+        assignments = np.argmax(sample @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        sums = np.stack([
+            np.bincount(assignments, weights=sample[:, d], minlength=n_clusters) for d in range(sample.shape[1])
+        ], axis=1)
+        # empty clusters keep their previous centroid
+        centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centroids).astype(np.float32)
+
+    return centroids
+
+
+class PQIndex():
+    """
+    Product quantization: vectors are split in n_subspaces sub-vectors, and each sub-vector is
+    replaced by the id of the closest of 256 centroids (learned with k-means on that subspace),
+    so a track takes n_subspaces bytes (plus its bias, see below) - e.g. 16 bytes instead of 192 for
+    48 float32 dims.
+
+    Queries are not quantized (asymmetric distance computation): the score of a track is the sum,
+    over subspaces, of the dot product between the query sub-vector and the centroid of the track
+    in that subspace. Instead of n_subspaces table lookups per (query, track) pair, we decode one
+    block of codes at a time (a gather in the codebooks) and score all the queries against it with
+    a matrix multiply, which gives the same scores much faster in numpy.
+
+    As in Int8Index, we quantize x - mean, so that the 256 centroids of a subspace are spread over
+    the differences between tracks instead of clustering around the mean, and score
+    (q - mean).(x - mean) + bias, with one float32 bias per track.
+
+    This much compression loses too much to rank the top k directly, so by default the best k * rerank
+    candidates are re-scored with the exact vectors, which only touches those rows (vectors can stay
+    memory-mapped).
+    """
+
+    def __init__(self, vectors, n_subspaces=None, n_iter=10, max_train_size=32768, rerank=4,
+                 chunk_size=1024, block_size=16384, seed=42, normalized=False):
+        self.vectors = vectors if normalized else normalize(vectors)
+        n_vectors, dim = self.vectors.shape
+        self.n_subspaces = n_subspaces or max(1, dim // 4)
+        if dim % self.n_subspaces != 0:
+            raise ValueError("Vector size {} is not a multiple of n_subspaces={}".format(dim, self.n_subspaces))
+        self.rerank = rerank
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.mean, self.bias = _centering(self.vectors)
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(self.vectors[np.sort(rng.choice(n_vectors, min(n_vectors, max_train_size), replace=False))])
+        sample = (sample - self.mean).reshape(sample.shape[0], self.n_subspaces, -1)
+        n_centroids = min(256, sample.shape[0])
+        # (n_subspaces, n_centroids, dim / n_subspaces)
+        self.codebooks = np.stack([
+            _kmeans(sample[:, j], n_centroids, n_iter, rng) for j in range(self.n_subspaces)])
+        self.codes = np.empty((n_vectors, self.n_subspaces), dtype=np.uint8)
+        for j in range(self.n_subspaces):
+            sub_mean = self.mean[j * self.sub_dim:(j + 1) * self.sub_dim]
+            sub_vectors = np.ascontiguousarray(self.vectors[:, j * self.sub_dim:(j + 1) * self.sub_dim]) - sub_mean
+            norms = 0.5 * (self.codebooks[j] ** 2).sum(axis=1)
+            for start in range(0, n_vectors, 65536):
+                self.codes[start:start + 65536, j] = np.argmax(
+                    sub_vectors[start:start + 65536] @ self.codebooks[j].T - norms, axis=1)
+
+    @property
+    def sub_dim(self):
+        return self.codebooks.shape[2]
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.codebooks.nbytes + self.mean.nbytes + self.bias.nbytes
+
+    def decode(self, start, end):
+        """
+        Approximate vectors of rows start to end, rebuilt from their codes.
+        """
+        return self._decode_centered(start, end) + self.mean
+
+    def _decode_centered(self, start, end):
+        codes = self.codes[start:end]
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(self.n_subspaces)], axis=1)
+
+    def _score_block(self, queries, start, end):
+        # queries are centered too, see Int8Index
+        return queries @ self._decode_centered(start, end).T + self.bias[start:end]
+
+    def search(self, queries, k, exclude=None):
+        """
+        Same contract as IVFIndex.search: rows are padded with -1 if needed.
+        """
+        queries = normalize(queries)
+        exclude = as_exclusions(exclude)
+        n_candidates = k * self.rerank if self.rerank > 0 else k
+        results = np.empty((queries.shape[0], k), dtype=np.int64)
+        for start in range(0, queries.shape[0], self.chunk_size):
+            end = min(start + self.chunk_size, queries.shape[0])
+            candidates = _blocked_search(
+                queries[start:end] - self.mean, self.codes.shape[0], self._score_block, n_candidates,
+                None if exclude is None else exclude.take(slice(start, end)), self.block_size)
+            if self.rerank > 0:
+                candidates = _rerank(self.vectors, queries[start:end], candidates, k)
+            results[start:end] = candidates
+
+        return results
+
+
+def resident_nbytes(index):
+    """
+    Memory an index holds in RAM: what its search scans (nbytes), plus the float32 vectors of the
+    quantized indexes unless they are memory-mapped, since their search never reads them all.
+    """
+    if isinstance(index, (Int8Index, PQIndex)) and not isinstance(index.vectors, np.memmap):
+        return index.nbytes + index.vectors.nbytes
+
+    return index.nbytes
+
+
+INDEXES = {
+    'brute_force': BruteForceIndex,
+    'ivf': IVFIndex,
+    'int8': Int8Index,
+    'pq': PQIndex,
+}
+# the indexes which score compressed codes, and can re-score their best candidates exactly
+RERANK_INDEXES = ['int8', 'pq']
+
+
+def build_index(index_type, vectors, rerank=None, **kwargs):
+    """
+    Build a retrieval index over vectors: index_type is one of the keys in INDEXES.
+
+    rerank (if not None) is the re-ranking factor of the quantized indexes, see Int8Index and
+    PQIndex: the float32 indexes are exact over their candidates already, so they ignore it.
+    """
+    if index_type not in INDEXES:
+        raise ValueError("Unknown index type '{}', choose one of: {}".format(index_type, list(INDEXES)))
+    if rerank is not None and index_type in RERANK_INDEXES:
+        kwargs['rerank'] = rerank
+
+    return INDEXES[index_type](vectors, **kwargs)
@@ -0,0 +1,42 @@
+"""
+
+Successive halving for the Word2Vec hyperparameters in RecSysTuningFlow.
+
+Instead of training a handful of hand-picked configurations to completion, we draw many from
+a declared search space, train all of them for a fraction (1 / eta) of their epochs, score them
+on a sample of the validation set, and only let the best 1 / eta of them finish their schedule.
+For the same compute, we get to look at a much larger part of the space: bad configurations
+are usually bad after a few epochs already.
+
+Training is resumed, not restarted, for the configurations we promote (see resume_word2vec in
+training.py), so the survivors end up exactly as if they had been trained in one go.
+
+"""
+
+import itertools
+import random
+
+
+def sample_configs(space, n_configs, seed=42):
+    """
+    Draw n_configs distinct configurations from the grid defined by space (a dictionary from
+    hyperparameter to the list of values we want to try), or all of them if the grid is smaller.
+    """
+    grid = list(itertools.product(*space.values()))
+    picked = random.Random(seed).sample(grid, min(n_configs, len(grid)))
+    return [dict(zip(space.keys(), values)) for values in picked]
+
+
+def rung_epochs(hypers, eta):
+    """
+    Epochs a configuration is trained for before we decide whether to promote it.
+    """
+    return max(1, hypers['epochs'] // eta)
+
+
+def promote(scores, eta):
+    """
+    Keep the best 1 / eta (at least one) of a dictionary from configuration to score, best first.
+    """
+    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    return [_[0] for _ in ranked[:max(1, len(ranked) // eta)]]
@@ -0,0 +1,301 @@
+"""
+
+A self-contained recommendation server, to serve next-track predictions from a plain Linux box
+(no SageMaker, no TensorFlow).
+
+We load the final vectors (the best vector space according to validation) from a finished run of one
+of the recsys flows, and expose it over HTTP with asyncio. Concurrent requests are grouped into
+micro-batches, so that each batch is answered by a single matrix operation in retrieval.py,
+and we keep track of p50/p95/p99 latency. Unknown tracks are answered with the cold-start fallback
+saved with the vectors (see fallback.py).
+
+Usage:
+
+    python serve.py --flow RecSysTuningFlow --port 8080
+    curl -X POST localhost:8080/predict -d '{"track": "Daft Punk|||One More Time", "k": 5}'
+    # with --pooling mean (or recency), the previous tracks of the session are pooled in the query
+    curl -X POST localhost:8080/predict -d '{"track": "Daft Punk|||One More Time", "session": ["Daft Punk|||Aerodynamic"]}'
+    # with --exclude_seen, none of the tracks of the session (nor the track) are recommended
+    curl localhost:8080/stats
+
+    # fire 10k requests, 64 at a time, with random tracks from the vocabulary
+    python serve.py --flow RecSysTuningFlow --load_test 10000 --concurrency 64
+
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import time
+
+import numpy as np
+
+from retrieval import Exclusions, build_index, pool
+
+
+class MicroBatcher():
+    """
+    Collect queries for up to max_wait_ms (or until max_batch_size queries are waiting),
+    then answer all of them with one index search.
+    """
+
+    def __init__(self, index, max_batch_size=256, max_wait_ms=2.0):
+        self.index = index
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = None
+        self.batch_sizes = collections.deque(maxlen=10000)
+
+    async def predict(self, query_vector, exclude, k):
+        """
+        Top k rows for the query vector, without the rows in the int array exclude (-1 is ignored).
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query_vector, exclude, k, future))
+        return await future
+
+    def start(self):
+        """
+        Create the queue in the running event loop and start batching in the background.
+        """
+        self.queue = asyncio.Queue()
+        return asyncio.ensure_future(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            queries = np.stack([_[0] for _ in batch])
+            # one sparse set of rows per query, masked before top k selection
+            exclude = Exclusions.from_lists([_[1] for _ in batch])
+            k = max(_[2] for _ in batch)
+            try:
+                # run the matrix operation off the event loop, so we keep accepting requests
+                results = await loop.run_in_executor(None, self.index.search, queries, k, exclude)
+            except Exception as ex:
+                for _, _, _, future in batch:
+                    future.set_exception(ex)
+                continue
+            self.batch_sizes.append(len(batch))
+            for (_, _, _k, future), row in zip(batch, results):
+                future.set_result(row[:_k])
+
+
+class RecommendationServer():
+
+    def __init__(self, vector_space, index_type='brute_force', max_batch_size=256, max_wait_ms=2.0, fallback=None,
+                 pooling='last', session_length=5, exclude_seen=False, max_k=1000, rerank=None):
+        # clients send and receive 'artist|||track' names, the int ids stay inside the store
+        self.ids = vector_space.names
+        # a micro-batch is searched at the largest k of its requests: we cap it
+        self.max_k = max_k
+        self.fallback = fallback
+        self.pooling = pooling
+        self.session_length = session_length
+        self.exclude_seen = exclude_seen
+        self.key_to_index = {name: i for i, name in enumerate(self.ids)}
+        self.batcher = MicroBatcher(
+            build_index(index_type, vector_space.get_normed_vectors(), normalized=True, rerank=rerank),
+            max_batch_size, max_wait_ms)
+        self.latencies = collections.deque(maxlen=100000)
+        self.rng = np.random.default_rng()
+
+    def stats(self):
+        latencies_ms = 1000 * np.array(self.latencies) if self.latencies else np.zeros(1)
+        p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+        batch_sizes = self.batcher.batch_sizes
+        return {
+            'requests': len(self.latencies),
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'mean_batch_size': float(np.mean(batch_sizes)) if batch_sizes else 0.0
+        }
+
+    async def recommend(self, track, k, session=None):
+        query_index = self.key_to_index.get(track, -1)
+        seen = None
+        if self.exclude_seen:
+            # every track of the session is excluded, not only the query track
+            seen = np.array([self.key_to_index.get(_, -1) for _ in (session or []) + [track]], dtype=np.int64)
+        rows = None
+        if self.pooling != 'last':
+            # the previous tracks of the session, most recent last, as in evaluation.py
+            rows = np.array([[self.key_to_index.get(_, -1) for _ in ((session or []) + [track])[-self.session_length:]]])
+        if rows is not None and (rows >= 0).any():
+            query = pool(self.batcher.index.vectors, rows, self.pooling)[0]
+        elif query_index >= 0:
+            query = self.batcher.index.vectors[query_index]
+        elif self.fallback is None:
+            # unknown track and no cold-start tables in the store: we make a random bet
+            query_index = int(self.rng.integers(0, len(self.ids)))
+            query = self.batcher.index.vectors[query_index]
+        else:
+            # unknown track: search from its artist centroid, or answer with the (precomputed)
+            # most popular tracks if we do not know the artist either
+            artist = self.fallback.name_artist(track)
+            if artist < 0 and seen is None:
+                return [self.ids[_] for _ in self.fallback.popular_tracks(k) if _ >= 0]
+            if artist < 0:
+                # no query vector, so no index search: only the popular tracks the session does not have
+                popular = self.fallback.search(
+                    self.batcher.index, np.array([-1]), np.array([-1]), k, Exclusions.from_lists([seen]))[0]
+                return [self.ids[_] for _ in popular if _ >= 0]
+            query = self.fallback.artist_centroids[artist]
+        # pooled queries are searched in the same micro-batches as the others
+        neighbours = await self.batcher.predict(query, np.array([query_index]) if seen is None else seen, k)
+        return [self.ids[_] for _ in neighbours if _ >= 0]
+
+    async def handle(self, reader, writer):
+        # minimal HTTP/1.1 with keep-alive: enough for curl and load testing
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                start = time.perf_counter()
+                try:
+                    status, payload = await self.route(method, path, body)
+                except Exception as ex:
+                    # answer, instead of dropping the connection
+                    status, payload = '500 Internal Server Error', {'error': repr(ex)}
+                if path == '/predict':
+                    self.latencies.append(time.perf_counter() - start)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    'HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+                        status, len(data)).encode() + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return '200 OK', self.stats()
+        if method == 'POST' and path == '/predict':
+            try:
+                request = json.loads(body)
+                track, k, session = request['track'], int(request.get('k', 10)), request.get('session', [])
+            except (ValueError, KeyError, TypeError, AttributeError):
+                return '400 Bad Request', {'error': 'expected a JSON body like {"track": "...", "k": 10}'}
+            if not 1 <= k <= self.max_k:
+                return '400 Bad Request', {'error': 'k must be between 1 and {}'.format(self.max_k)}
+            if not isinstance(track, str) or not isinstance(session, list) or not all(isinstance(_, str) for _ in session):
+                return '400 Bad Request', {'error': 'track must be a string, and session a list of strings'}
+            return '200 OK', {'track': track, 'predictions': await self.recommend(track, k, session)}
+        return '404 Not Found', {'error': 'unknown route {} {}'.format(method, path)}
+
+    async def serve(self, host, port):
+        batcher = self.batcher.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Serving {} tracks on http://{}:{}".format(len(self.ids), host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+async def load_test(server, host, port, n_requests, concurrency, k):
+    """
+    Spin up the server and hit it with n_requests, concurrency at a time, then print
+    client and server side latency percentiles.
+    """
+    server_task = asyncio.ensure_future(server.serve(host, port))
+    await asyncio.sleep(0.5)
+    tracks = [server.ids[_] for _ in np.random.default_rng(0).integers(0, len(server.ids), n_requests)]
+    latencies = []
+
+    async def client(worker_id):
+        reader, writer = await asyncio.open_connection(host, port)
+        for track in tracks[worker_id::concurrency]:
+            body = json.dumps({'track': track, 'k': k}).encode()
+            start = time.perf_counter()
+            writer.write(
+                'POST /predict HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                    host, len(body)).encode() + body)
+            await writer.drain()
+            await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line == b'\r\n':
+                    break
+                if line.lower().startswith(b'content-length'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(_) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(1000 * np.array(latencies), [50, 95, 99])
+    print("Client: {} requests in {:.2f}s ({:.0f} req/s), p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms".format(
+        n_requests, elapsed, n_requests / elapsed, p50, p95, p99))
+    print("Server: {}".format(server.stats()))
+    server_task.cancel()
+
+
+def load_vectors(flow_name, run_id=None):
+    """
+    Open the (memory-mapped) final vectors of the given run, or of the latest successful run of the flow.
+    """
+    from metaflow import Flow, Run
+    from embedding_store import load_embedding_store
+    run = Run('{}/{}'.format(flow_name, run_id)) if run_id else Flow(flow_name).latest_successful_run
+    print("Loading final vectors from run {}: {}".format(run.pathspec, run.data.final_vectors_path))
+    return load_embedding_store(run.data.final_vectors_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve next-track recommendations over HTTP")
+    parser.add_argument('--flow', default='RecSysTuningFlow', help='Flow storing final_vectors')
+    parser.add_argument('--run_id', default=None, help='Defaults to the latest successful run')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--index', default='brute_force', help='brute_force, ivf, int8 or pq')
+    parser.add_argument('--rerank', type=int, default=4,
+                        help='int8 and pq: re-score the best k * rerank candidates with the exact vectors')
+    parser.add_argument('--max_batch_size', type=int, default=256)
+    parser.add_argument('--max_wait_ms', type=float, default=2.0)
+    parser.add_argument('--pooling', default='last', help='last, mean or recency: how a request session becomes a query')
+    parser.add_argument('--session_length', type=int, default=5)
+    parser.add_argument('--exclude_seen', action='store_true', help='Never recommend the tracks of the request session')
+    parser.add_argument('--load_test', type=int, default=0, help='Number of requests for a local load test')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--max_k', type=int, default=1000, help='Largest k a request can ask for')
+    args = parser.parse_args()
+    from fallback import load_fallback
+    vector_space = load_vectors(args.flow, args.run_id)
+    server = RecommendationServer(
+        vector_space, args.index, args.max_batch_size, args.max_wait_ms, load_fallback(vector_space.path),
+        args.pooling, args.session_length, args.exclude_seen, args.max_k, args.rerank)
+    if args.load_test > 0:
+        asyncio.run(load_test(server, args.host, args.port, args.load_test, args.concurrency, args.k))
+    else:
+        asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,335 @@
+"""
+
+Multi-core Word2Vec training for the recsys flows.
+
+Feeding gensim an iterable of Python lists caps training at roughly one core, however many
+workers we ask for: every sentence goes through the Python interpreter. In corpus_file mode,
+gensim reads a plain text file (one playlist per line, space-separated track ids) directly
+from its C code, with each worker thread reading its own slice of the file, so throughput
+scales with the number of cores.
+
+The prepare step writes the corpus once (see write_corpus in dataset.py), and each branch of
+the foreach trains on it with as many workers as the CPUs it has been allocated.
+
+For daily refreshes, a model from a previous run can also be warm-started: its vocabulary is
+remapped to the ids of the current run, extended with the new tracks, and trained on the new
+playlists only (see update_word2vec).
+
+Every training call records per-epoch stats (see epoch_throughput_callback): wall time, words per
+second, training loss and how busy the worker threads were, i.e. the CPU time of the process over
+workers x wall time. A low utilisation means more workers than the branch can keep busy (e.g. more
+than its cores, or a corpus too small to split): join_runs plots the stats of all the branches,
+next to the peak memory of each one (see rss_mb).
+
+"""
+
+import os
+import sys
+import time
+
+# gensim defaults for the learning rate schedule
+DEFAULT_ALPHA = 0.025
+DEFAULT_MIN_ALPHA = 0.0001
+
+
+def cgroup_cpu_quota():
+    """
+    CPUs granted by the cgroup quota when running in a container (e.g. @batch or @kubernetes
+    with @resources(cpu=N)), None if there is no quota.
+    """
+    # cgroup v2 has 'quota period' in one file, v1 has two files
+    for quota_file, period_file in [
+        ('/sys/fs/cgroup/cpu.max', None),
+        ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    ]:
+        try:
+            with open(quota_file) as f:
+                values = f.read().split()
+            if values[0] in ('max', '-1'):
+                return None
+            if period_file:
+                with open(period_file) as f:
+                    values.append(f.read().strip())
+            return int(values[0]) / int(values[1])
+        except (OSError, ValueError, IndexError):
+            continue
+
+    return None
+
+
+def cpu_allocation():
+    """
+    Number of CPUs this process can actually use: the cgroup quota if any, capped by the
+    cores we are pinned to.
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, int(quota))
+
+    return max(1, cpus)
+
+
+def branch_workers(n_branches=1):
+    """
+    Word2Vec threads for one branch of a foreach: with a cgroup quota the branch has its own
+    allocation, otherwise (e.g. a local run) the parallel branches share the cores of the box.
+    """
+    if cgroup_cpu_quota() is not None:
+        return cpu_allocation()
+
+    return max(1, cpu_allocation() // n_branches)
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process (Linux only), so that each stage reports its own peak.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def rss_mb(field='VmHWM'):
+    """
+    Peak (VmHWM) or current (VmRSS) resident memory of the process in MB: outside Linux, we fall
+    back to the peak of the whole process so far.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    # ru_maxrss is in kB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+def epoch_throughput_callback(first_epoch=0):
+    """
+    A gensim callback timing each epoch: stats are appended to its .epochs list as dictionaries
+    with the epoch (counting from first_epoch), the seconds it took, the words per second over
+    the raw corpus, the training loss of the epoch (None unless the model computes it), the
+    number of workers and their utilisation (CPU seconds of the process per worker and second).
+    """
+    from gensim.models.callbacks import CallbackAny2Vec
+
+    class EpochThroughput(CallbackAny2Vec):
+
+        def __init__(self):
+            self.epochs = []
+            self._start = None
+            self._cpu_start = None
+            self._loss_start = None
+
+        def on_epoch_begin(self, model):
+            # gensim sums the loss over the epochs of a training call
+            self._loss_start = model.get_latest_training_loss()
+            self._cpu_start = time.process_time()
+            self._start = time.perf_counter()
+
+        def on_epoch_end(self, model):
+            seconds = time.perf_counter() - self._start
+            cpu_seconds = time.process_time() - self._cpu_start
+            words = model.corpus_total_words
+            self.epochs.append({
+                'epoch': first_epoch + len(self.epochs),
+                'seconds': seconds,
+                'words_per_second': words / seconds if seconds > 0 else 0.0,
+                'loss': model.get_latest_training_loss() - self._loss_start if model.compute_loss else None,
+                'workers': model.workers,
+                'utilization': cpu_seconds / (seconds * model.workers) if seconds > 0 else 0.0
+            })
+            print("Epoch {}: {:.2f}s, {:.0f} words/s, {:.0%} utilization of {} workers".format(
+                self.epochs[-1]['epoch'], seconds, self.epochs[-1]['words_per_second'],
+                self.epochs[-1]['utilization'], model.workers))
+
+    return EpochThroughput()
+
+
+def alpha_after(hypers, epoch):
+    """
+    Learning rate after the given number of epochs: gensim decays it linearly from alpha to
+    min_alpha over all the epochs of a training call.
+    """
+    alpha, min_alpha = hypers.get('alpha', DEFAULT_ALPHA), hypers.get('min_alpha', DEFAULT_MIN_ALPHA)
+    return alpha - (alpha - min_alpha) * min(epoch, hypers['epochs']) / hypers['epochs']
+
+
+def train_word2vec(corpus_path, hypers, workers, epochs=None):
+    """
+    Train Word2Vec on a corpus file with the given hypers and number of worker threads, and
+    return the model and the per-epoch throughput stats.
+
+    If epochs is less than hypers['epochs'], training stops early, at the learning rate the full
+    schedule would have at that point: resume_word2vec can then run the remaining epochs and get
+    the same schedule as a single training call.
+    """
+    from gensim.models.word2vec import Word2Vec
+    epochs = min(epochs or hypers['epochs'], hypers['epochs'])
+    callback = epoch_throughput_callback()
+    # the loss is reported per epoch by the callback, unless the hypers turn it off
+    model = Word2Vec(
+        corpus_file=corpus_path,
+        workers=workers,
+        callbacks=[callback],
+        **dict({'compute_loss': True}, **dict(hypers, epochs=epochs, min_alpha=alpha_after(hypers, epochs))))
+
+    return model, callback.epochs
+
+
+def resume_word2vec(model, corpus_path, hypers, workers):
+    """
+    Run the epochs left in the schedule of a model from train_word2vec, and return the model and
+    the per-epoch throughput stats.
+    """
+    done = model.epochs
+    callback = epoch_throughput_callback(first_epoch=done)
+    if done < hypers['epochs']:
+        model.workers = workers
+        model.train(
+            corpus_file=corpus_path,
+            total_words=model.corpus_total_words,
+            epochs=hypers['epochs'] - done,
+            start_alpha=alpha_after(hypers, done),
+            end_alpha=alpha_after(hypers, hypers['epochs']),
+            compute_loss=model.compute_loss,
+            callbacks=[callback])
+        model.epochs = hypers['epochs']
+
+    return model, callback.epochs
+
+
+def is_track_id(key):
+    """
+    Whether a model key is a track id (a token of the corpus), not the name of a stale track.
+    """
+    return key.isdigit()
+
+
+def remap_vocabulary(model, old_vocabulary, new_vocabulary):
+    """
+    Translate the keys of a model trained in a previous run (track ids in old_vocabulary) to the
+    track ids in new_vocabulary, matching tracks by name: ids are assigned by popularity, so the same
+    track may get a different id from one run to the next. Tracks that are not in the new vocabulary
+    are keyed by their name ('artist|||track') instead, which no token of the new corpus can match
+    (see drop_stale_tracks): if they come back in a later run, they get their id, and their vector,
+    back, instead of a second (fresh) vector.
+    """
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    keys = model.wv.index_to_key
+    is_id = np.array([is_track_id(_) for _ in keys], dtype=bool)
+    old_ids = np.array([int(key) if _ else 0 for key, _ in zip(keys, is_id)], dtype=np.int64)
+    # the vocabulary is sorted by track_idx, so positions are ids
+    names = old_vocabulary.column('track_id').take(pa.array(old_ids)).to_pylist()
+    names = [name if _ else key for name, key, _ in zip(names, keys, is_id)]
+    new_ids = pc.index_in(pa.array(names, type=pa.string()), value_set=new_vocabulary.column('track_id').combine_chunks())
+    new_ids = new_ids.fill_null(-1).to_numpy().astype(np.int64)
+    model.wv.index_to_key = [str(new_id) if new_id >= 0 else name for new_id, name in zip(new_ids, names)]
+    model.wv.key_to_index = {key: i for i, key in enumerate(model.wv.index_to_key)}
+
+    return model
+
+
+def drop_stale_tracks(vector_space):
+    """
+    Return the KeyedVectors restricted to the tracks of the current vocabulary, i.e. without the
+    names left as keys by remap_vocabulary.
+    """
+    import numpy as np
+    from gensim.models import KeyedVectors
+    keep = np.flatnonzero([is_track_id(_) for _ in vector_space.index_to_key])
+    if keep.shape[0] == len(vector_space.index_to_key):
+        return vector_space
+    current_vectors = KeyedVectors(vector_space.vector_size)
+    current_vectors.add_vectors([vector_space.index_to_key[_] for _ in keep], vector_space.vectors[keep])
+
+    return current_vectors
+
+
+def update_word2vec(model, corpus_path, workers):
+    """
+    Warm start: add the new tracks in corpus_path to the vocabulary of a trained model, and train
+    it on corpus_path only, with the model's own epochs and learning rate schedule. Return the model
+    and the per-epoch throughput stats.
+    """
+    callback = epoch_throughput_callback()
+    model.workers = workers
+    model.build_vocab(corpus_file=corpus_path, update=True)
+    model.train(
+        corpus_file=corpus_path,
+        total_words=model.corpus_total_words,
+        epochs=model.epochs,
+        start_alpha=model.alpha,
+        end_alpha=model.min_alpha,
+        compute_loss=model.compute_loss,
+        callbacks=[callback])
+
+    return model, callback.epochs
+
+
+def throughput_summary(epoch_stats):
+    """
+    Totals of a training run from its per-epoch stats: epochs, workers, seconds, mean words per
+    second and utilisation, and the loss of the last epoch.
+    """
+    if not epoch_stats:
+        return {'epochs': 0, 'workers': None, 'seconds': 0.0, 'words_per_second': 0.0, 'utilization': 0.0, 'last_loss': None}
+
+    return {
+        'epochs': len(epoch_stats),
+        'workers': epoch_stats[-1]['workers'],
+        'seconds': sum(_['seconds'] for _ in epoch_stats),
+        'words_per_second': sum(_['words_per_second'] for _ in epoch_stats) / len(epoch_stats),
+        'utilization': sum(_['utilization'] for _ in epoch_stats) / len(epoch_stats),
+        'last_loss': epoch_stats[-1]['loss']
+    }
+
+
+def short_labels(hyper_strings):
+    """
+    Legend labels for sets of hypers (JSON strings): only the keys that differ across the sets.
+    """
+    import json
+    hypers = [json.loads(_) for _ in hyper_strings]
+    keys = sorted({key for _ in hypers for key in _})
+    varying = [key for key in keys if len({json.dumps(_.get(key)) for _ in hypers}) > 1] or keys
+
+    return [' '.join('{}={}'.format(key, _[key]) for key in varying if key in _) for _ in hypers]
+
+
+def plot_epoch_stats(all_epoch_stats):
+    """
+    A matplotlib figure with words per second, loss and worker utilisation by epoch, one line per
+    set of hypers in all_epoch_stats (hyper string -> per-epoch stats), e.g. for a card.
+    """
+    import matplotlib
+    # no display in a task
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    labels = short_labels(list(all_epoch_stats))
+    # the legend goes below the plots, in two columns
+    legend_height = 0.25 * ((len(labels) + 1) // 2)
+    fig, axes = plt.subplots(1, 3, figsize=(15, 4 + legend_height))
+    for label, epoch_stats in zip(labels, all_epoch_stats.values()):
+        epochs = [_['epoch'] for _ in epoch_stats]
+        axes[0].plot(epochs, [_['words_per_second'] for _ in epoch_stats], label=label)
+        if all(_['loss'] is not None for _ in epoch_stats):
+            axes[1].plot(epochs, [_['loss'] for _ in epoch_stats], label=label)
+        axes[2].plot(epochs, [_['utilization'] for _ in epoch_stats], label=label)
+    for ax, title in zip(axes, ['words / second', 'training loss', 'worker utilization']):
+        ax.set_title(title)
+        ax.set_xlabel('epoch')
+    axes[2].set_ylim(0, 1.05)
+    fig.tight_layout()
+    fig.subplots_adjust(bottom=(legend_height + 0.7) / (4 + legend_height))
+    fig.legend(*axes[0].get_legend_handles_labels(), loc='lower center', ncol=2, fontsize='small', frameon=False)
+
+    return fig
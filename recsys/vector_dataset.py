@@ -0,0 +1,192 @@
+"""
+
+Track vectors as a Lance dataset, next to cleaned_spotify_dataset.lance: one row per track with
+its track_id ('artist|||track'), artist and L2 normalized vector, and an IVF-PQ vector index.
+
+The embedding stores (see embedding_store.py) are private to a run and keyed by the int track ids
+of that run. The vector dataset is what leaves the flow instead: a single path per flow, where
+each deploy writes a new Lance version (so a client can pin the version of a run, or time travel
+back to it), keyed by names that stay the same across runs. KNN lookups, filtered lookups (e.g.
+only tracks of an artist) and incremental appends all go through TrackVectorDataset, against the
+same on-disk store: Lance only reads the index partitions and the rows it needs.
+
+Vectors are normalized, so ranking by (squared) L2 distance, Lance's default metric, is ranking by
+cosine similarity, i.e. the same neighbours as most_similar: similarity = 1 - _distance / 2.
+
+Usage:
+
+    tracks = TrackVectorDataset('embedding_stores/PlaylistRecsFlow/track_vectors.lance')
+    tracks.similar_tracks('Daft Punk|||One More Time', k=10)
+    tracks.similar_tracks('Daft Punk|||One More Time', k=10, artist='Daft Punk')
+
+"""
+
+import math
+
+import numpy as np
+
+VECTOR_COLUMN = 'vector'
+# below this, an exhaustive search is about as fast as the index, which we do not train
+MIN_INDEX_ROWS = 16384
+# PQ trains 256 centroids per sub-vector, and IVF wants ~256 vectors per partition
+ROWS_PER_PARTITION = 256
+
+
+def _quote(value):
+    # SQL string literal for Lance filters
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def track_reader(vector_space, batch_size=65536):
+    """
+    Stream of record batches (track_id, artist, vector) for the rows of a vector space with names
+    (e.g. an embedding store), so that the (memory-mapped) matrix is never copied as a whole.
+    """
+    import pyarrow as pa
+    names = vector_space.names
+    normed_vectors = vector_space.get_normed_vectors()
+    dim = normed_vectors.shape[1]
+    schema = pa.schema([
+        ('track_id', pa.string()),
+        ('artist', pa.string()),
+        (VECTOR_COLUMN, pa.list_(pa.float32(), dim))
+    ])
+
+    def batches():
+        for start in range(0, len(names), batch_size):
+            batch_names = names[start:start + batch_size]
+            vectors = np.ascontiguousarray(normed_vectors[start:start + batch_size], dtype=np.float32)
+            yield pa.RecordBatch.from_arrays([
+                pa.array(batch_names, type=pa.string()),
+                pa.array([_.split('|||', 1)[0] for _ in batch_names], type=pa.string()),
+                pa.FixedSizeListArray.from_arrays(pa.array(vectors.ravel()), dim)
+            ], schema=schema)
+
+    return pa.RecordBatchReader.from_batches(schema, batches())
+
+
+def index_params(n_rows, dim):
+    """
+    IVF partitions and PQ sub-vectors for n_rows vectors of size dim: ~sqrt(n) partitions (but
+    at least ROWS_PER_PARTITION vectors in each) and sub-vectors of ~4 dimensions, as in PQIndex
+    (see retrieval.py).
+    """
+    num_partitions = max(1, min(int(math.sqrt(n_rows)), n_rows // ROWS_PER_PARTITION))
+    # the sub-vectors have to split the vector evenly
+    num_sub_vectors = max(_ for _ in range(1, max(1, dim // 4) + 1) if dim % _ == 0)
+
+    return num_partitions, num_sub_vectors
+
+
+class TrackVectorDataset():
+    """
+    A (version of a) Lance dataset of track vectors written by write_vector_dataset.
+    """
+
+    def __init__(self, path, version=None):
+        import lance
+        self.path = path
+        self.dataset = lance.dataset(path, version=version)
+
+    @property
+    def version(self):
+        return self.dataset.version
+
+    def __len__(self):
+        return self.dataset.count_rows()
+
+    def has_index(self):
+        return any(VECTOR_COLUMN in _['fields'] for _ in self.dataset.list_indices())
+
+    def create_index(self, num_partitions=None, num_sub_vectors=None):
+        """
+        (Re)build the IVF-PQ index on the vectors, as a new version: small datasets (dev runs) are
+        left without index, and searched exhaustively.
+        """
+        import lance
+        n_rows = len(self)
+        if n_rows < MIN_INDEX_ROWS:
+            print("Only {} track vectors: no vector index".format(n_rows))
+            return False
+        default_partitions, default_sub_vectors = index_params(
+            n_rows, self.dataset.schema.field(VECTOR_COLUMN).type.list_size)
+        self.dataset.create_index(
+            VECTOR_COLUMN,
+            index_type='IVF_PQ',
+            num_partitions=num_partitions or default_partitions,
+            num_sub_vectors=num_sub_vectors or default_sub_vectors,
+            replace=True)
+        self.dataset = lance.dataset(self.path)
+
+        return True
+
+    def search(self, vector, k=10, artist=None, exclude=None, nprobes=20, refine_factor=None):
+        """
+        The k tracks closest to vector, as an Arrow table (track_id, artist, _distance), best first:
+        only tracks of artist if given, never the track_id exclude. Filters are applied before the
+        search, so we still get k tracks. With the index, nprobes partitions are searched and the
+        top k * refine_factor candidates (if set) re-ranked with exact distances.
+        """
+        nearest = {'column': VECTOR_COLUMN, 'q': np.asarray(vector, dtype=np.float32), 'k': k, 'nprobes': nprobes}
+        if refine_factor:
+            nearest['refine_factor'] = refine_factor
+        conditions = []
+        if artist is not None:
+            conditions.append('artist = {}'.format(_quote(artist)))
+        if exclude is not None:
+            conditions.append('track_id != {}'.format(_quote(exclude)))
+
+        return self.dataset.to_table(
+            columns=['track_id', 'artist', '_distance'],
+            nearest=nearest,
+            filter=' AND '.join(conditions) if conditions else None,
+            prefilter=bool(conditions))
+
+    def vector(self, track_id):
+        """
+        The vector of track_id, None if the track is not in the dataset.
+        """
+        table = self.dataset.to_table(
+            columns=[VECTOR_COLUMN], filter='track_id = {}'.format(_quote(track_id)), limit=1)
+        if table.num_rows == 0:
+            return None
+        return table[VECTOR_COLUMN][0].values.to_numpy()
+
+    def similar_tracks(self, track_id, k=10, artist=None, **search_kwargs):
+        """
+        The k tracks most similar to track_id (optionally, only those of artist) as a list of
+        (track_id, similarity) pairs, like most_similar: empty for an unknown track.
+        """
+        vector = self.vector(track_id)
+        if vector is None:
+            return []
+        table = self.search(vector, k, artist, exclude=track_id, **search_kwargs)
+
+        return [(name, 1.0 - distance / 2) for name, distance in zip(
+            table['track_id'].to_pylist(), table['_distance'].to_pylist())]
+
+    def append(self, vector_space):
+        """
+        Add the tracks of a vector space with names as a new version: until the index is rebuilt
+        (create_index), the new rows are searched exhaustively, on top of the indexed ones.
+        """
+        import lance
+        lance.write_dataset(track_reader(vector_space), self.path, mode='append')
+        self.dataset = lance.dataset(self.path)
+
+        return self
+
+
+def write_vector_dataset(path, vector_space, index=True, **index_kwargs):
+    """
+    Write the tracks of a vector space with names (e.g. an embedding store) as a new version of
+    the Lance dataset in path (created if needed), index them (see create_index) and return the
+    TrackVectorDataset at that version.
+    """
+    import lance
+    lance.write_dataset(track_reader(vector_space), path, mode='overwrite')
+    dataset = TrackVectorDataset(path)
+    if index:
+        dataset.create_index(**index_kwargs)
+
+    return dataset